@@ -1,60 +1,134 @@
+import threading
+import time
+
+from django.conf import settings
+
+from cheques.cache import bump_namespace, fill_reads, get_or_set, namespace_version, versioned_key
 from cheques.models import PaymentInstrumentType, PaymentInstrument
 
 
-class InstrumentPolicy:
-    _instance = None
+class PaymentInstrumentPolicy:
+    """
+    Reference cache of payment instrument types and instruments.
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-        return cls._instance
+    Both tables are loaded together and kept in per-process dicts keyed by id
+    and by (branch_id, serial_no); each cached instrument has its
+    instrument_type attached, so instrument.instrument_type costs no query.
+    The loaded rows are also stored in the shared cache under the 'reference'
+    namespace, so one worker's load warms the others.
 
-    def __init__(self):
-        # Initialize the instance (this will only run once)
-        if not hasattr(self, 'initialized'):
-            print("Singleton instance initialized!")
-            self.initialized = True
+    post_save/post_delete of either model (see signals.py) bump that
+    namespace once the write commits. Workers check the shared version at most every
+    REFERENCE_CACHE_CHECK_SECONDS and reload when it moved; entries live for
+    REFERENCE_CACHE_SECONDS regardless.
 
-# Get instances of the singleton class
-# instance1 = PaymentInstrument()
-# instance2 = PaymentInstrument()
+    Cached rows are shared between requests: treat them as read-only, and
+    never read PaymentInstrumentType.last_number from here - auto numbering
+    must lock the row with select_for_update.
+    """
+    _lock = threading.Lock()
+    _generation = 0
+    _loaded_at = None
+    _checked_at = None
+    _shared_version = None
+    _types_by_id = {}
+    _types_by_serial = {}
+    _instruments_by_id = {}
+    _instruments_by_serial = {}
 
-# print(instance1 is instance2) # Output: True
+    @classmethod
+    def invalidate(cls):
+        with cls._lock:
+            cls._generation += 1
+            cls._loaded_at = None
+        bump_namespace('reference')
 
-class PaymentInstrumentPolicy:
-    _payment_instrument_types = None
-    _payment_instruments = None
+    @classmethod
+    def _is_fresh(cls):
+        loaded_at = cls._loaded_at
+        now = time.monotonic()
+        if loaded_at is None or now - loaded_at >= getattr(settings, 'REFERENCE_CACHE_SECONDS', 300):
+            return False
+        if now - cls._checked_at < getattr(settings, 'REFERENCE_CACHE_CHECK_SECONDS', 2):
+            return True
+        cls._checked_at = now
+        return namespace_version('reference') == cls._shared_version
+
+    @staticmethod
+    def _load_rows():
+        with fill_reads('reference'):
+            return list(PaymentInstrumentType.objects.all()), list(PaymentInstrument.objects.all())
+
+    @classmethod
+    def _ensure_loaded(cls):
+        if cls._is_fresh():
+            return
+
+        generation = cls._generation
+        shared_version = namespace_version('reference')
+        types, instruments = get_or_set(
+            versioned_key('reference', None, 'payment-instruments'),
+            cls._load_rows,
+            getattr(settings, 'REFERENCE_CACHE_SECONDS', 300),
+        )
+        types = {t.id: t for t in types}
+        instruments = {i.id: i for i in instruments}
+        for instrument in instruments.values():
+            instrument.instrument_type = types[instrument.instrument_type_id]
+
+        with cls._lock:
+            cls._types_by_id = types
+            cls._types_by_serial = {(t.branch_id, t.serial_no): t for t in types.values()}
+            cls._instruments_by_id = instruments
+            cls._instruments_by_serial = {(i.branch_id, i.serial_no): i for i in instruments.values()}
+            cls._shared_version = shared_version
+            # A write that landed while loading leaves the cache marked stale
+            if generation == cls._generation:
+                cls._loaded_at = cls._checked_at = time.monotonic()
+
+    @staticmethod
+    def _as_id(value):
+        try:
+            return int(getattr(value, 'pk', value))
+        except (TypeError, ValueError):
+            return None
 
     @classmethod
     def get_payment_instrument_types(cls):
-        if cls._payment_instrument_types is None:
-            cls._payment_instrument_types = PaymentInstrumentType.objects.all()
-        return cls._payment_instrument_types
+        cls._ensure_loaded()
+        return list(cls._types_by_id.values())
 
     @classmethod
     def get_payment_instruments(cls):
-        if cls._payment_instruments is None:
-            cls._payment_instruments = PaymentInstrument.objects.all()
-        return cls._payment_instruments
+        cls._ensure_loaded()
+        return list(cls._instruments_by_id.values())
+
+    @classmethod
+    def get_instrument_type(cls, type_id):
+        cls._ensure_loaded()
+        return cls._types_by_id.get(cls._as_id(type_id))
+
+    @classmethod
+    def get_instrument(cls, instrument_id):
+        cls._ensure_loaded()
+        return cls._instruments_by_id.get(cls._as_id(instrument_id))
+
+    @classmethod
+    def get_instrument_type_by_serial(cls, branch_id, serial_no):
+        cls._ensure_loaded()
+        return cls._types_by_serial.get((branch_id, serial_no))
+
+    @classmethod
+    def get_instrument_by_serial(cls, branch_id, serial_no):
+        cls._ensure_loaded()
+        return cls._instruments_by_serial.get((branch_id, serial_no))
 
     @classmethod
     def get_instrument_auto_number_by_id(cls, instrument_id):
-        if not cls._payment_instruments:
-            for instrument in cls.get_payment_instruments():
-                if instrument.id == instrument_id:
-                    ins_type=  instrument.instrument_type
-                    exit
-            for instrumentType in cls.get_payment_instrument_types():
-                if instrumentType.id == ins_type:
-                    return instrumentType.auto_number
-                
-        return None
-    
+        instrument = cls.get_instrument(instrument_id)
+        return instrument.instrument_type.auto_number if instrument else None
+
     @classmethod
     def get_instrument_auto_number_by_type_id(cls, ins_type_id):
-
-        for instrumentType in cls.get_payment_instrument_types():
-            if instrumentType.id == ins_type_id:
-                return instrumentType.auto_number
-                
-        return None
\ No newline at end of file
+        instrument_type = cls.get_instrument_type(ins_type_id)
+        return instrument_type.auto_number if instrument_type else None
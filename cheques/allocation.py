@@ -0,0 +1,161 @@
+"""
+Invoice allocation for incoming payments.
+
+Given a parent customer's unpaid invoices and a received amount, propose the
+invoices the payment settles:
+
+1. an exact match - a subset of invoices whose net amounts add up to the
+   received amount, preferring the oldest grace dates - searched depth-first
+   within a time budget, otherwise
+2. FIFO by grace date - the oldest invoices that fit in the amount.
+
+Amounts are compared as integers in units of 1/10000 (the DecimalField scale)
+so the search is exact.
+"""
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import F
+
+from .models import CreditInvoice
+
+SCALE = Decimal('10000')
+
+# Steps of a find_exact_subset() stack frame
+ENTER, INCLUDED, EXCLUDED = range(3)
+
+
+def to_units(amount):
+    return int((Decimal(amount) * SCALE).to_integral_value())
+
+
+def from_units(units):
+    return (Decimal(units) / SCALE).quantize(Decimal('0.0001'))
+
+
+def load_unpaid_invoices(parent_alias_id, branch_id=None):
+    # One query for everything the allocator needs
+    queryset = CreditInvoice.objects.filter(
+        customer__parent__alias_id=parent_alias_id,
+        payment__isnull=True,
+    )
+    if branch_id is not None:
+        queryset = queryset.filter(branch_id=branch_id)
+
+    invoices = []
+    for row in queryset.values(
+        'id', 'alias_id', 'grn', 'transaction_date', 'payment_grace_days',
+        'customer__alias_id', 'customer__name',
+        net_amount=F('sales_amount') - F('sales_return'),
+    ):
+        row['grace_date'] = row['transaction_date'] + timedelta(days=row['payment_grace_days'] or 0)
+        invoices.append(row)
+
+    invoices.sort(key=lambda i: (i['grace_date'], i['transaction_date'], i['id']))
+    return invoices
+
+
+def find_exact_subset(amounts, target, budget_seconds):
+    """
+    Depth-first subset-sum over non-negative integer amounts, trying items in
+    order (oldest first) so the first hit favours older invoices. Returns the
+    chosen indexes, or None when there is no exact match or the budget runs out.
+    """
+    if target == 0:
+        return []
+
+    suffix = [0] * (len(amounts) + 1)
+    for i in range(len(amounts) - 1, -1, -1):
+        suffix[i] = suffix[i + 1] + amounts[i]
+    if suffix[0] < target:
+        return None
+
+    deadline = time.perf_counter() + budget_seconds
+    dead_ends = set()
+    chosen = []
+    nodes = 0
+
+    # An explicit stack rather than recursion: the depth is the number of
+    # invoices, which has no useful bound. A frame (i, remaining, step) is
+    # popped on ENTER, again as INCLUDED once the branch taking amounts[i]
+    # failed, and as EXCLUDED once the branch skipping it failed too.
+    stack = [(0, target, ENTER)]
+    while stack:
+        i, remaining, step = stack.pop()
+        if step == ENTER:
+            if remaining == 0:
+                return list(chosen)
+            if i == len(amounts) or suffix[i] < remaining or (i, remaining) in dead_ends:
+                continue
+            nodes += 1
+            if nodes % 1024 == 0 and time.perf_counter() > deadline:
+                return None
+            if amounts[i] <= remaining:
+                chosen.append(i)
+                stack.append((i, remaining, INCLUDED))
+                stack.append((i + 1, remaining - amounts[i], ENTER))
+            else:
+                stack.append((i, remaining, EXCLUDED))
+                stack.append((i + 1, remaining, ENTER))
+        elif step == INCLUDED:
+            chosen.pop()
+            stack.append((i, remaining, EXCLUDED))
+            stack.append((i + 1, remaining, ENTER))
+        else:
+            dead_ends.add((i, remaining))
+    return None
+
+
+def propose_allocation(invoices, amount, budget_ms=None):
+    """
+    Pick the invoices settled by `amount` out of `invoices` (as returned by
+    load_unpaid_invoices). Invoices with a zero or negative net are always
+    included; a credit simply adds to the amount available.
+    """
+    if budget_ms is None:
+        budget_ms = getattr(settings, 'ALLOCATION_SEARCH_BUDGET_MS', 50)
+
+    credits = [i for i in invoices if to_units(i['net_amount']) <= 0]
+    candidates = [i for i in invoices if to_units(i['net_amount']) > 0]
+    available = to_units(amount) - sum(to_units(i['net_amount']) for i in credits)
+
+    amounts = [to_units(i['net_amount']) for i in candidates]
+    indexes = find_exact_subset(amounts, available, budget_ms / 1000) if available >= 0 else None
+
+    if indexes is not None:
+        match = 'exact'
+        selected = [candidates[i] for i in indexes]
+    else:
+        match = 'fifo'
+        selected = []
+        running = 0
+        for invoice, units in zip(candidates, amounts):
+            if running + units > available:
+                break
+            selected.append(invoice)
+            running += units
+
+    selected = sorted(credits + selected, key=lambda i: (i['grace_date'], i['transaction_date'], i['id']))
+    allocated = sum(to_units(i['net_amount']) for i in selected)
+
+    return {
+        'match': match,
+        'received_amount': from_units(to_units(amount)),
+        'allocated_amount': from_units(allocated),
+        'unallocated_amount': from_units(to_units(amount) - allocated),
+        'open_invoice_count': len(invoices),
+        'invoices': [
+            {
+                'alias_id': i['alias_id'],
+                'grn': i['grn'],
+                'customer': i['customer__alias_id'],
+                'customer_name': i['customer__name'],
+                'transaction_date': i['transaction_date'],
+                'grace_date': i['grace_date'],
+                'net_amount': i['net_amount'],
+            }
+            for i in selected
+        ],
+    }
@@ -0,0 +1,124 @@
+"""
+Archival of settled history to the archive_* tables.
+
+A payment is archived together with its details, their claims and the
+invoices it paid, once:
+
+- it was received more than ARCHIVE_AFTER_DAYS ago, and
+- every claim on its details is closed (nothing remaining) and was refunded
+  before that cutoff
+
+Unpaid invoices and open claims never move, so the unpaid-invoice, due and
+claims queries only ever scan recent rows. Each batch of payments is copied
+to the archive tables (same ids and alias_ids) and deleted from the hot
+tables in one transaction; archived rows stay readable through the archive
+endpoints and the customer statement (cheques/statement.py).
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .cache import bump_namespace
+from .claim_summary import invalidate_claims_summary
+from .models import (
+    ArchivedClaim, ArchivedCreditInvoice, ArchivedPayment, ArchivedPaymentDetails,
+    Claim, CreditInvoice, Payment, PaymentDetails,
+)
+
+DEFAULT_BATCH_SIZE = 500
+
+# Hot model -> archive model, in the order the archive rows are inserted
+ARCHIVED_MODELS = [
+    (Payment, ArchivedPayment),
+    (PaymentDetails, ArchivedPaymentDetails),
+    (Claim, ArchivedClaim),
+    (CreditInvoice, ArchivedCreditInvoice),
+]
+
+
+def archive_cutoff(older_than_days=None, today=None):
+    if older_than_days is None:
+        older_than_days = getattr(settings, 'ARCHIVE_AFTER_DAYS', 730)
+    return (today or timezone.localdate()) - timedelta(days=older_than_days)
+
+
+def archivable_payments(cutoff, branch_id=None):
+    """Payments received before `cutoff` with no claim still open or refunded since."""
+    unsettled = Claim.objects.filter(payment_details__payment_id=OuterRef('pk')).filter(
+        Q(remaining_amount__gt=0) | Q(refund_date__gte=cutoff)
+    )
+    queryset = Payment.objects.filter(received_date__lt=cutoff).exclude(Exists(unsettled))
+    if branch_id is not None:
+        queryset = queryset.filter(branch_id=branch_id)
+    return queryset
+
+
+def _rows(model, payment_ids):
+    if model is Payment:
+        return Payment.objects.filter(pk__in=payment_ids)
+    if model is Claim:
+        return Claim.objects.filter(payment_details__payment_id__in=payment_ids)
+    return model.objects.filter(payment_id__in=payment_ids)
+
+
+def _copy(model, archive_model, payment_ids, archived_at):
+    fields = [field.attname for field in archive_model._meta.concrete_fields if field.name != 'archived_at']
+    rows = [archive_model(archived_at=archived_at, **values)
+            for values in _rows(model, payment_ids).values(*fields)]
+    archive_model.objects.bulk_create(rows)
+    return len(rows)
+
+
+def _delete(model, payment_ids):
+    # A plain DELETE: the rows live on in the archive, there is nothing for
+    # the collector to cascade to, and the caller drops the caches signals
+    # would have
+    rows = _rows(model, payment_ids).order_by()
+    return rows._raw_delete(rows.db)
+
+
+def archive_batch(payment_ids):
+    """Move the given payments with their details, claims and invoices; returns the row counts."""
+    counts = {}
+    archived_at = timezone.now()
+    for model, archive_model in ARCHIVED_MODELS:
+        counts[model._meta.db_table] = _copy(model, archive_model, payment_ids, archived_at)
+    for model, _ in reversed(ARCHIVED_MODELS):
+        _delete(model, payment_ids)
+    return counts
+
+
+def archive_settled(cutoff, branch_id=None, batch_size=DEFAULT_BATCH_SIZE, dry_run=False):
+    """
+    Archive every archivable payment (see archivable_payments), batch_size
+    payments per transaction. Returns the rows moved per hot table; with
+    dry_run, the rows that would be moved.
+    """
+    totals = {model._meta.db_table: 0 for model, _ in ARCHIVED_MODELS}
+    if dry_run:
+        payment_ids = archivable_payments(cutoff, branch_id).values('pk')
+        for model, _ in ARCHIVED_MODELS:
+            totals[model._meta.db_table] = _rows(model, payment_ids).count()
+        return totals
+
+    branch_ids = set()
+    while True:
+        with transaction.atomic():
+            batch = list(
+                archivable_payments(cutoff, branch_id).select_for_update(skip_locked=True)
+                .order_by('pk').values_list('pk', 'branch_id')[:batch_size]
+            )
+            if not batch:
+                break
+            payment_ids = [pk for pk, _ in batch]
+            for table, count in archive_batch(payment_ids).items():
+                totals[table] += count
+            branch_ids.update(branch for _, branch in batch)
+
+    if branch_ids:
+        bump_namespace('dues', *branch_ids)
+        invalidate_claims_summary(*branch_ids)
+    return totals
@@ -0,0 +1,45 @@
+"""
+JWT authentication with the user resolved from the shared cache.
+
+JWTAuthentication loads the user row on every request. Here the profile
+columns of the loaded user (CACHED_USER_FIELDS - never the password hash) are
+cached per (user id, token jti) for AUTH_USER_CACHE_SECONDS under the
+'auth-user' namespace of that user, and turned back into a User with the
+other columns deferred. signals.py bumps the namespace once a change to the
+user, its groups or its permissions commits - so deactivating a user or
+changing a password still takes effect on the next request. Permissions are
+never cached: has_perm() loads them per request as usual.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+from .cache import bump_namespace, versioned_key
+
+CACHED_USER_FIELDS = {'id', 'username', 'first_name', 'last_name', 'email', 'is_active', 'is_staff', 'is_superuser'}
+
+
+def invalidate_cached_user(*user_ids):
+    bump_namespace('auth-user', *user_ids)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if user_id is None:
+            return super().get_user(validated_token)
+
+        key = versioned_key('auth-user', user_id, validated_token.get(api_settings.JTI_CLAIM))
+        fields = [f.attname for f in self.user_model._meta.concrete_fields if f.attname in CACHED_USER_FIELDS]
+        values = cache.get(key)
+        if values is None:
+            # Runs the is_active / revoked-token checks; only users that pass are cached
+            user = super().get_user(validated_token)
+            cache.set(key, [getattr(user, field) for field in fields],
+                      getattr(settings, 'AUTH_USER_CACHE_SECONDS', 60))
+            return user
+        # Like a .only(*fields) row: other columns load on access, save() writes only these
+        return self.user_model.from_db(router.db_for_read(self.user_model), fields, values)
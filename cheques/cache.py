@@ -0,0 +1,237 @@
+"""
+Shared cache helpers.
+
+Everything here goes through the cache configured in settings.CACHES (Redis
+in production), so an entry is warmed once for all gunicorn workers rather
+than once per process. Keys are namespaced per branch and versioned:
+invalidating a namespace bumps its version number instead of hunting down
+keys, and entries written under older versions simply expire.
+
+Entries are filled from wherever the request reads (see db_router.py); a
+namespace bumped moments ago is filled from the primary, since the replica
+may not have the write that invalidated it yet.
+"""
+import functools
+import hashlib
+import inspect
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+
+from . import db_router
+
+DEFAULT_TIMEOUT = 300
+_MISSING = object()
+
+
+def _namespace_key(namespace, branch_id):
+    return f'ns:{namespace}:{branch_id}'
+
+
+def namespace_version(namespace, branch_id=None):
+    key = _namespace_key(namespace, branch_id)
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock, so a version entry that was evicted can't
+        # come back with a number used by older entries
+        version = time.time_ns()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_namespace(namespace, *branch_ids):
+    """
+    Invalidate everything cached under `namespace` for the given branches (or
+    the global one). Inside a transaction the bump waits for the commit:
+    bumped earlier, an entry refilled in between would cache the old rows
+    under the new version.
+    """
+    keys = [_namespace_key(namespace, branch_id) for branch_id in set(branch_ids) or {None}]
+
+    def bump():
+        for key in keys:
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, time.time_ns(), None)
+        db_router.note_writes(*keys)
+    transaction.on_commit(bump)
+
+
+def fill_reads(namespace, branch_id=None):
+    """Context for computing a missing entry of `namespace`: the primary right after a bump."""
+    return db_router.fresh_reads(_namespace_key(namespace, branch_id))
+
+
+def versioned_key(namespace, branch_id, *parts):
+    digest = hashlib.sha256(repr(parts).encode()).hexdigest()[:32]
+    return f'{namespace}:{branch_id}:{namespace_version(namespace, branch_id)}:{digest}'
+
+
+def get_or_set(key, default, timeout=DEFAULT_TIMEOUT):
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        value = default()
+        cache.set(key, value, timeout)
+    return value
+
+
+# Branch aliases never change (editable=False) and ids are never reused, so
+# both directions of the alias <-> id map are also memoised per process.
+# Deleting a branch bumps the 'branches' namespace; each process drops its
+# memo when it sees the bump, checked at most every
+# REFERENCE_CACHE_CHECK_SECONDS.
+_branch_id_by_alias = {}
+_branch_alias_by_id = {}
+_branch_memo_version = None
+_branch_memo_checked_at = None
+
+
+def _check_branch_memo():
+    global _branch_memo_version, _branch_memo_checked_at
+    now = time.monotonic()
+    if (_branch_memo_checked_at is not None
+            and now - _branch_memo_checked_at < getattr(settings, 'REFERENCE_CACHE_CHECK_SECONDS', 2)):
+        return
+    version = namespace_version('branches')
+    if version != _branch_memo_version:
+        _branch_id_by_alias.clear()
+        _branch_alias_by_id.clear()
+        _branch_memo_version = version
+    _branch_memo_checked_at = now
+
+
+def branch_id_for_alias(alias_id):
+    if not alias_id:
+        return None
+    _check_branch_memo()
+    branch_id = _branch_id_by_alias.get(alias_id)
+    if branch_id is None:
+        key = f'branch-alias:{alias_id}'
+        branch_id = cache.get(key)
+        if branch_id is None:
+            from .models import Branch  # imported late: cheques.authentication loads before the models
+            branch_id = Branch.objects.filter(alias_id=alias_id).values_list('id', flat=True).first()
+            if branch_id is None:
+                return None
+            cache.set(key, branch_id, None)
+        _branch_id_by_alias[alias_id] = branch_id
+        _branch_alias_by_id[branch_id] = alias_id
+    return branch_id
+
+
+def branch_alias_for_id(branch_id):
+    if branch_id is None:
+        return None
+    _check_branch_memo()
+    alias_id = _branch_alias_by_id.get(branch_id)
+    if alias_id is None:
+        key = f'branch-id:{branch_id}'
+        alias_id = cache.get(key)
+        if alias_id is None:
+            from .models import Branch
+            alias_id = Branch.objects.filter(pk=branch_id).values_list('alias_id', flat=True).first()
+            if alias_id is None:
+                return None
+            cache.set(key, alias_id, None)
+        _branch_alias_by_id[branch_id] = alias_id
+        _branch_id_by_alias[alias_id] = branch_id
+    return alias_id
+
+
+def branch_for_alias(alias_id):
+    """The Branch row for an alias, cached until the branch is saved or deleted."""
+    if not alias_id:
+        return None
+    key = f'branch:{alias_id}'
+    branch = cache.get(key)
+    if branch is None:
+        from .models import Branch
+        branch = Branch.objects.filter(alias_id=alias_id).first()
+        if branch is not None:
+            cache.set(key, branch, DEFAULT_TIMEOUT)
+    return branch
+
+
+def forget_branch(alias_id, branch_id, deleted=False):
+    """Drop the cached row of a saved branch, and every mapping of a deleted one, once committed."""
+    def forget():
+        cache.delete(f'branch:{alias_id}')
+        if deleted:
+            _branch_id_by_alias.pop(alias_id, None)
+            _branch_alias_by_id.pop(branch_id, None)
+            cache.delete_many([f'branch-alias:{alias_id}', f'branch-id:{branch_id}'])
+    transaction.on_commit(forget)
+    if deleted:
+        bump_namespace('branches')
+
+
+def request_branch_id(request):
+    """
+    The id of the ?branch=<alias> of a request, resolved once per request.
+    None when no branch was given or the alias is unknown.
+    """
+    try:
+        return request._branch_id
+    except AttributeError:
+        request._branch_id = branch_id_for_alias(request.query_params.get('branch'))
+        return request._branch_id
+
+
+def cached_for_branch(namespace, timeout=DEFAULT_TIMEOUT):
+    """
+    Cache a function's (or method's) return value under `namespace`. The
+    function must take a `branch_id` argument; the remaining arguments are
+    part of the key. Results must be picklable - evaluate querysets first.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = sorted(
+                (name, value) for name, value in bound.arguments.items() if name != 'self'
+            )
+            branch_id = bound.arguments.get('branch_id')
+            key = versioned_key(namespace, branch_id, func.__module__, func.__qualname__, arguments)
+
+            def compute():
+                with fill_reads(namespace, branch_id):
+                    return func(*args, **kwargs)
+            return get_or_set(key, compute, timeout)
+
+        return wrapper
+    return decorator
+
+
+def cache_branch_response(namespace, timeout=DEFAULT_TIMEOUT):
+    """
+    Cache successful responses of a DRF handler per ?branch= and query
+    string, under `namespace`. Requests without a known branch are not cached.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(self, request, *args, **kwargs):
+            branch_id = request_branch_id(request)
+            if branch_id is None:
+                return handler(self, request, *args, **kwargs)
+
+            key = versioned_key(namespace, branch_id, request.path, sorted(request.query_params.lists()))
+            data = cache.get(key, _MISSING)
+            if data is not _MISSING:
+                return Response(data)
+
+            with fill_reads(namespace, branch_id):
+                response = handler(self, request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.data, timeout)
+            return response
+
+        return wrapper
+    return decorator
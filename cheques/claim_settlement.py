@@ -0,0 +1,143 @@
+"""
+Bulk settlement of claim refunds from a supplier statement.
+
+Rows are (claim alias_id or id_number, refund_amount, refund_date[,
+submitted_date, remarks]). All claims are resolved and locked with one query,
+the ClaimUpdateSerializer rules are checked row by row in memory, and the
+valid rows are written with a single bulk_update. Invalid rows are reported
+and left untouched.
+
+id_numbers are only unique per branch: without a branch, an id_number that
+matches claims of several branches is reported as ambiguous rather than
+settling whichever came first.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .cache import branch_id_for_alias
+from .claim_summary import invalidate_claims_summary
+from .models import Claim
+from .serializers import ClaimRefundRowSerializer, ClaimUpdateSerializer
+
+UPDATED = 'updated'
+ERROR = 'error'
+
+SETTLED_FIELDS = [
+    'submitted_date', 'refund_amount', 'refund_date', 'remarks',
+    'remaining_amount', 'updated_at', 'updated_by', 'version',
+]
+
+
+def settle_claim_refunds(rows, branch_alias_id=None, user=None, dry_run=False):
+    report = [{'row': index, 'claim': row.get('claim') if isinstance(row, dict) else None,
+               'status': None, 'errors': []}
+              for index, row in enumerate(rows, start=1)]
+
+    parsed = []
+    for entry, row in zip(report, rows):
+        serializer = ClaimRefundRowSerializer(data=row)
+        if serializer.is_valid():
+            parsed.append((entry, serializer.validated_data))
+        else:
+            entry['status'] = ERROR
+            entry['errors'] = [f"{field}: {' '.join(str(m) for m in messages)}"
+                               for field, messages in serializer.errors.items()]
+
+    with transaction.atomic():
+        keys = {data['claim'] for _, data in parsed}
+        branch_id = branch_id_for_alias(branch_alias_id)
+        if branch_alias_id and branch_id is None:
+            keys = set()  # unknown branch: every row reports "Claim not found"
+        claims, ambiguous = resolve_claims(keys, branch_id)
+
+        to_update = {}
+        now = timezone.now()
+        for entry, data in parsed:
+            claim = claims.get(data['claim'])
+            if data['claim'] in ambiguous:
+                entry['status'] = ERROR
+                entry['errors'] = ['Id number matches claims in more than one branch; '
+                                   'give the branch or the claim alias_id.']
+                continue
+            if claim is None:
+                entry['status'] = ERROR
+                entry['errors'] = ['Claim not found.']
+                continue
+            if claim.pk in to_update:
+                entry['status'] = ERROR
+                entry['errors'] = ['Claim appears more than once in the statement.']
+                continue
+
+            submitted_date = data.get('submitted_date', claim.submitted_date)
+            errors = ClaimUpdateSerializer.refund_rule_errors(
+                submitted_date, data['refund_amount'], data['refund_date']
+            )
+            if data['refund_amount'] > claim.claim_amount:
+                errors.append("Refund amount cannot exceed the claim amount.")
+            if submitted_date and data['refund_date'] < submitted_date:
+                errors.append("Refund date cannot be earlier than the submitted date.")
+            if errors:
+                entry['status'] = ERROR
+                entry['errors'] = errors
+                continue
+
+            claim.submitted_date = submitted_date
+            claim.refund_amount = data['refund_amount']
+            claim.refund_date = data['refund_date']
+            if 'remarks' in data:
+                claim.remarks = data['remarks']
+            claim._sync_remaining_amount()
+            claim.updated_at = now
+            claim.updated_by = user
+            claim.version += 1
+            to_update[claim.pk] = claim
+
+            entry['status'] = UPDATED
+            entry['claim'] = claim.alias_id
+            entry['id_number'] = claim.payment_details.id_number
+            entry['remaining_amount'] = str(claim.remaining_amount.quantize(Decimal('0.0001')))
+
+        if to_update and not dry_run:
+            Claim.objects.bulk_update(to_update.values(), SETTLED_FIELDS)
+            invalidate_claims_summary(*{claim.branch_id for claim in to_update.values()})
+
+    return {
+        'dry_run': dry_run,
+        'updated': sum(1 for entry in report if entry['status'] == UPDATED),
+        'errors': sum(1 for entry in report if entry['status'] == ERROR),
+        'rows': report,
+    }
+
+
+def resolve_claims(keys, branch_id=None):
+    """
+    Map each key (alias_id or id_number) to its claim, in one locking query.
+    Returns the map and the id_numbers that matched more than one claim.
+    """
+    if not keys:
+        return {}, set()
+    queryset = Claim.objects.select_related('payment_details').select_for_update(of=('self',)).filter(
+        Q(alias_id__in=keys) | Q(payment_details__id_number__in=keys)
+    )
+    if branch_id is not None:
+        queryset = queryset.filter(branch_id=branch_id)
+
+    claims = {}
+    by_id_number = {}
+    for claim in queryset:
+        claims[claim.alias_id] = claim
+        if claim.payment_details.id_number in keys:
+            by_id_number.setdefault(claim.payment_details.id_number, []).append(claim)
+
+    ambiguous = set()
+    for id_number, matches in by_id_number.items():
+        if id_number in claims:
+            continue  # an alias_id wins over an id_number
+        if len(matches) > 1:
+            ambiguous.add(id_number)
+        else:
+            claims[id_number] = matches[0]
+    return claims, ambiguous
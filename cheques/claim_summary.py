@@ -0,0 +1,86 @@
+"""
+Outstanding-claims rollup per parent customer and instrument.
+
+Built from one grouped query over the claim table and cached per branch in
+the shared cache under the 'claims' namespace. The namespace is bumped
+whenever claims of that branch are written: Claim saves/deletes through
+signals, and the bulk paths (payment edits, refund settlement) call
+invalidate_claims_summary() themselves. Like every bump_namespace(), it
+waits for the transaction to commit.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Count, Min, Q, Sum
+
+from .cache import bump_namespace, fill_reads, get_or_set, versioned_key
+from .models import Claim
+
+
+def invalidate_claims_summary(*branch_ids):
+    bump_namespace('claims', *branch_ids)
+
+
+def get_claims_summary(branch_id):
+    def build():
+        with fill_reads('claims', branch_id):
+            return build_claims_summary(branch_id)
+
+    return get_or_set(
+        versioned_key('claims', branch_id, 'summary'),
+        build,
+        getattr(settings, 'CLAIMS_SUMMARY_CACHE_SECONDS', 3600),
+    )
+
+
+def build_claims_summary(branch_id):
+    rows = Claim.objects.filter(
+        branch_id=branch_id,
+        remaining_amount__gt=0,
+    ).values(
+        'customer__alias_id', 'customer__name',
+        'payment_details__payment_instrument_id', 'payment_details__payment_instrument__instrument_name',
+    ).annotate(
+        claim_count=Count('id'),
+        claim_amount=Sum('claim_amount'),
+        refund_amount=Sum('refund_amount'),
+        remaining_amount=Sum('remaining_amount'),
+        oldest_unsubmitted_date=Min('claim_date', filter=Q(submitted_date__isnull=True)),
+    ).order_by('customer__name', 'payment_details__payment_instrument__instrument_name')
+
+    amounts = ('claim_count', 'claim_amount', 'refund_amount', 'remaining_amount')
+    customers = {}
+    totals = dict.fromkeys(amounts, Decimal(0))
+    totals['claim_count'] = 0
+
+    for row in rows:
+        customer = customers.setdefault(row['customer__alias_id'], {
+            'alias_id': row['customer__alias_id'],
+            'name': row['customer__name'],
+            'claim_count': 0,
+            'claim_amount': Decimal(0),
+            'refund_amount': Decimal(0),
+            'remaining_amount': Decimal(0),
+            'oldest_unsubmitted_date': None,
+            'instruments': [],
+        })
+        instrument = {
+            'id': row['payment_details__payment_instrument_id'],
+            'instrument_name': row['payment_details__payment_instrument__instrument_name'],
+            'oldest_unsubmitted_date': row['oldest_unsubmitted_date'],
+        }
+        for field in amounts:
+            value = row[field] or 0
+            instrument[field] = value
+            customer[field] += value
+            totals[field] += value
+        customer['instruments'].append(instrument)
+
+        oldest = row['oldest_unsubmitted_date']
+        if oldest and (customer['oldest_unsubmitted_date'] is None or oldest < customer['oldest_unsubmitted_date']):
+            customer['oldest_unsubmitted_date'] = oldest
+
+    return {
+        'data': list(customers.values()),
+        'totals': totals,
+    }
@@ -0,0 +1,108 @@
+"""
+Primary/replica database routing.
+
+With a 'replica' database configured and REPLICA_READS on, views that opt in
+through ReplicaReadsMixin (cheques/views.py) - GET list/retrieve and the
+reports - run their reads on the replica. Everything else reads from the
+primary, and writes always go there.
+
+Replication lags a little, so reads stay on the primary where that would
+show:
+
+- a user's reads for REPLICA_STICKY_SECONDS after one of their writes, so
+  they see what they just saved
+- cache fills of a namespace bumped within that window (see fill_reads in
+  cheques/cache.py), so the shared cache is never filled from a replica that
+  hasn't caught up with the write that invalidated it
+
+Recent writes are remembered in the shared cache, so the window holds
+across workers.
+"""
+import contextvars
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+PRIMARY = DEFAULT_DB_ALIAS
+REPLICA = 'replica'
+
+# Alias reads of the current request go to; None is the primary
+_reads = contextvars.ContextVar('db_reads', default=None)
+
+
+def replica_enabled():
+    return getattr(settings, 'REPLICA_READS', False) and REPLICA in settings.DATABASES
+
+
+def sticky_seconds():
+    return getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+
+
+def current_reads():
+    return _reads.get() or PRIMARY
+
+
+@contextmanager
+def reads_from(alias):
+    token = _reads.set(alias)
+    try:
+        yield
+    finally:
+        _reads.reset(token)
+
+
+def read_from_replica():
+    """Send the rest of the current request's reads to the replica (when there is one)."""
+    if replica_enabled():
+        _reads.set(REPLICA)
+
+
+def _written_key(key):
+    return f'db-written:{key}'
+
+
+def note_writes(*keys):
+    if keys and replica_enabled():
+        cache.set_many({_written_key(key): 1 for key in keys}, sticky_seconds())
+
+
+def written_recently(*keys):
+    return bool(keys) and bool(cache.get_many([_written_key(key) for key in keys]))
+
+
+@contextmanager
+def fresh_reads(*keys):
+    """Read from the primary inside the block if any of `keys` was written within the sticky window."""
+    if _reads.get() == REPLICA and written_recently(*keys):
+        with reads_from(PRIMARY):
+            yield
+    else:
+        yield
+
+
+def user_key(user_id):
+    return f'user:{user_id}'
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # Related objects are read from wherever their instance came from
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return _reads.get()
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        if {obj1._state.db, obj2._state.db} <= {PRIMARY, REPLICA}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica follows the primary's schema through replication
+        return db != REPLICA
@@ -1,11 +1,47 @@
 import logging
+import re
 from rest_framework.views import exception_handler
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import APIException
 from django.db import IntegrityError  # Add this import
 
 logger = logging.getLogger(__name__)
 
+
+class VersionConflict(APIException):
+    # Raised when a versioned UPDATE matches no row: someone else saved first
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'This record has been modified by another user. Please refresh.'
+    default_code = 'version_conflict'
+
+
+# Unique violations with a friendly message, recognised in the error text.
+# On partitioned PostgreSQL tables the guard tables of cheques/partitions.py
+# raise them (<guard>_pkey, with the guard trigger function in the error
+# context); otherwise the constraint does (PostgreSQL names it, SQLite lists
+# the columns).
+DUPLICATE_MESSAGES = [
+    (
+        re.compile(r'payment_details_id_number|unique_id_number|payment_details\.branch_id, payment_details\.id_number'),
+        'Duplicate ID number detected',
+        'This ID number already exists in the branch. Please use a unique value.',
+    ),
+    (
+        re.compile(r'_alias_id(_pkey|_key|_guard|_[0-9a-f]{8}_uniq)\b|\.alias_id\b'),
+        'Duplicate alias_id detected',
+        'A record with this alias_id already exists. Please retry.',
+    ),
+]
+
+
+def duplicate_message(error):
+    for pattern, message, details in DUPLICATE_MESSAGES:
+        if pattern.search(error):
+            return message, details
+    return None
+
+
 def custom_exception_handler(exc, context):
     # Log exception
     logger.error(
@@ -17,13 +53,15 @@ def custom_exception_handler(exc, context):
      # Handle specific exception types
     if isinstance(exc, IntegrityError):
         # Extract meaningful message from IntegrityError
-        if 'unique_id_number' in str(exc):
+        duplicate = duplicate_message(str(exc))
+        if duplicate:
+            message, details = duplicate
             return Response(
                 {
                     'error': {
                         'code': 400,
-                        'message': 'Duplicate ID number detected',
-                        'details': 'This ID number already exists in the branch. Please use a unique value.'
+                        'message': message,
+                        'details': details
                     }
                 },
                 status=status.HTTP_400_BAD_REQUEST
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cheques.archive import DEFAULT_BATCH_SIZE, archive_cutoff, archive_settled
+from cheques.cache import branch_id_for_alias
+
+
+class Command(BaseCommand):
+    help = (
+        "Move settled payments older than ARCHIVE_AFTER_DAYS (or --older-than days), "
+        "with their details, closed claims and the invoices they paid, to the archive "
+        "tables. Open claims and unpaid invoices stay. Safe to run repeatedly; run it "
+        "nightly (cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.ARCHIVE_AFTER_DAYS, help='Age in days')
+        parser.add_argument('--branch', help='Only this branch alias_id')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Payments per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Count without moving anything')
+
+    def handle(self, *args, **options):
+        branch_id = None
+        if options['branch']:
+            branch_id = branch_id_for_alias(options['branch'])
+            if branch_id is None:
+                raise CommandError(f"Branch {options['branch']} does not exist.")
+
+        cutoff = archive_cutoff(options['older_than'])
+        totals = archive_settled(cutoff, branch_id, options['batch_size'], options['dry_run'])
+
+        for table, count in totals.items():
+            self.stdout.write(f'{table}: {count}')
+        summary = f'Settled history before {cutoff} archived.'
+        if options['dry_run']:
+            summary = f'Dry run, nothing moved (history before {cutoff}).'
+        self.stdout.write(self.style.SUCCESS(summary))
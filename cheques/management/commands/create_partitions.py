@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from cheques.partitions import DEFAULT_MONTHS_AHEAD, ensure_partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the monthly partitions of credit_invoice, payment and payment_details "
+        "for the coming months, and for any month whose rows landed in a default "
+        "partition. Safe to run repeatedly; run it daily (cron) and on deploy."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=DEFAULT_MONTHS_AHEAD)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if connection.vendor != 'postgresql':
+            self.stdout.write('Partitioning needs PostgreSQL; nothing to do.')
+            return
+        with transaction.atomic(using=options['database']):
+            created = ensure_partitions(connection, options['months_ahead'])
+        for name in created:
+            self.stdout.write(f'Created {name}')
+        self.stdout.write(self.style.SUCCESS(f'{len(created)} partition(s) created.'))
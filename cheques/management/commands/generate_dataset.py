@@ -0,0 +1,233 @@
+import json
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from cheques.cache import bump_namespace
+from cheques.claim_summary import invalidate_claims_summary
+from cheques.Instrument import PaymentInstrumentPolicy
+from cheques.models import (
+    Branch, Claim, CreditInvoice, Customer, Payment, PaymentDetails, PaymentInstrument, PaymentInstrumentType,
+)
+from src.inve_lib.inve_lib import generate_slugify_id
+
+CENT = Decimal('0.01')
+
+# (serial_no, type_name, prefix, auto_number, is_cash_equivalent); serial 3 is
+# the claim type PaymentViewSet.create opens claims for
+INSTRUMENT_TYPES = [
+    (1, 'Cheque', 'CQ', False, False),
+    (2, 'Cash', 'CH', True, True),
+    (3, 'Claim', 'CL', True, False),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a synthetic dataset for load tests: branches with parent/child "
+        "customers, daily credit invoices over several years, weekly payments "
+        "settling them (cash, cheques and claims, auto-numbered like the API does) "
+        "and claims, older ones refunded. Only runs with DEBUG on unless --force."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--branches', type=int, default=2)
+        parser.add_argument('--parents', type=int, default=20, help='Parent customers per branch')
+        parser.add_argument('--children', type=int, default=4, help='Child customers per parent')
+        parser.add_argument('--years', type=float, default=2, help='History length')
+        parser.add_argument('--invoices-per-day', type=int, default=30, help='Per branch')
+        parser.add_argument('--unpaid-days', type=int, default=60,
+                            help='Invoices of the last N days are left unpaid')
+        parser.add_argument('--claim-rate', type=float, default=0.3,
+                            help='Share of payments that include a claim')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed, for repeatable datasets')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--manifest', help='Write branch/customer/instrument ids for scripts/loadtest.py --suite')
+        parser.add_argument('--force', action='store_true', help='Run even with DEBUG off')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError("DEBUG is off; this adds a lot of fake data. Pass --force if that is intended.")
+
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.aliases = set()
+        today = timezone.localdate()
+        start = today - timedelta(days=int(options['years'] * 365))
+
+        manifest = {'branches': []}
+        branch_ids = []
+        for number in range(1, options['branches'] + 1):
+            with transaction.atomic():
+                branch, counts, entry = self.generate_branch(number, start, today, options)
+            branch_ids.append(branch.id)
+            manifest['branches'].append(entry)
+            self.stdout.write(f"{branch.name} ({branch.alias_id}): " + ', '.join(
+                f'{count} {name}' for name, count in counts.items()))
+
+        bump_namespace('customers', *branch_ids)
+        bump_namespace('dues', *branch_ids)
+        invalidate_claims_summary(*branch_ids)
+        PaymentInstrumentPolicy.invalidate()
+
+        if options['manifest']:
+            with open(options['manifest'], 'w') as f:
+                json.dump(manifest, f, indent=2)
+            self.stdout.write(f"Manifest written to {options['manifest']}")
+        self.stdout.write(self.style.SUCCESS('Done.'))
+
+    def alias(self):
+        # Default aliases are 40 random bits; at these volumes collisions are likely
+        while True:
+            alias_id = generate_slugify_id()
+            if alias_id not in self.aliases:
+                self.aliases.add(alias_id)
+                return alias_id
+
+    def amount(self, low, high):
+        return Decimal(self.random.uniform(low, high)).quantize(CENT)
+
+    def bulk_create(self, model, objects):
+        for obj in objects:
+            obj.alias_id = self.alias()
+        return model.objects.bulk_create(objects, batch_size=self.batch_size)
+
+    def generate_branch(self, number, start, today, options):
+        branch = Branch.objects.create(name=f'Load Test Branch {number}', branch_type=2)
+
+        types = {}
+        instruments = {}
+        for serial_no, type_name, prefix, auto_number, cash_equivalent in INSTRUMENT_TYPES:
+            types[serial_no] = PaymentInstrumentType.objects.create(
+                branch=branch, serial_no=serial_no, type_name=type_name, prefix=prefix,
+                auto_number=auto_number, is_cash_equivalent=cash_equivalent, last_number=0,
+            )
+            instruments[serial_no] = PaymentInstrument.objects.create(
+                branch=branch, serial_no=serial_no, instrument_type=types[serial_no], instrument_name=type_name,
+            )
+
+        parents = self.bulk_create(Customer, [
+            Customer(branch=branch, name=f'Parent {number}-{p:03d}', is_parent=True)
+            for p in range(options['parents'])
+        ])
+        children = self.bulk_create(Customer, [
+            Customer(branch=branch, name=f'Customer {number}-{p:03d}-{c:02d}', parent=parent,
+                     grace_days=self.random.choice([7, 14, 30]))
+            for p, parent in enumerate(parents) for c in range(options['children'])
+        ])
+        parent_of = {child.id: child.parent_id for child in children}
+
+        invoices = []
+        day = start
+        while day <= today:
+            for _ in range(options['invoices_per_day']):
+                customer = self.random.choice(children)
+                sales = self.amount(500, 50000)
+                returned = self.amount(0, float(sales) / 10) if self.random.random() < 0.1 else Decimal(0)
+                invoices.append(CreditInvoice(
+                    branch=branch, customer=customer, grn=f'GRN-{number}-{len(invoices) + 1:07d}',
+                    transaction_date=day, sales_amount=sales, sales_return=returned,
+                    payment_grace_days=customer.grace_days,
+                ))
+            day += timedelta(days=1)
+        invoices = self.bulk_create(CreditInvoice, invoices)
+
+        payments, settled = self.settle(branch, invoices, parent_of, today - timedelta(days=options['unpaid_days']))
+        details, claims = self.pay(branch, payments, types, instruments, today, options['claim_rate'])
+
+        paid_invoices = []
+        for payment, batch in zip(payments, settled):
+            for invoice in batch:
+                invoice.payment = payment
+                invoice.status = True
+                paid_invoices.append(invoice)
+        CreditInvoice.objects.bulk_update(paid_invoices, ['payment', 'status'], batch_size=self.batch_size)
+        for instrument_type in types.values():
+            instrument_type.save(update_fields=['last_number'])
+
+        counts = {
+            'customers': len(parents) + len(children), 'invoices': len(invoices),
+            'paid invoices': len(paid_invoices), 'payments': len(payments),
+            'payment details': len(details), 'claims': len(claims),
+        }
+        entry = {
+            'alias_id': branch.alias_id,
+            'parents': [parent.alias_id for parent in parents],
+            'instruments': {type_name.lower(): instruments[serial_no].id
+                            for serial_no, type_name, *_ in INSTRUMENT_TYPES},
+        }
+        return branch, counts, entry
+
+    def settle(self, branch, invoices, parent_of, last_payment_day):
+        """Each parent pays weekly for its children's invoices older than a week."""
+        pending = {}
+        for invoice in invoices:
+            pending.setdefault(parent_of[invoice.customer_id], []).append(invoice)
+
+        payments, settled = [], []
+        for parent_id, open_invoices in pending.items():
+            open_invoices.sort(key=lambda invoice: invoice.transaction_date)
+            day = open_invoices[0].transaction_date + timedelta(days=self.random.randint(7, 13))
+            while day <= last_payment_day and open_invoices:
+                due = [invoice for invoice in open_invoices if invoice.transaction_date <= day - timedelta(days=7)]
+                if due:
+                    open_invoices = open_invoices[len(due):]
+                    payments.append(Payment(
+                        branch=branch, customer_id=parent_id, received_date=day,
+                        total_amount=sum(invoice.sales_amount - invoice.sales_return for invoice in due),
+                    ))
+                    settled.append(due)
+                day += timedelta(days=7)
+        return self.bulk_create(Payment, payments), settled
+
+    def next_number(self, instrument_type):
+        instrument_type.last_number += 1
+        return f'{instrument_type.prefix}{instrument_type.last_number:04d}'
+
+    def pay(self, branch, payments, types, instruments, today, claim_rate):
+        details = []
+        cheque_number = self.random.randint(100000, 200000)
+        for payment in payments:
+            total = payment.total_amount
+            claim = (total * Decimal(self.random.uniform(0.01, 0.05))).quantize(CENT) \
+                if self.random.random() < claim_rate else Decimal(0)
+            cash = ((total - claim) * Decimal(self.random.uniform(0.3, 0.7))).quantize(CENT)
+            cheque = total - claim - cash
+
+            day = payment.received_date
+            details.append(PaymentDetails(branch=branch, payment=payment, payment_instrument=instruments[2],
+                                          id_number=self.next_number(types[2]), amount=cash, received_date=day))
+            cheque_number += 1
+            details.append(PaymentDetails(branch=branch, payment=payment, payment_instrument=instruments[1],
+                                          id_number=f'{cheque_number:08d}', amount=cheque,
+                                          detail=f'Cheque {cheque_number}', received_date=day))
+            if claim:
+                details.append(PaymentDetails(branch=branch, payment=payment, payment_instrument=instruments[3],
+                                              id_number=self.next_number(types[3]), amount=claim,
+                                              detail='Damaged goods', received_date=day))
+            payment.cash_equivalent_amount = cash
+            payment.claim_amount = claim
+        Payment.objects.bulk_update(payments, ['cash_equivalent_amount', 'claim_amount'], batch_size=self.batch_size)
+        details = self.bulk_create(PaymentDetails, details)
+
+        claims = []
+        payment_by_id = {payment.id: payment for payment in payments}
+        for detail in details:
+            if detail.payment_instrument_id != instruments[3].id:
+                continue
+            payment = payment_by_id[detail.payment_id]
+            claim = Claim(branch=branch, payment_details=detail, customer_id=payment.customer_id,
+                          claim_amount=detail.amount, claim_date=payment.received_date)
+            # Claims older than three months have been submitted and refunded
+            if (today - payment.received_date).days > 90:
+                claim.submitted_date = payment.received_date + timedelta(days=self.random.randint(3, 20))
+                claim.refund_date = claim.submitted_date + timedelta(days=self.random.randint(10, 60))
+                claim.refund_amount = detail.amount
+            claim._sync_remaining_amount()
+            claims.append(claim)
+        return details, self.bulk_create(Claim, claims)
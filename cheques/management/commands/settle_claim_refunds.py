@@ -0,0 +1,53 @@
+import csv
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from cheques.claim_settlement import settle_claim_refunds
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply a supplier refund statement. The CSV needs claim, refund_amount and "
+        "refund_date columns (claim is the claim alias_id or its id_number); "
+        "submitted_date and remarks are optional."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement', help='Path to the statement CSV')
+        parser.add_argument('--branch', help='Branch alias_id the claims belong to')
+        parser.add_argument('--user', help='Username recorded as updated_by')
+        parser.add_argument('--dry-run', action='store_true', help='Validate without saving')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f"User {options['user']} does not exist.")
+
+        try:
+            with open(options['statement'], newline='', encoding='utf-8-sig') as statement:
+                rows = [
+                    {key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()}
+                    for row in csv.DictReader(statement)
+                ]
+        except OSError as e:
+            raise CommandError(str(e))
+
+        report = settle_claim_refunds(rows, options['branch'], user, options['dry_run'])
+
+        for entry in report['rows']:
+            if entry['errors']:
+                self.stdout.write(self.style.ERROR(
+                    f"row {entry['row']} {entry['claim']}: {'; '.join(entry['errors'])}"
+                ))
+            else:
+                self.stdout.write(
+                    f"row {entry['row']} {entry['claim']}: {entry['status']}, remaining {entry['remaining_amount']}"
+                )
+
+        summary = f"{report['updated']} updated, {report['errors']} rejected"
+        if report['dry_run']:
+            summary += ' (dry run, nothing saved)'
+        self.stdout.write(self.style.SUCCESS(summary))
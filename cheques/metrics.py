@@ -0,0 +1,209 @@
+"""
+Per-request performance metrics.
+
+PerformanceMiddleware (cheques/middleware.py) opens a RequestMetrics for each
+request in a context variable. While it is open:
+
+- every SQL statement is counted and timed by a wrapper installed on each
+  new DB connection (connection_created, see signals.py), so queries run on
+  worker threads (run_in_worker_thread) are counted too
+- serializers and the renderer add their time through timed()
+
+At the end of the request the timings go into per-endpoint histograms held
+by each worker process. Every METRICS_FLUSH_SECONDS a worker copies its
+histograms to the shared cache, and /metrics sums the copies of all live
+workers into the Prometheus text format. Counters restart when a worker is
+recycled (max_requests); Prometheus treats that as a counter reset.
+"""
+import contextvars
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+HISTOGRAMS = {
+    # name: (help, buckets)
+    'request_duration_seconds': ('Total request time', DURATION_BUCKETS),
+    'db_duration_seconds': ('Time spent in SQL statements', DURATION_BUCKETS),
+    'serializer_duration_seconds': ('Time spent in serializer to_representation', DURATION_BUCKETS),
+    'render_duration_seconds': ('Time spent rendering the response body', DURATION_BUCKETS),
+    'db_queries': ('SQL statements per request', QUERY_BUCKETS),
+}
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.db_time = 0.0
+        self.timings = {}
+        self.nplusone = None  # QueryShapeTracker when N+1 detection is on
+        self._depth = {}
+
+    def add_query(self, sql, duration):
+        self.query_count += 1
+        self.db_time += duration
+        if self.nplusone is not None:
+            self.nplusone.add(sql)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def begin():
+    metrics = RequestMetrics()
+    return metrics, _current.set(metrics)
+
+
+def end(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def timed(name):
+    """Add the block's duration to the current request under `name`; nested blocks count once."""
+    metrics = _current.get()
+    if metrics is None or metrics._depth.get(name):
+        yield
+        return
+    metrics._depth[name] = 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics._depth[name] = 0
+        metrics.timings[name] = metrics.timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def record_query(execute, sql, params, many, context):
+    # Installed on every connection with execute_wrapper
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(sql, time.perf_counter() - start)
+
+
+def install_query_recorder(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class Registry:
+    """This process's histograms: {(metric, endpoint): [bucket counts..., sum, count]}."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._flushed_at = 0.0
+        self._pid = None
+        self._worker_key = None
+
+    @property
+    def worker_key(self):
+        # Built on first use, not at import: with preload_app the module is
+        # imported by the gunicorn master and every forked worker would
+        # otherwise flush under the master's pid
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._worker_key = f'metrics:worker:{socket.gethostname()}:{pid}'
+        return self._worker_key
+
+    def observe(self, endpoint, metrics):
+        values = {
+            'request_duration_seconds': metrics.elapsed(),
+            'db_duration_seconds': metrics.db_time,
+            'serializer_duration_seconds': metrics.timings.get('serializer', 0.0),
+            'render_duration_seconds': metrics.timings.get('render', 0.0),
+            'db_queries': metrics.query_count,
+        }
+        with self._lock:
+            for name, value in values.items():
+                buckets = HISTOGRAMS[name][1]
+                series = self._series.setdefault((name, endpoint), [0] * (len(buckets) + 2))
+                for i, bound in enumerate(buckets):
+                    if value <= bound:
+                        series[i] += 1
+                series[-2] += value
+                series[-1] += 1
+        self.maybe_flush()
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(series) for key, series in self._series.items()}
+
+    def maybe_flush(self, force=False):
+        interval = getattr(settings, 'METRICS_FLUSH_SECONDS', 10)
+        now = time.monotonic()
+        if not force and now - self._flushed_at < interval:
+            return
+        self._flushed_at = now
+        # Entries of workers that stopped flushing expire after a few intervals
+        worker_key = self.worker_key
+        cache.set(worker_key, self.snapshot(), interval * 6)
+        workers = cache.get('metrics:workers', set())
+        if worker_key not in workers:
+            cache.set('metrics:workers', workers | {worker_key}, None)
+
+
+registry = Registry()
+
+
+def collect():
+    """Histograms of all live workers, summed."""
+    registry.maybe_flush(force=True)
+    workers = cache.get('metrics:workers', set())
+    snapshots = cache.get_many(list(workers))
+    if len(snapshots) < len(workers):
+        cache.set('metrics:workers', set(snapshots), None)
+
+    totals = {}
+    for snapshot in snapshots.values():
+        for key, series in snapshot.items():
+            total = totals.setdefault(key, [0] * len(series))
+            for i, value in enumerate(series):
+                total[i] += value
+    return totals
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def prometheus_text(totals):
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        metric = f'chequestore_{name}'
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} histogram')
+        for (series_name, endpoint), series in sorted(totals.items()):
+            if series_name != name:
+                continue
+            label = f'endpoint="{_label(endpoint)}"'
+            for bound, count in zip(buckets, series):
+                lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {series[-1]}')
+            lines.append(f'{metric}_sum{{{label}}} {_number(series[-2])}')
+            lines.append(f'{metric}_count{{{label}}} {series[-1]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,232 @@
+"""
+Project middleware.
+
+PerformanceMiddleware records query count, DB, serializer, render and total
+time per request (see cheques/metrics.py), feeds the per-endpoint histograms
+behind /metrics and writes slow requests to logs/slow_requests.log. With
+METRICS_SERVER_TIMING on it also sends them as a Server-Timing header, and
+with NPLUSONE_DETECTION on it reports repeated query shapes (see
+cheques/nplusone.py).
+
+CompressionMiddleware replaces django.middleware.gzip.GZipMiddleware: it
+compresses with brotli when the client accepts it (and the optional
+`brotli` package is installed), otherwise gzip, and only for responses of
+an allowed content type that are at least COMPRESSION_MIN_SIZE bytes long.
+Streaming responses (exports) of an allowed type are compressed chunk by
+chunk. Both encodings keep Django's BREACH mitigation of random padding:
+gzip a random filename, brotli a random metadata block (brotli_padding).
+"""
+import logging
+import random
+import secrets
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence, compress_string
+
+from . import metrics, nplusone
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+slow_request_logger = logging.getLogger('cheques.slow_requests')
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_CONTENT_TYPES = [
+    'application/json',
+    'text/csv',
+    'text/plain',
+    'text/html',
+    'application/javascript',
+    'text/css',
+]
+
+
+def accepted_encodings(header):
+    """Encodings named in an Accept-Encoding header, minus those with q=0."""
+    accepted = set()
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def brotli_padding(max_random_bytes):
+    """
+    A metadata meta-block of 1 to max_random_bytes (at most 256) random
+    bytes, which decoders skip (RFC 7932, section 9.2): the brotli
+    counterpart of the random filename GZipMiddleware writes into gzip
+    headers. Valid wherever the stream is byte aligned, i.e. after a flush.
+    """
+    length = secrets.randbelow(min(max_random_bytes, 256)) + 1
+    # ISLAST=0, MNIBBLES=3 (metadata), reserved bit, MSKIPBYTES=1, MSKIPLEN-1, zero fill
+    header = 0b11 << 1 | 1 << 4 | (length - 1) << 6
+    return header.to_bytes(2, 'little') + secrets.token_bytes(length)
+
+
+def brotli_sequence(sequence, quality, max_random_bytes=0):
+    compressor = brotli.Compressor(quality=quality)
+    for chunk in sequence:
+        # Flush per chunk so each export row reaches the client as it's produced
+        data = compressor.process(chunk) + compressor.flush()
+        if data:
+            yield data
+    if max_random_bytes:
+        # Flushing an unused compressor still writes the stream header
+        yield compressor.flush() + brotli_padding(max_random_bytes)
+    yield compressor.finish()
+
+
+class CompressionMiddleware(GZipMiddleware):
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.min_size = getattr(settings, 'COMPRESSION_MIN_SIZE', DEFAULT_MIN_SIZE)
+        self.content_types = tuple(getattr(settings, 'COMPRESSION_CONTENT_TYPES', DEFAULT_CONTENT_TYPES))
+        self.brotli_quality = getattr(settings, 'COMPRESSION_BROTLI_QUALITY', 5)
+
+    def choose_encoding(self, request):
+        accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+    def is_compressible(self, response):
+        if response.has_header('Content-Encoding'):
+            return False
+        content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type not in self.content_types:
+            return False
+        return response.streaming or len(response.content) >= self.min_size
+
+    def process_response(self, request, response):
+        if not self.is_compressible(response):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = self.choose_encoding(request)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                # Async iterators: compress each chunk on its own, as GZipMiddleware does
+                original_iterator = response.streaming_content
+
+                async def compressed_chunks():
+                    async for chunk in original_iterator:
+                        yield self.compress(chunk, encoding)
+
+                response.streaming_content = compressed_chunks()
+            elif encoding == 'br':
+                response.streaming_content = brotli_sequence(
+                    response.streaming_content, self.brotli_quality, self.max_random_bytes
+                )
+            else:
+                response.streaming_content = compress_sequence(
+                    response.streaming_content, max_random_bytes=self.max_random_bytes
+                )
+            del response.headers['Content-Length']
+        else:
+            compressed = self.compress(response.content, encoding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def compress(self, content, encoding):
+        if encoding == 'br':
+            return b''.join(brotli_sequence([content], self.brotli_quality, self.max_random_bytes))
+        return compress_string(content, max_random_bytes=self.max_random_bytes)
+
+
+def endpoint_name(request):
+    """ViewClass.action for DRF views (ViewClass.method otherwise), used as the metrics label."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    view = match.func
+    view_class = getattr(view, 'cls', None) or getattr(view, 'view_class', None)
+    name = view_class.__name__ if view_class else (match.view_name or getattr(view, '__name__', 'view'))
+    method = request.method.lower()
+    action = (getattr(view, 'actions', None) or {}).get(method, method)
+    return f'{name}.{action}'
+
+
+class PerformanceMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request_metrics, token = metrics.begin()
+        request_metrics.nplusone = nplusone.start_tracking()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.end(token)
+        return self.finish(request, response, request_metrics)
+
+    async def __acall__(self, request):
+        request_metrics, token = metrics.begin()
+        request_metrics.nplusone = nplusone.start_tracking()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.end(token)
+        return self.finish(request, response, request_metrics)
+
+    def finish(self, request, response, request_metrics):
+        endpoint = endpoint_name(request)
+        total = request_metrics.elapsed()
+        metrics.registry.observe(endpoint, request_metrics)
+
+        if getattr(settings, 'METRICS_SERVER_TIMING', False):
+            timings = request_metrics.timings
+            response['Server-Timing'] = ', '.join([
+                f'db;dur={request_metrics.db_time * 1000:.1f};desc="{request_metrics.query_count} queries"',
+                f'ser;dur={timings.get("serializer", 0.0) * 1000:.1f}',
+                f'render;dur={timings.get("render", 0.0) * 1000:.1f}',
+                f'total;dur={total * 1000:.1f}',
+            ])
+
+        slow_ms = getattr(settings, 'SLOW_REQUEST_MS', 1000)
+        if total * 1000 >= slow_ms and random.random() < getattr(settings, 'SLOW_REQUEST_SAMPLE_RATE', 1.0):
+            self.log_slow_request(request, response, endpoint, request_metrics, total)
+        nplusone.report(endpoint, request_metrics.nplusone)
+        return response
+
+    def log_slow_request(self, request, response, endpoint, request_metrics, total):
+        slow_request_logger.warning(
+            '%s %s %s [%s] total=%.1fms db=%.1fms/%d queries ser=%.1fms render=%.1fms',
+            request.method, request.get_full_path(), response.status_code, endpoint,
+            total * 1000, request_metrics.db_time * 1000, request_metrics.query_count,
+            request_metrics.timings.get('serializer', 0.0) * 1000,
+            request_metrics.timings.get('render', 0.0) * 1000,
+        )
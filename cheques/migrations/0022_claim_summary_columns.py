@@ -0,0 +1,69 @@
+# Generated by Django 4.2.20 on 2026-10-19 16:00
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, ExpressionWrapper, DecimalField
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    def backfill_claim_summary(apps, schema_editor):
+        Claim = apps.get_model('cheques', 'Claim')
+        PaymentDetails = apps.get_model('cheques', 'PaymentDetails')
+
+        # One UPDATE for all existing claims (same as ClaimQuerySet.sync_summary)
+        detail = PaymentDetails.objects.filter(pk=OuterRef('payment_details_id'))
+        amount = Subquery(detail.values('amount')[:1])
+        Claim.objects.update(
+            customer_id=Subquery(detail.values('payment__customer_id')[:1]),
+            claim_date=Subquery(detail.values('payment__received_date')[:1]),
+            claim_amount=amount,
+            remaining_amount=ExpressionWrapper(
+                amount - Coalesce(F('refund_amount'), 0),
+                output_field=DecimalField(max_digits=18, decimal_places=4)
+            ),
+        )
+
+    dependencies = [
+        ('cheques', '0021_claim_remarks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='claim',
+            name='claim_amount',
+            field=models.DecimalField(decimal_places=4, default=0.0, max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='claim',
+            name='claim_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='claim',
+            name='customer',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='cheques.customer'),
+        ),
+        migrations.AddField(
+            model_name='claim',
+            name='remaining_amount',
+            field=models.DecimalField(decimal_places=4, default=0.0, max_digits=18),
+        ),
+        migrations.RunPython(backfill_claim_summary, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='claim',
+            index=models.Index(fields=['claim_date'], name='claim_claim_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claim',
+            index=models.Index(fields=['claim_amount'], name='claim_claim_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claim',
+            index=models.Index(fields=['remaining_amount'], name='claim_remaining_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claim',
+            index=models.Index(fields=['refund_amount'], name='claim_refund_amount_idx'),
+        ),
+    ]
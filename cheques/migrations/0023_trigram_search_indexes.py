@@ -0,0 +1,40 @@
+from django.db import migrations
+
+
+# Expression indexes match the SQL Django emits for __icontains on PostgreSQL,
+# UPPER("table"."column"::text) LIKE UPPER('%term%'), so existing icontains
+# filters and the trigram search backend (cheques/search.py) can use them.
+TRIGRAM_INDEXES = [
+    ('customer_name_trgm_idx', 'customer', 'name'),
+    ('customer_alias_id_trgm_idx', 'customer', 'alias_id'),
+    ('payment_instrument_name_trgm_idx', 'payment_instrument', 'instrument_name'),
+    ('payment_details_detail_trgm_idx', 'payment_details', 'detail'),
+    ('payment_details_id_number_trgm_idx', 'payment_details', 'id_number'),
+]
+
+
+class Migration(migrations.Migration):
+    def create_trigram_indexes(apps, schema_editor):
+        # pg_trgm is PostgreSQL only; other backends keep plain LIKE scans
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for name, table, column in TRIGRAM_INDEXES:
+            schema_editor.execute(
+                f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" '
+                f'USING gin ((UPPER("{column}"::text)) gin_trgm_ops)'
+            )
+
+    def drop_trigram_indexes(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for name, table, column in TRIGRAM_INDEXES:
+            schema_editor.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+    dependencies = [
+        ('cheques', '0022_claim_summary_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
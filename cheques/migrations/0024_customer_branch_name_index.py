@@ -0,0 +1,17 @@
+# Generated by Django 4.2.20 on 2026-10-19 16:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cheques', '0023_trigram_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['branch', 'name'], name='customer_branch_name_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.20 on 2026-10-19 18:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_received_dates(apps, schema_editor):
+    Payment = apps.get_model('cheques', 'Payment')
+    PaymentDetails = apps.get_model('cheques', 'PaymentDetails')
+    PaymentDetails.objects.update(received_date=models.Subquery(
+        Payment.objects.filter(pk=models.OuterRef('payment_id')).values('received_date')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cheques', '0024_customer_branch_name_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='claim',
+            name='payment_details',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='payment_detail', to='cheques.paymentdetails'),
+        ),
+        migrations.AlterField(
+            model_name='creditinvoice',
+            name='payment',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='invoice_set', to='cheques.payment'),
+        ),
+        migrations.AlterField(
+            model_name='paymentdetails',
+            name='payment',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, to='cheques.payment'),
+        ),
+        migrations.AddField(
+            model_name='paymentdetails',
+            name='received_date',
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.RunPython(copy_received_dates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='paymentdetails',
+            name='received_date',
+            field=models.DateField(editable=False),
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+from cheques import partitions
+
+
+# Monthly range partitions for credit_invoice, payment and payment_details;
+# see cheques/partitions.py for what changes in the schema. Rewrites the
+# three tables, so expect it to take a while on a large database.
+class Migration(migrations.Migration):
+    def partition(apps, schema_editor):
+        # Declarative partitioning is PostgreSQL only
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        partitions.partition_tables(schema_editor.connection)
+
+    def unpartition(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        partitions.unpartition_tables(schema_editor.connection)
+
+    dependencies = [
+        ('cheques', '0025_paymentdetails_received_date'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
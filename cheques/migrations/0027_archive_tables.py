@@ -0,0 +1,122 @@
+# Generated by Django 4.2.20 on 2026-10-19 16:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cheques', '0026_partition_by_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPayment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('alias_id', models.TextField(editable=False, max_length=10, unique=True)),
+                ('received_date', models.DateField()),
+                ('claim_amount', models.DecimalField(decimal_places=4, default=0.0, max_digits=18)),
+                ('cash_equivalent_amount', models.DecimalField(decimal_places=4, default=0.0, max_digits=18)),
+                ('total_amount', models.DecimalField(decimal_places=4, default=0.0, max_digits=18)),
+                ('shortage_amount', models.DecimalField(decimal_places=4, default=0.0, max_digits=18)),
+                ('updated_at', models.DateTimeField()),
+                ('version', models.IntegerField(default=1)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('branch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cheques.branch')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='archived_payments', to='cheques.customer')),
+                ('updated_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Archived Payment',
+                'verbose_name_plural': 'Archived Payments',
+                'db_table': 'archive_payment',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedPaymentDetails',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('alias_id', models.TextField(editable=False, max_length=10, unique=True)),
+                ('id_number', models.CharField(max_length=10, null=True)),
+                ('detail', models.TextField(blank=True, default='', null=True)),
+                ('amount', models.DecimalField(decimal_places=4, default=0.0, max_digits=18)),
+                ('received_date', models.DateField()),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('branch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cheques.branch')),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='details', to='cheques.archivedpayment')),
+                ('payment_instrument', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cheques.paymentinstrument')),
+            ],
+            options={
+                'verbose_name': 'Archived Payment Details',
+                'verbose_name_plural': 'Archived Payments Details',
+                'db_table': 'archive_payment_details',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedCreditInvoice',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('alias_id', models.TextField(editable=False, max_length=10, unique=True)),
+                ('grn', models.TextField(blank=True, null=True)),
+                ('transaction_date', models.DateField()),
+                ('delivery_man', models.TextField(blank=True, null=True)),
+                ('transaction_details', models.TextField(blank=True, null=True)),
+                ('sales_amount', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('sales_return', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('payment_grace_days', models.IntegerField(default=0)),
+                ('invoice_image', models.ImageField(null=True, upload_to='invoices/')),
+                ('status', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField()),
+                ('version', models.IntegerField(default=1)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('branch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cheques.branch')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='archived_invoices', to='cheques.customer')),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='invoices', to='cheques.archivedpayment')),
+                ('updated_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Archived Credit Invoice',
+                'verbose_name_plural': 'Archived Credit Invoices',
+                'db_table': 'archive_credit_invoice',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedClaim',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('alias_id', models.TextField(editable=False, max_length=10, unique=True)),
+                ('submitted_date', models.DateField(null=True)),
+                ('refund_amount', models.DecimalField(decimal_places=4, default=0.0, max_digits=18)),
+                ('refund_date', models.DateField(null=True)),
+                ('remarks', models.TextField(blank=True, null=True)),
+                ('claim_amount', models.DecimalField(decimal_places=4, default=0.0, max_digits=18)),
+                ('claim_date', models.DateField(null=True)),
+                ('remaining_amount', models.DecimalField(decimal_places=4, default=0.0, max_digits=18)),
+                ('updated_at', models.DateTimeField()),
+                ('version', models.IntegerField(default=1)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('branch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cheques.branch')),
+                ('customer', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='cheques.customer')),
+                ('payment_details', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='claim', to='cheques.archivedpaymentdetails')),
+                ('updated_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Archived Claim',
+                'verbose_name_plural': 'Archived Claims',
+                'db_table': 'archive_claim',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedpayment',
+            index=models.Index(fields=['customer', 'received_date'], name='archive_payment_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedcreditinvoice',
+            index=models.Index(fields=['customer', 'transaction_date'], name='archive_invoice_customer_idx'),
+        ),
+    ]
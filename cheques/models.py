@@ -1,15 +1,52 @@
-from django.db import models
+from django.db import models, router
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save
+from django.db.models.functions import Coalesce
+from decimal import Decimal
 from rest_framework.exceptions import ValidationError
+from cheques.exception_handler import VersionConflict
 from src.inve_lib.inve_lib import generate_slugify_id, generate_alias_id
 from django.contrib.auth.models import User
 from django.utils import timezone
 from PIL import Image
 
+class VersionedModelMixin:
+    """
+    Optimistic concurrency for models with a `version` column.
+
+    save_versioned() writes the row with a single
+    UPDATE ... SET ..., version = version + 1 WHERE id = ? AND version = ?
+    and raises VersionConflict (409) when no row matched. Sends pre_save and
+    post_save like save() so signal receivers still see the write.
+    """
+
+    def save_versioned(self, expected_version, update_fields=None):
+        expected_version = int(expected_version)
+        using = router.db_for_write(type(self), instance=self)
+        pre_save.send(sender=type(self), instance=self, raw=False, using=using, update_fields=update_fields)
+
+        values = {}
+        for field in self._meta.concrete_fields:
+            if field.primary_key or field.name == 'version':
+                continue
+            if update_fields is not None and field.name not in update_fields and not getattr(field, 'auto_now', False):
+                continue
+            values[field.attname] = field.pre_save(self, False)
+
+        rows = type(self)._base_manager.using(using).filter(pk=self.pk, version=expected_version).update(
+            version=F('version') + 1, **values
+        )
+        if not rows:
+            raise VersionConflict()
+        self.version = expected_version + 1
+        post_save.send(sender=type(self), instance=self, created=False, raw=False, using=using, update_fields=update_fields)
+
+
 class BranchType(models.IntegerChoices):
     HEAD_OFFICE = 1, 'Head Office'
     BRANCH = 2, 'Branch'
 
-class Branch(models.Model):
+class Branch(VersionedModelMixin, models.Model):
     alias_id = models.SlugField(
         max_length=10,
         unique=True,
@@ -69,6 +106,9 @@ class Customer(models.Model):
         db_table = 'customer'
         verbose_name = 'Customer'
         verbose_name_plural = 'Customers'
+        indexes = [
+            models.Index(fields=['branch', 'name'], name='customer_branch_name_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -131,7 +171,7 @@ class PaymentInstrumentType(models.Model):
 # ]}
 
 
-class PaymentInstrument(models.Model):
+class PaymentInstrument(VersionedModelMixin, models.Model):
     branch = models.ForeignKey(Branch, on_delete=models.PROTECT, blank=False, null=False)
     serial_no = models.IntegerField( unique=False, null=False)
     instrument_type = models.ForeignKey(PaymentInstrumentType,on_delete=models.PROTECT,blank=False, null=False, related_name="payment_type") #name should be branch wise unique
@@ -149,7 +189,7 @@ class PaymentInstrument(models.Model):
     def __str__(self):
         return str(self.instrument_name)
 
-class Payment(models.Model):
+class Payment(VersionedModelMixin, models.Model):
     branch = models.ForeignKey(Branch, on_delete=models.CASCADE, blank=False, null=False)
     alias_id = models.TextField(default=generate_slugify_id, max_length=10, unique=True, editable=False)
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT, blank=False, null=False)
@@ -174,10 +214,17 @@ class PaymentDetails(models.Model):
     branch = models.ForeignKey(Branch, on_delete=models.CASCADE, blank=False, null=False)
     alias_id = models.TextField(default=generate_slugify_id, max_length=10, unique=True, editable=False)
     id_number = models.CharField(max_length=10, blank=False, null=True)  # branch wise Unique identifier for the payment detail
-    payment = models.ForeignKey(Payment, on_delete=models.PROTECT, blank=False, null=False)   
+    # payment, credit_invoice and payment_details are partitioned by date
+    # (cheques/partitions.py); the database can't enforce foreign keys into
+    # them, so Django applies on_delete alone. Only ORM deletes honour it:
+    # raw SQL can leave details pointing at a missing payment
+    payment = models.ForeignKey(Payment, on_delete=models.PROTECT, blank=False, null=False, db_constraint=False)
     payment_instrument = models.ForeignKey(PaymentInstrument, on_delete=models.CASCADE , blank=False, null=False) 
     detail= models.TextField(blank=True,null=True, default='')
     amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
+    # Copy of payment.received_date, the partition key; set on save, and by
+    # PaymentViewSet when it bulk creates or moves details
+    received_date = models.DateField(editable=False)
     # is_allocated = models.BooleanField(default=False)
 
     class Meta:
@@ -194,7 +241,12 @@ class PaymentDetails(models.Model):
     def __str__(self):
         return f"{self.payment_instrument} - {self.detail}"
 
-class CreditInvoice(models.Model):
+    def save(self, *args, **kwargs):
+        if self.received_date is None:
+            self.received_date = self.payment.received_date
+        super().save(*args, **kwargs)
+
+class CreditInvoice(VersionedModelMixin, models.Model):
     alias_id = models.TextField(default=generate_slugify_id, max_length=10, unique=True, editable=False)
     branch = models.ForeignKey(Branch, on_delete=models.CASCADE, blank=False, null=False)
     grn = models.TextField(blank=True, null=True)
@@ -207,7 +259,8 @@ class CreditInvoice(models.Model):
     payment_grace_days = models.IntegerField(default=0)
     invoice_image = models.ImageField(upload_to='invoices/', null=True)
     status = models.BooleanField(default=False) # this field id for future use
-    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, blank=False, null=True,  related_name='invoice_set') #this is indicate that this invoice is paid.
+    # Not enforced by the database, see PaymentDetails.payment
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, blank=False, null=True,  related_name='invoice_set', db_constraint=False) #this is indicate that this invoice is paid.
     updated_at = models.DateTimeField(auto_now=True)
     updated_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     version = models.IntegerField(default=1)
@@ -222,35 +275,190 @@ class CreditInvoice(models.Model):
         return f"{self.customer.name} - {self.sales_amount} -{self.grn}"
 
 
-class Claim(models.Model):
+class ClaimQuerySet(models.QuerySet):
+    def sync_summary(self):
+        """
+        Refresh the denormalized customer/claim_amount/claim_date/remaining_amount
+        columns from the claim's payment detail and payment, in one UPDATE.
+        """
+        detail = PaymentDetails.objects.filter(pk=models.OuterRef('payment_details_id'))
+        amount = models.Subquery(detail.values('amount')[:1])
+        return self.update(
+            customer_id=models.Subquery(detail.values('payment__customer_id')[:1]),
+            claim_date=models.Subquery(detail.values('payment__received_date')[:1]),
+            claim_amount=amount,
+            remaining_amount=models.ExpressionWrapper(
+                amount - Coalesce(F('refund_amount'), 0),
+                output_field=models.DecimalField(max_digits=18, decimal_places=4)
+            ),
+        )
+
+
+class Claim(VersionedModelMixin, models.Model):
     branch = models.ForeignKey(Branch, on_delete=models.CASCADE, blank=False, null=False)
     alias_id = models.TextField(default=generate_slugify_id, max_length=10, unique=True, editable=False)
-    payment_details = models.OneToOneField(PaymentDetails, on_delete=models.CASCADE, blank=False, null=False, related_name='payment_detail')
+    # Not enforced by the database, see PaymentDetails.payment
+    payment_details = models.OneToOneField(PaymentDetails, on_delete=models.CASCADE, blank=False, null=False, related_name='payment_detail', db_constraint=False)
     submitted_date = models.DateField(blank=False, null=True)
     refund_amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
     refund_date = models.DateField(blank=False, null=True)
     remarks = models.TextField(blank= True, null=True)
+    # Denormalized from payment_details / payment so the claims screen
+    # filters and sorts on this table alone (kept in sync on write)
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT, null=True, blank=True)
+    claim_amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
+    claim_date = models.DateField(null=True, blank=True)
+    remaining_amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
     updated_at = models.DateTimeField(auto_now=True)
     updated_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     version = models.IntegerField(default=1)
 
+    objects = ClaimQuerySet.as_manager()
+
     class Meta:
         db_table = 'claim'
         verbose_name = 'Claim'
         verbose_name_plural = 'Claims'
+        indexes = [
+            models.Index(fields=['claim_date'], name='claim_claim_date_idx'),
+            models.Index(fields=['claim_amount'], name='claim_claim_amount_idx'),
+            models.Index(fields=['remaining_amount'], name='claim_remaining_amount_idx'),
+            models.Index(fields=['refund_amount'], name='claim_refund_amount_idx'),
+        ]
 
     def __str__(self):
         return f"Claim {self.alias_id} - {self.refund_amount} refunded"
 
+    def _sync_remaining_amount(self):
+        self.remaining_amount = Decimal(self.claim_amount or 0) - Decimal(self.refund_amount or 0)
+
+    def save(self, *args, **kwargs):
+        self._sync_remaining_amount()
+        super().save(*args, **kwargs)
+
+    def save_versioned(self, expected_version, update_fields=None):
+        self._sync_remaining_amount()
+        super().save_versioned(expected_version, update_fields)
+
     @property
     def is_fully_refunded(self):
         # The claim is fully refunded if the refund amount equals the claim amount
-        return self.refund_amount == self.payment_details.amount
+        return self.refund_amount == self.claim_amount
 
     def clean(self):
-        if self.is_fully_refunded and self.refund_amount != self.payment_details.amount:
+        if self.is_fully_refunded and self.refund_amount != self.claim_amount:
             raise ValidationError("Refund amount must be equal to the claim amount if fully refunded.")
-        if not self.is_fully_refunded and self.refund_amount > self.payment_details.amount:
+        if not self.is_fully_refunded and self.refund_amount > self.claim_amount:
             raise ValidationError("Refund amount cannot exceed the claim amount unless fully refunded.")
         if self.refund_date < self.submitted_date:
             raise ValidationError("Refund date cannot be earlier than the submitted date.")
+
+# Archive: settled history moved out of the hot tables above by
+# `manage.py archive_history` (cheques/archive.py). Rows keep their ids and
+# alias_ids and are read-only from then on.
+
+class ArchivedPayment(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name='+')
+    alias_id = models.TextField(max_length=10, unique=True, editable=False)
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='archived_payments')
+    received_date = models.DateField()
+    claim_amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
+    cash_equivalent_amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
+    total_amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
+    shortage_amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
+    updated_at = models.DateTimeField()
+    updated_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='+')
+    version = models.IntegerField(default=1)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'archive_payment'
+        verbose_name = 'Archived Payment'
+        verbose_name_plural = 'Archived Payments'
+        indexes = [
+            models.Index(fields=['customer', 'received_date'], name='archive_payment_customer_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.received_date} - {self.customer_id} (archived)"
+
+
+class ArchivedPaymentDetails(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name='+')
+    alias_id = models.TextField(max_length=10, unique=True, editable=False)
+    id_number = models.CharField(max_length=10, null=True)
+    payment = models.ForeignKey(ArchivedPayment, on_delete=models.CASCADE, related_name='details')
+    payment_instrument = models.ForeignKey(PaymentInstrument, on_delete=models.CASCADE, related_name='+')
+    detail = models.TextField(blank=True, null=True, default='')
+    amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
+    received_date = models.DateField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'archive_payment_details'
+        verbose_name = 'Archived Payment Details'
+        verbose_name_plural = 'Archived Payments Details'
+
+    def __str__(self):
+        return f"{self.payment_instrument_id} - {self.detail} (archived)"
+
+
+class ArchivedCreditInvoice(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    alias_id = models.TextField(max_length=10, unique=True, editable=False)
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name='+')
+    grn = models.TextField(blank=True, null=True)
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='archived_invoices')
+    transaction_date = models.DateField()
+    delivery_man = models.TextField(blank=True, null=True)
+    transaction_details = models.TextField(blank=True, null=True)
+    sales_amount = models.DecimalField(max_digits=18, decimal_places=4)
+    sales_return = models.DecimalField(max_digits=18, decimal_places=4)
+    payment_grace_days = models.IntegerField(default=0)
+    invoice_image = models.ImageField(upload_to='invoices/', null=True)
+    status = models.BooleanField(default=False)
+    payment = models.ForeignKey(ArchivedPayment, on_delete=models.CASCADE, related_name='invoices')
+    updated_at = models.DateTimeField()
+    updated_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='+')
+    version = models.IntegerField(default=1)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'archive_credit_invoice'
+        verbose_name = 'Archived Credit Invoice'
+        verbose_name_plural = 'Archived Credit Invoices'
+        indexes = [
+            models.Index(fields=['customer', 'transaction_date'], name='archive_invoice_customer_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.customer_id} - {self.sales_amount} - {self.grn} (archived)"
+
+
+class ArchivedClaim(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name='+')
+    alias_id = models.TextField(max_length=10, unique=True, editable=False)
+    payment_details = models.OneToOneField(ArchivedPaymentDetails, on_delete=models.CASCADE, related_name='claim')
+    submitted_date = models.DateField(null=True)
+    refund_amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
+    refund_date = models.DateField(null=True)
+    remarks = models.TextField(blank=True, null=True)
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT, null=True, related_name='+')
+    claim_amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
+    claim_date = models.DateField(null=True)
+    remaining_amount = models.DecimalField(max_digits=18, decimal_places=4, default=0.0)
+    updated_at = models.DateTimeField()
+    updated_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='+')
+    version = models.IntegerField(default=1)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'archive_claim'
+        verbose_name = 'Archived Claim'
+        verbose_name_plural = 'Archived Claims'
+
+    def __str__(self):
+        return f"Claim {self.alias_id} - {self.refund_amount} refunded (archived)"
@@ -0,0 +1,111 @@
+"""
+N+1 query detection.
+
+When NPLUSONE_DETECTION is 'log' or 'raise', each request (see
+PerformanceMiddleware) counts its SELECT statements by shape - the SQL with
+literals and IN lists collapsed. A shape that repeats NPLUSONE_THRESHOLD
+times is reported with where it came from: the serializer field(s) being
+rendered when it ran, and the innermost project frame. In 'log' mode the
+report goes to the cheques.nplusone logger, in 'raise' mode (the default
+under `manage.py test`) the request fails with NPlusOneError. Outside tests
+it is off unless NPLUSONE_DETECTION is set.
+
+Only requests are checked; code run outside a request is not tracked.
+"""
+import logging
+import os
+import re
+import sys
+from collections import Counter
+
+from django.conf import settings
+from rest_framework.serializers import BaseSerializer
+
+logger = logging.getLogger('cheques.nplusone')
+
+LOG = 'log'
+RAISE = 'raise'
+
+_IN_LIST = re.compile(r'\bIN\s*\((?:\s*%s\s*,?)+\)', re.IGNORECASE)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_OWN_FILES = {os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in ('metrics.py', 'middleware.py', 'nplusone.py')}
+
+
+class NPlusOneError(AssertionError):
+    pass
+
+
+def detection_mode():
+    mode = getattr(settings, 'NPLUSONE_DETECTION', '')
+    return mode if mode in (LOG, RAISE) else None
+
+
+def query_shape(sql):
+    sql = _IN_LIST.sub('IN (...)', sql)
+    sql = _STRING.sub('?', sql)
+    return _NUMBER.sub('?', sql)
+
+
+def query_source():
+    """'Serializer.field > Nested.field (path:line in function)' for the running query."""
+    project_dir = str(settings.BASE_DIR)
+    fields = []
+    location = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name == 'to_representation':
+            serializer, field = frame.f_locals.get('self'), frame.f_locals.get('field')
+            if isinstance(serializer, BaseSerializer) and field is not None:
+                fields.append(f'{type(serializer).__name__}.{field.field_name}')
+        filename = os.path.abspath(code.co_filename)
+        if (location is None and code.co_name != 'to_representation' and filename.startswith(project_dir)
+                and filename not in _OWN_FILES and 'site-packages' not in filename):
+            location = f'{os.path.relpath(filename, project_dir)}:{frame.f_lineno} in {code.co_name}'
+        frame = frame.f_back
+
+    source = ' > '.join(reversed(fields))
+    if location:
+        source = f'{source} ({location})' if source else location
+    return source or 'unknown'
+
+
+class QueryShapeTracker:
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.counts = Counter()
+        self.sources = {}
+
+    def add(self, sql):
+        if sql.lstrip()[:6].upper() != 'SELECT':
+            return
+        shape = query_shape(sql)
+        self.counts[shape] += 1
+        if self.counts[shape] == self.threshold:
+            self.sources[shape] = query_source()
+
+    def repeated(self):
+        """[(count, source, shape)] of the shapes that reached the threshold, most repeated first."""
+        return sorted(
+            ((count, self.sources[shape], shape) for shape, count in self.counts.items() if count >= self.threshold),
+            reverse=True,
+        )
+
+
+def start_tracking():
+    if detection_mode() is None:
+        return None
+    return QueryShapeTracker(getattr(settings, 'NPLUSONE_THRESHOLD', 3))
+
+
+def report(endpoint, tracker):
+    repeated = tracker.repeated() if tracker is not None else []
+    if not repeated:
+        return
+    message = f'{endpoint}: possible N+1 queries\n' + '\n'.join(
+        f'  {count} x from {source}: {shape[:300]}' for count, source, shape in repeated
+    )
+    if detection_mode() == RAISE:
+        raise NPlusOneError(message)
+    logger.warning(message)
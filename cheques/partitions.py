@@ -0,0 +1,336 @@
+"""
+Monthly range partitions for the tables that grow with time (PostgreSQL).
+
+credit_invoice, payment and payment_details are partitioned by date, one
+partition per month (<table>_p2025_01) plus a <table>_default partition for
+dates no monthly partition covers yet, so an insert never fails. Reports
+filtering on the date only scan the months they ask for.
+
+What partitioning changes, and how the models stay usable by Django:
+
+- a primary key or unique constraint must include the partition column, so
+  the table's primary key is (id, <date>) and the alias_id constraint is
+  (alias_id, <date>). Django still sees `id` as the primary key; ids come
+  from a sequence owned by the id column, so they stay unique across
+  partitions. alias_id stays unique table-wide through a trigger
+  maintaining <table>_alias_id
+- payment_details is partitioned on its copy of payment.received_date, and
+  the branch-wide uniqueness of id_number is kept by a trigger maintaining
+  payment_details_id_number
+- a foreign key can't reference a partitioned table's id alone, so the
+  foreign keys pointing at these tables (payment_details.payment,
+  credit_invoice.payment, claim.payment_details) are db_constraint=False.
+  Django still applies on_delete when a row is deleted through the ORM,
+  but the database no longer checks them: a raw SQL insert or update can
+  store an id that doesn't exist, and a raw DELETE, QuerySet._raw_delete or
+  TRUNCATE of a payment leaves its details, invoices and claims pointing at
+  nothing, where the database used to refuse or cascade. Code writing these
+  tables outside the ORM (archive.py deletes children before parents for
+  this reason) has to keep them consistent itself
+
+`manage.py create_partitions` (run by entrypoint.sh and daily from cron)
+creates the coming months' partitions, moving rows that landed in the
+default partition into the new monthly one.
+"""
+import re
+from datetime import date
+
+from django.utils import timezone
+
+PARTITIONED_TABLES = {
+    'credit_invoice': 'transaction_date',
+    'payment': 'received_date',
+    'payment_details': 'received_date',
+}
+
+DEFAULT_MONTHS_AHEAD = 3
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f'{table}_p{month.year}_{month.month:02d}'
+
+
+def default_partition_name(table):
+    return f'{table}_default'
+
+
+def is_partitioned(cursor, table):
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))", [table]
+    )
+    return cursor.fetchone()[0]
+
+
+def partitions_of(cursor, table):
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s)", [table]
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+def create_partition(cursor, table, month):
+    """Create `table`'s partition for `month`, moving its rows out of the default partition."""
+    column = PARTITIONED_TABLES[table]
+    name = partition_name(table, month)
+    bounds = [month, add_months(month, 1)]
+    default = default_partition_name(table)
+
+    cursor.execute(f'SELECT EXISTS (SELECT 1 FROM "{default}" WHERE "{column}" >= %s AND "{column}" < %s)', bounds)
+    if not cursor.fetchone()[0]:
+        cursor.execute(f'CREATE TABLE "{name}" PARTITION OF "{table}" FOR VALUES FROM (%s) TO (%s)', bounds)
+        return name
+
+    # Attaching a partition checks the default partition holds no rows of its
+    # range, so those rows move over first
+    cursor.execute(f'CREATE TABLE "{name}" (LIKE "{table}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM "{default}" WHERE "{column}" >= %s AND "{column}" < %s RETURNING *) '
+        f'INSERT INTO "{name}" SELECT * FROM moved', bounds
+    )
+    cursor.execute(f'ALTER TABLE "{table}" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)', bounds)
+    # Deleting them from the default partition released their guard entries
+    cursor.execute(f'INSERT INTO "{table}_alias_id" SELECT alias_id FROM "{name}" ON CONFLICT DO NOTHING')
+    if table == 'payment_details':
+        cursor.execute(
+            f'INSERT INTO payment_details_id_number SELECT branch_id, id_number FROM "{name}" '
+            f'WHERE id_number IS NOT NULL ON CONFLICT DO NOTHING'
+        )
+    return name
+
+
+def ensure_partitions(connection, months_ahead=DEFAULT_MONTHS_AHEAD, today=None):
+    """
+    Create the monthly partitions missing up to `months_ahead` months from now,
+    and those of any month with rows in a default partition. Returns their names.
+    """
+    if connection.vendor != 'postgresql':
+        return []
+    first = month_start(today or timezone.localdate())
+    upcoming = [add_months(first, n) for n in range(months_ahead + 1)]
+    created = []
+    with connection.cursor() as cursor:
+        for table, column in PARTITIONED_TABLES.items():
+            if not is_partitioned(cursor, table):
+                continue
+            cursor.execute(
+                f'SELECT DISTINCT date_trunc(\'month\', "{column}")::date FROM "{default_partition_name(table)}"'
+            )
+            stray = [row[0] for row in cursor.fetchall()]
+            existing = partitions_of(cursor, table)
+            for month in sorted(set(upcoming + stray)):
+                if partition_name(table, month) not in existing:
+                    created.append(create_partition(cursor, table, month))
+    return created
+
+
+# -- converting a table (migration 0025) ------------------------------------
+
+def _columns(cursor, table, oids):
+    cursor.execute(
+        "SELECT attname FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attnum = ANY(%s) ORDER BY attnum",
+        [table, list(oids)],
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _table_definition(cursor, table):
+    """Primary key, unique constraints, other indexes and foreign keys of `table`, to rebuild them."""
+    cursor.execute(
+        "SELECT conname, contype, conkey, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(%s) AND contype IN ('p', 'u', 'f')", [table]
+    )
+    constraints = cursor.fetchall()
+    cursor.execute(
+        "SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index "
+        "WHERE indrelid = to_regclass(%s) AND NOT EXISTS "
+        "(SELECT 1 FROM pg_constraint WHERE conindid = indexrelid AND contype IN ('p', 'u'))", [table]
+    )
+    indexes = cursor.fetchall()
+    uniques = [(name, _columns(cursor, table, keys)) for name, kind, keys, _ in constraints if kind == 'u']
+    foreign_keys = [(name, definition) for name, kind, _, definition in constraints if kind == 'f']
+    return uniques, indexes, foreign_keys
+
+
+def _rebuild(cursor, table, column, today):
+    """Recreate `table` partitioned by `column`, or as a plain table when `column` is None."""
+    old = f'{table}__old'
+    uniques, indexes, foreign_keys = _table_definition(cursor, table)
+    # Foreign keys into the table (db_constraint=False now) would block dropping it
+    cursor.execute(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint WHERE confrelid = to_regclass(%s)", [table]
+    )
+    for referencing, name in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {referencing} DROP CONSTRAINT "{name}"')
+
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+    old_sequence = cursor.fetchone()[0]
+    cursor.execute(f'ALTER TABLE "{table}" RENAME TO "{old}"')
+    if old_sequence:
+        cursor.execute(f'ALTER SEQUENCE {old_sequence} RENAME TO "{old}_id_seq"')
+    cursor.execute(f'SELECT MAX(id) FROM "{old}"')
+    last_id = cursor.fetchone()[0]
+
+    partitioning = f' PARTITION BY RANGE ("{column}")' if column else ''
+    cursor.execute(f'CREATE TABLE "{table}" (LIKE "{old}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS){partitioning}')
+    if column:
+        # Identity columns can't be declared on partitioned tables before
+        # PostgreSQL 17; a sequence owned by the column does the same job
+        cursor.execute(f'CREATE SEQUENCE "{table}_id_seq" OWNED BY "{table}".id')
+        cursor.execute(f'ALTER TABLE "{table}" ALTER COLUMN id SET DEFAULT nextval(\'"{table}_id_seq"\')')
+        cursor.execute(f'SELECT setval(\'"{table}_id_seq"\', %s, %s)', [last_id or 1, last_id is not None])
+        cursor.execute(f'CREATE TABLE "{default_partition_name(table)}" PARTITION OF "{table}" DEFAULT')
+        cursor.execute(f'SELECT MIN("{column}") FROM "{old}"')
+        oldest = cursor.fetchone()[0] or today
+        month, last = month_start(min(oldest, today)), add_months(month_start(today), DEFAULT_MONTHS_AHEAD)
+        while month <= last:
+            cursor.execute(
+                f'CREATE TABLE "{partition_name(table, month)}" PARTITION OF "{table}" FOR VALUES FROM (%s) TO (%s)',
+                [month, add_months(month, 1)],
+            )
+            month = add_months(month, 1)
+    else:
+        cursor.execute(f'ALTER TABLE "{table}" ALTER COLUMN id DROP DEFAULT')
+        cursor.execute(f'ALTER TABLE "{table}" ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY')
+        cursor.execute(f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), %s, %s)",
+                       [last_id or 1, last_id is not None])
+
+    cursor.execute(f'INSERT INTO "{table}" SELECT * FROM "{old}"')
+    cursor.execute(f'DROP TABLE "{old}"')
+
+    # Indexes are built after the copy, and keep their names
+    key = ['id'] + ([column] if column else [])
+    cursor.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{table}_pkey" PRIMARY KEY ({", ".join(key)})')
+    for name, columns in uniques:
+        columns = [c for c in columns if c not in PARTITIONED_TABLES.values()] + ([column] if column else [])
+        cursor.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" UNIQUE ({", ".join(columns)})')
+    for name, definition in indexes:
+        # Indexes of a partitioned table read "ON ONLY <table>"
+        cursor.execute(re.sub(rf' ON (ONLY )?(\S+\.)?"?{old}"? ', f' ON "{table}" ', definition))
+    for name, definition in foreign_keys:
+        cursor.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" {definition}')
+
+
+ID_NUMBER_GUARD = """
+CREATE TABLE payment_details_id_number (
+    branch_id bigint NOT NULL,
+    id_number varchar(10) NOT NULL,
+    PRIMARY KEY (branch_id, id_number)
+);
+INSERT INTO payment_details_id_number
+    SELECT DISTINCT branch_id, id_number FROM payment_details WHERE id_number IS NOT NULL;
+
+CREATE FUNCTION payment_details_id_number_guard() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        TRUNCATE payment_details_id_number;
+        RETURN NULL;
+    END IF;
+    IF TG_OP <> 'INSERT' AND OLD.id_number IS NOT NULL THEN
+        DELETE FROM payment_details_id_number WHERE branch_id = OLD.branch_id AND id_number = OLD.id_number;
+    END IF;
+    -- A duplicate fails here with a unique violation, as the old constraint did
+    IF TG_OP <> 'DELETE' AND NEW.id_number IS NOT NULL THEN
+        INSERT INTO payment_details_id_number (branch_id, id_number) VALUES (NEW.branch_id, NEW.id_number);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- A row moving to another partition fires DELETE and INSERT
+CREATE TRIGGER payment_details_id_number_guard
+    AFTER INSERT OR DELETE OR UPDATE OF branch_id, id_number ON payment_details
+    FOR EACH ROW EXECUTE FUNCTION payment_details_id_number_guard();
+CREATE TRIGGER payment_details_id_number_truncate
+    AFTER TRUNCATE ON payment_details
+    FOR EACH STATEMENT EXECUTE FUNCTION payment_details_id_number_guard();
+"""
+
+DROP_ID_NUMBER_GUARD = """
+DROP TRIGGER IF EXISTS payment_details_id_number_truncate ON payment_details;
+DROP TRIGGER IF EXISTS payment_details_id_number_guard ON payment_details;
+DROP FUNCTION IF EXISTS payment_details_id_number_guard();
+DROP TABLE IF EXISTS payment_details_id_number;
+"""
+
+# Same pattern for alias_id, on each partitioned table ({table} is filled in)
+ALIAS_ID_GUARD = """
+CREATE TABLE {table}_alias_id (
+    alias_id text PRIMARY KEY
+);
+INSERT INTO {table}_alias_id SELECT alias_id FROM {table};
+
+CREATE FUNCTION {table}_alias_id_guard() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        TRUNCATE {table}_alias_id;
+        RETURN NULL;
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        DELETE FROM {table}_alias_id WHERE alias_id = OLD.alias_id;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO {table}_alias_id (alias_id) VALUES (NEW.alias_id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER {table}_alias_id_guard
+    AFTER INSERT OR DELETE OR UPDATE OF alias_id ON {table}
+    FOR EACH ROW EXECUTE FUNCTION {table}_alias_id_guard();
+CREATE TRIGGER {table}_alias_id_truncate
+    AFTER TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE FUNCTION {table}_alias_id_guard();
+"""
+
+DROP_ALIAS_ID_GUARD = """
+DROP TRIGGER IF EXISTS {table}_alias_id_truncate ON {table};
+DROP TRIGGER IF EXISTS {table}_alias_id_guard ON {table};
+DROP FUNCTION IF EXISTS {table}_alias_id_guard();
+DROP TABLE IF EXISTS {table}_alias_id;
+"""
+
+
+def partition_tables(connection, today=None):
+    today = today or timezone.localdate()
+    with connection.cursor() as cursor:
+        for table, column in PARTITIONED_TABLES.items():
+            if not is_partitioned(cursor, table):
+                _rebuild(cursor, table, column, today)
+        # The (branch_id, id_number) constraint became per date above; the
+        # guard table keeps id numbers unique per branch
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass('payment_details') AND conname = %s",
+            ['unique_id_number'],
+        )
+        if cursor.fetchone():
+            cursor.execute('ALTER TABLE payment_details DROP CONSTRAINT unique_id_number')
+        cursor.execute(ID_NUMBER_GUARD)
+        # alias_id's unique constraint became (alias_id, <date>); it stays as
+        # the lookup index, the guard tables keep alias_ids unique
+        for table in PARTITIONED_TABLES:
+            cursor.execute(ALIAS_ID_GUARD.format(table=table))
+
+
+def unpartition_tables(connection, today=None):
+    today = today or timezone.localdate()
+    with connection.cursor() as cursor:
+        cursor.execute(DROP_ID_NUMBER_GUARD)
+        for table in PARTITIONED_TABLES:
+            cursor.execute(DROP_ALIAS_ID_GUARD.format(table=table))
+            if is_partitioned(cursor, table):
+                _rebuild(cursor, table, None, today)
+        cursor.execute(
+            'ALTER TABLE payment_details DROP CONSTRAINT IF EXISTS unique_id_number, '
+            'ADD CONSTRAINT unique_id_number UNIQUE (branch_id, id_number)'
+        )
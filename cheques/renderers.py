@@ -0,0 +1,62 @@
+"""
+orjson based JSON renderer and parser.
+
+Drop-in replacements for DRF's JSONRenderer/JSONParser: orjson writes
+str, int, float, dict, list and UUIDs itself straight to bytes; everything
+else goes through DRF's own encoder. That includes dates, datetimes and
+times, which orjson would write with microseconds where DRF keeps
+milliseconds, as well as raw Decimals in report payloads, lazy translation
+strings and querysets. The output is byte for byte what JSONRenderer writes
+with the default COMPACT_JSON/UNICODE_JSON, with one difference: NaN and
+infinite floats render as null, where JSONRenderer (STRICT_JSON) raises.
+"""
+import orjson
+from django.utils.http import parse_header_parameters
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from .metrics import timed
+
+_encoder = JSONEncoder()
+
+OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+class ORJSONRenderer(BaseRenderer):
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        options = OPTIONS
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            # orjson only indents by 2
+            options |= orjson.OPT_INDENT_2
+        with timed('render'):
+            return orjson.dumps(data, default=_encoder.default, option=options)
+
+    def get_indent(self, accepted_media_type, renderer_context):
+        # Same rules as JSONRenderer: an indent= media type parameter, else the context
+        if accepted_media_type:
+            _, params = parse_header_parameters(accepted_media_type)
+            try:
+                return int(params['indent']) > 0
+            except (KeyError, ValueError, TypeError):
+                pass
+        return bool(renderer_context.get('indent'))
+
+
+class ORJSONParser(BaseParser):
+    media_type = 'application/json'
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
@@ -0,0 +1,43 @@
+from django.db.models import Q
+from rest_framework import filters
+
+
+class TrigramSearchFilter(filters.SearchFilter):
+    """
+    ?search= backed by the pg_trgm GIN indexes (migration 0023).
+
+    Views declare `trigram_search` as (relation path, model, fields) entries;
+    an empty path searches the view's own model. Each term is matched per
+    table in a subquery that can use that table's trigram indexes, and the
+    subqueries are OR-ed by id. A plain SearchFilter ORs icontains across a
+    chain of joins, which the planner can only answer with sequential scans.
+    Views without `trigram_search` get the stock SearchFilter behaviour.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        entries = getattr(view, 'trigram_search', None)
+        if not entries:
+            return super().filter_queryset(request, queryset, view)
+
+        for term in self.get_search_terms(request):
+            condition = Q()
+            for path, model, fields in entries:
+                matches = Q()
+                for field in fields:
+                    matches |= Q(**{f'{field}__icontains': term})
+                if path:
+                    condition |= Q(**{f'{path}__in': model._default_manager.filter(matches).values('pk')})
+                else:
+                    condition |= matches
+            queryset = queryset.filter(condition)
+        return queryset
+
+    def get_search_fields(self, view, request):
+        entries = getattr(view, 'trigram_search', None)
+        if not entries:
+            return super().get_search_fields(view, request)
+        return [
+            f'{path}__{field}' if path else field
+            for path, model, fields in entries
+            for field in fields
+        ]
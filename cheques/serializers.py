@@ -3,6 +3,10 @@ from rest_framework import serializers
 from .models import (Branch, #ChequeStore, InvoiceChequeMap, 
                      Customer, CreditInvoice,) #MasterClaim, CustomerClaim, CustomerPayment, InvoiceClaimMap)
 from .models import Payment, PaymentDetails, Customer, Branch, PaymentInstrument, PaymentInstrumentType, Claim
+from .models import ArchivedClaim, ArchivedCreditInvoice, ArchivedPayment, ArchivedPaymentDetails
+from .Instrument import PaymentInstrumentPolicy
+from .cache import branch_alias_for_id, branch_for_alias
+from .metrics import timed
 
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.utils import timezone
@@ -12,7 +16,76 @@ from django.shortcuts import get_object_or_404
 
 from django.core.exceptions import ValidationError 
 
-class UserSerializer(serializers.ModelSerializer):
+
+def split_field_list(value):
+    # "a, b,,c" -> {'a', 'b', 'c'}
+    if not value:
+        return set()
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+class DynamicFieldsMixin:
+    """
+    Sparse fieldsets for read requests.
+
+    ?fields=alias_id,received_date  -> only the listed fields are rendered
+    ?expand=invoices                -> nested fields named in Meta.expandable_fields
+
+    Expandable fields are rendered unless the view passes context['slim'] =
+    True or the request lists ?fields= without them; then they are dropped
+    until named in ?fields= or ?expand=.
+    """
+
+    @classmethod
+    def requested_expansions(cls, request, slim=False):
+        expandable = set(getattr(cls.Meta, 'expandable_fields', ()))
+        if request is None:
+            return expandable
+        params = request.query_params
+        only = split_field_list(params.get('fields'))
+        if not slim and not only:
+            return expandable
+        return expandable & (split_field_list(params.get('expand')) | only)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            return
+
+        expanded = self.requested_expansions(request, self.context.get('slim', False))
+        for name in set(getattr(self.Meta, 'expandable_fields', ())) - expanded:
+            self.fields.pop(name, None)
+
+        only = split_field_list(request.query_params.get('fields'))
+        if only:
+            for name in set(self.fields) - only - expanded:
+                self.fields.pop(name)
+
+    def to_representation(self, instance):
+        with timed('serializer'):
+            return super().to_representation(instance)
+
+
+class VersionedSerializerMixin:
+    """
+    Routes updates of versioned models through Model.save_versioned() when
+    the caller passes save(expected_version=...), so the version check and
+    the write are one statement.
+    """
+
+    def update(self, instance, validated_data):
+        expected_version = validated_data.pop('expected_version', None)
+        if expected_version is None:
+            return super().update(instance, validated_data)
+
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save_versioned(expected_version)
+        return instance
+
+
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'email', 'first_name', 'last_name']
@@ -28,10 +101,31 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         }
         return data
 
-class BranchSerializer(serializers.ModelSerializer):
-    parent = serializers.SlugRelatedField(
-        slug_field='alias_id',
-        queryset=Branch.objects.all(),
+class CachedBranchField(serializers.SlugRelatedField):
+    # Maps branch alias <-> id through the shared cache instead of a query per instance
+    def __init__(self, **kwargs):
+        kwargs.setdefault('slug_field', 'alias_id')
+        kwargs.setdefault('queryset', Branch.objects.all())
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if not isinstance(data, str):
+            self.fail('invalid')
+        branch = branch_for_alias(data)
+        if branch is None:
+            self.fail('does_not_exist', slug_name=self.slug_field, value=data)
+        return branch
+
+    def use_pk_only_optimization(self):
+        # Only branch_id is read from the instance, so lists don't need to join branch
+        return True
+
+    def to_representation(self, value):
+        return branch_alias_for_id(value.pk)
+
+
+class BranchSerializer(VersionedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
+    parent = CachedBranchField(
         required=False,
         allow_null=True
     )
@@ -52,12 +146,8 @@ class BranchSerializer(serializers.ModelSerializer):
         }
    
 #-----------------------------
-class CustomerSerializer(serializers.ModelSerializer):
-    branch = serializers.SlugRelatedField(
-        slug_field='alias_id',
-        queryset=Branch.objects.all(),
-        required=True
-    )
+class CustomerSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    branch = CachedBranchField(required=True)
     parent = serializers.SlugRelatedField(
         slug_field='alias_id',
         queryset=Customer.objects.all(),
@@ -82,10 +172,10 @@ class CustomerSerializer(serializers.ModelSerializer):
         # extra_kwargs = {
         #     'parent': {'required': False}
         # }
-class CreditInvoiceSerializer(serializers.ModelSerializer):
+class CreditInvoiceSerializer(VersionedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
     alias_id = serializers.CharField(read_only=True) 
 
-    branch = serializers.SlugRelatedField(slug_field='alias_id', queryset=Branch.objects.all())
+    branch = CachedBranchField()
     customer = serializers.SlugRelatedField(slug_field='alias_id', queryset=Customer.objects.all())
     payment_grace_days = serializers.IntegerField(read_only=True)
     customer_name = serializers.CharField(source='customer.name', read_only=True)
@@ -136,21 +226,32 @@ class CreditInvoiceSerializer(serializers.ModelSerializer):
 
 #  ---------------------implementing payment-----------------------
 
-class PaymentInstrumentTypeSerializer(serializers.ModelSerializer):
+class PaymentInstrumentTypeSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = PaymentInstrumentType
         fields = ['id','serial_no', 'type_name', 'is_cash_equivalent', 'prefix', 'last_number', 'auto_number' ]
         read_only_fields = ['id']
 
-class PaymentInstrumentSerializer(serializers.ModelSerializer):
+class PaymentInstrumentSerializer(VersionedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
     
     class Meta:
         model = PaymentInstrument
         fields = ['id', 'branch', 'serial_no','instrument_type','instrument_name', 'is_active','version']
         read_only_fields = ['version']
 
-class PaymentDetailsSerializer(serializers.ModelSerializer):
-    payment_instrument = serializers.PrimaryKeyRelatedField(
+class CachedPaymentInstrumentField(serializers.PrimaryKeyRelatedField):
+    # Resolves the instrument (with its type attached) from the reference cache
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        instrument = PaymentInstrumentPolicy.get_instrument(data)
+        if instrument is None:
+            self.fail('does_not_exist', pk_value=data)
+        return instrument
+
+
+class PaymentDetailsSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    payment_instrument = CachedPaymentInstrumentField(
         queryset=PaymentInstrument.objects.all()
     )    
 
@@ -193,11 +294,8 @@ class PaymentDetailsSerializer(serializers.ModelSerializer):
         return attrs
 
 
-class PaymentSerializer(serializers.ModelSerializer):
-    branch = serializers.SlugRelatedField(
-        slug_field='alias_id',
-        queryset=Branch.objects.all()
-    )
+class PaymentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    branch = CachedBranchField()
     customer = serializers.SlugRelatedField(
         slug_field='alias_id',
         queryset=Customer.objects.filter(is_parent=True)
@@ -235,12 +333,20 @@ class PaymentSerializer(serializers.ModelSerializer):
 
     invoices = CreditInvoiceSerializer(many=True, required=True, source='invoice_set')
 
+    # Summary columns, only present when the queryset is annotated (see PaymentViewSet)
+    details_count = serializers.IntegerField(read_only=True)
+    details_amount = serializers.DecimalField(max_digits=18, decimal_places=4, read_only=True)
+    invoice_count = serializers.IntegerField(read_only=True)
+    invoice_net_amount = serializers.DecimalField(max_digits=18, decimal_places=4, read_only=True)
+
     
     class Meta:
         model = Payment
         fields = ['alias_id', 'branch', 'customer', 'received_date', 'cash_equivalent_amount',
-                  'claim_amount','total_amount','shortage_amount', 'payment_details', 'invoices', 'version']
+                  'claim_amount','total_amount','shortage_amount', 'payment_details', 'invoices', 'version',
+                  'details_count', 'details_amount', 'invoice_count', 'invoice_net_amount']
         read_only_fields = ['alias_id', 'version']
+        expandable_fields = ['payment_details', 'invoices']
         
         extra_kwargs = {
             'alias_id': {'read_only': True}  # Explicitly make it read-only
@@ -251,54 +357,163 @@ class PaymentSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Only parent customers allowed.")
         return value
 
+class AllocatedInvoiceSerializer(serializers.Serializer):
+    alias_id = serializers.CharField()
+    grn = serializers.CharField(allow_null=True)
+    customer = serializers.CharField()
+    customer_name = serializers.CharField()
+    transaction_date = serializers.DateField()
+    grace_date = serializers.DateField()
+    net_amount = serializers.DecimalField(max_digits=18, decimal_places=4)
+
+
+class AllocationProposalSerializer(serializers.Serializer):
+    # Shaped so branch/customer/total_amount/invoices can be posted to PaymentViewSet.create
+    branch = serializers.CharField(allow_null=True)
+    customer = serializers.CharField()
+    match = serializers.CharField()
+    total_amount = serializers.DecimalField(max_digits=18, decimal_places=4)
+    allocated_amount = serializers.DecimalField(max_digits=18, decimal_places=4)
+    unallocated_amount = serializers.DecimalField(max_digits=18, decimal_places=4)
+    open_invoice_count = serializers.IntegerField()
+    invoices = AllocatedInvoiceSerializer(many=True)
+
+
 # serializers.py
-class ClaimListSerializer(serializers.ModelSerializer):
-    customer_name = serializers.CharField(source='payment_details.payment.customer.name', read_only=True)
+class ClaimListSerializer(VersionedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
+    customer_name = serializers.CharField(source='customer.name', read_only=True)
     instrument_name = serializers.CharField(source='payment_details.payment_instrument.instrument_name', read_only=True)
     claim_amount = serializers.DecimalField(
-        source='payment_details.amount', 
         max_digits=18, 
         decimal_places=4, 
         read_only=True
     )
-    claim_date = serializers.DateField(source='payment_details.payment.received_date', read_only=True)
+    claim_date = serializers.DateField(read_only=True)
     claim_serial_no = serializers.CharField(source='payment_details.id_number', read_only=True)
     detail = serializers.CharField(source='payment_details.detail', read_only=True)
 
-    remaining_amount = serializers.SerializerMethodField()
+    remaining_amount = serializers.DecimalField(max_digits=18, decimal_places=4, read_only=True)
 
     class Meta:
         model = Claim
         fields = [
             'alias_id', 'customer_name', 'instrument_name', 'claim_serial_no',
             'detail', 'claim_amount', 'claim_date', 'submitted_date',
-            'refund_amount', 'refund_date', 'remarks', 'remaining_amount',
+            'refund_amount', 'refund_date', 'remarks', 'remaining_amount', 'version',
         ]
 
         read_only_fields = ['alias_id', 'customer_name', 'instrument_name', 'claim_amount', 
-                            'claim_date', 'claim_serial_no', 'detail', ]
-    def get_remaining_amount(self, obj):
-        return obj.payment_details.amount - obj.refund_amount
+                            'claim_date', 'claim_serial_no', 'detail', 'remaining_amount', 'version']
     
-class ClaimUpdateSerializer(serializers.ModelSerializer):
+class ClaimUpdateSerializer(VersionedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Claim
-        fields = ['submitted_date', 'refund_amount', 'refund_date', 'remarks']
-
-    def validate(self, attrs):
-        submitted_date = attrs.get('submitted_date')
-        refund_amount = attrs.get('refund_amount')
-        refund_date = attrs.get('refund_date')
+        fields = ['submitted_date', 'refund_amount', 'refund_date', 'remarks', 'version']
+        read_only_fields = ['version']
 
+    @staticmethod
+    def refund_rule_errors(submitted_date, refund_amount, refund_date):
+        errors = []
         # Rule 1: If submitted_date is empty, refund_amount and refund_date are not allowed
         if submitted_date is None and (refund_amount or refund_date):
-            raise ValidationError("Refund amount and refund date cannot be set unless the submitted date is provided.")
+            errors.append("Refund amount and refund date cannot be set unless the submitted date is provided.")
         
         # Rule 2: Refund amount and refund date pair: both must be provided or neither
         if (refund_amount is None and refund_date) or (refund_amount and refund_date is None):
-            raise ValidationError("Refund amount and refund date must both be provided together.")
-        
+            errors.append("Refund amount and refund date must both be provided together.")
+        return errors
+
+    def validate(self, attrs):
+        errors = self.refund_rule_errors(
+            attrs.get('submitted_date'), attrs.get('refund_amount'), attrs.get('refund_date')
+        )
+        if errors:
+            raise ValidationError(errors[0])
         return attrs
+
+
+class ClaimRefundRowSerializer(serializers.Serializer):
+    # One line of a supplier refund statement; `claim` is the claim alias_id or its id_number
+    claim = serializers.CharField(max_length=10)
+    refund_amount = serializers.DecimalField(max_digits=18, decimal_places=4, min_value=Decimal('0'))
+    refund_date = serializers.DateField()
+    submitted_date = serializers.DateField(required=False)
+    remarks = serializers.CharField(required=False, allow_blank=True)
+
+
+# Archived history (cheques/archive.py), read-only
+
+class ArchivedCreditInvoiceSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    branch = CachedBranchField()
+    customer = serializers.SlugRelatedField(slug_field='alias_id', read_only=True)
+    customer_name = serializers.CharField(source='customer.name', read_only=True)
+    payment = serializers.SlugRelatedField(slug_field='alias_id', read_only=True)
+
+    class Meta:
+        model = ArchivedCreditInvoice
+        fields = ('alias_id', 'branch', 'grn', 'customer', 'customer_name', 'transaction_date',
+                  'sales_amount', 'sales_return', 'payment_grace_days', 'payment', 'status', 'archived_at')
+        read_only_fields = fields
+
+
+class ArchivedPaymentDetailsSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    instrument_name = serializers.CharField(source='payment_instrument.instrument_name', read_only=True)
+
+    class Meta:
+        model = ArchivedPaymentDetails
+        fields = ['alias_id', 'id_number', 'payment_instrument', 'instrument_name', 'detail', 'amount']
+        read_only_fields = fields
+
+
+class ArchivedPaymentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    branch = CachedBranchField()
+    customer = serializers.SlugRelatedField(slug_field='alias_id', read_only=True)
+    customer_name = serializers.CharField(source='customer.name', read_only=True)
+    payment_details = ArchivedPaymentDetailsSerializer(many=True, read_only=True, source='details')
+    invoices = serializers.SlugRelatedField(slug_field='alias_id', many=True, read_only=True)
+
+    class Meta:
+        model = ArchivedPayment
+        fields = ['alias_id', 'branch', 'customer', 'customer_name', 'received_date', 'cash_equivalent_amount',
+                  'claim_amount', 'total_amount', 'shortage_amount', 'payment_details', 'invoices', 'archived_at']
+        read_only_fields = fields
+
+
+class ArchivedClaimSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    customer_name = serializers.CharField(source='customer.name', read_only=True)
+    instrument_name = serializers.CharField(source='payment_details.payment_instrument.instrument_name', read_only=True)
+    claim_serial_no = serializers.CharField(source='payment_details.id_number', read_only=True)
+    detail = serializers.CharField(source='payment_details.detail', read_only=True)
+
+    class Meta:
+        model = ArchivedClaim
+        fields = [
+            'alias_id', 'customer_name', 'instrument_name', 'claim_serial_no',
+            'detail', 'claim_amount', 'claim_date', 'submitted_date',
+            'refund_amount', 'refund_date', 'remarks', 'remaining_amount', 'archived_at',
+        ]
+        read_only_fields = fields
+
+
+class StatementLineSerializer(serializers.Serializer):
+    date = serializers.DateField()
+    kind = serializers.CharField()
+    document = serializers.CharField()
+    reference = serializers.CharField(allow_null=True)
+    debit = serializers.DecimalField(max_digits=18, decimal_places=4)
+    credit = serializers.DecimalField(max_digits=18, decimal_places=4)
+    balance = serializers.DecimalField(max_digits=18, decimal_places=4)
+    archived = serializers.BooleanField()
+
+
+class CustomerStatementSerializer(serializers.Serializer):
+    # See cheques/statement.py
+    customer = serializers.CharField()
+    date_from = serializers.DateField(allow_null=True)
+    date_to = serializers.DateField(allow_null=True)
+    opening_balance = serializers.DecimalField(max_digits=18, decimal_places=4)
+    lines = StatementLineSerializer(many=True)
+    closing_balance = serializers.DecimalField(max_digits=18, decimal_places=4)
 # class ClaimSerializer(serializers.ModelSerializer):    
 #     branch = serializers.SlugRelatedField(
 #         slug_field='alias_id',
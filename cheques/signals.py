@@ -0,0 +1,78 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .Instrument import PaymentInstrumentPolicy
+from .authentication import invalidate_cached_user
+from .cache import bump_namespace, forget_branch
+from .claim_summary import invalidate_claims_summary
+from .metrics import install_query_recorder
+from .models import Branch, Claim, CreditInvoice, Customer, Payment, PaymentInstrument, PaymentInstrumentType
+
+
+@receiver([post_save, post_delete], sender=Claim)
+def claim_changed(sender, instance, **kwargs):
+    invalidate_claims_summary(instance.branch_id)
+
+
+@receiver([post_save, post_delete], sender=PaymentInstrumentType)
+@receiver([post_save, post_delete], sender=PaymentInstrument)
+def instrument_reference_changed(sender, instance, update_fields=None, **kwargs):
+    # Auto numbering bumps last_number on every payment; that column is never
+    # served from the cache, so it doesn't need a reload
+    if update_fields is not None and set(update_fields) == {'last_number'}:
+        return
+    branch_id = instance.branch_id
+
+    def invalidate():
+        PaymentInstrumentPolicy.invalidate()
+        bump_namespace('reference', branch_id)
+    # Only once committed: a reload before then would cache the old rows
+    # (other connections) or rows that may still roll back (this one)
+    transaction.on_commit(invalidate)
+
+
+@receiver([post_save, post_delete], sender=Customer)
+def customer_changed(sender, instance, **kwargs):
+    bump_namespace('customers', instance.branch_id)
+
+
+@receiver([post_save, post_delete], sender=Customer)
+@receiver([post_save, post_delete], sender=CreditInvoice)
+@receiver([post_save, post_delete], sender=Payment)
+def dues_changed(sender, instance, **kwargs):
+    bump_namespace('dues', instance.branch_id)
+
+
+@receiver(post_save, sender=Branch)
+def branch_saved(sender, instance, **kwargs):
+    forget_branch(instance.alias_id, instance.pk)
+
+
+@receiver(post_delete, sender=Branch)
+def branch_deleted(sender, instance, **kwargs):
+    forget_branch(instance.alias_id, instance.pk, deleted=True)
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, **kwargs):
+    invalidate_cached_user(instance.pk)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def user_access_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # Changed from the group/permission side: instance isn't a user
+        invalidate_cached_user(*(pk_set or ()))
+    elif isinstance(instance, User):
+        invalidate_cached_user(instance.pk)
+
+
+@receiver(connection_created)
+def record_queries(sender, connection, **kwargs):
+    install_query_recorder(connection)
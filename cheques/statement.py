@@ -0,0 +1,81 @@
+"""
+Customer statements over hot and archived history.
+
+Invoices (debits, net of returns) and payments (credits) of a customer - for
+a parent, its children's invoices and its own payments - read from the live
+tables and the archive tables (cheques/archive.py) in one UNION ALL query,
+oldest first, with a running balance. Archiving history doesn't change what
+a statement shows.
+"""
+from decimal import Decimal
+
+from django.db.models import BooleanField, CharField, DecimalField, F, Q, Sum, TextField, Value
+
+from .models import ArchivedCreditInvoice, ArchivedPayment, CreditInvoice, Payment
+
+AMOUNT = DecimalField(max_digits=18, decimal_places=4)
+ZERO = Decimal(0)
+INVOICE = 'invoice'
+PAYMENT = 'payment'
+
+# Every column is an annotation, in this order, so the union's parts line up
+COLUMNS = ('date', 'kind', 'document', 'reference', 'debit', 'credit', 'archived')
+
+
+def _invoices(model, customer, archived):
+    return model.objects.filter(Q(customer=customer) | Q(customer__parent=customer)).annotate(
+        date=F('transaction_date'),
+        kind=Value(INVOICE, output_field=CharField()),
+        document=F('alias_id'),
+        reference=F('grn'),
+        debit=F('sales_amount') - F('sales_return'),
+        credit=Value(ZERO, output_field=AMOUNT),
+        archived=Value(archived, output_field=BooleanField()),
+    )
+
+
+def _payments(model, customer, archived):
+    return model.objects.filter(customer=customer).annotate(
+        date=F('received_date'),
+        kind=Value(PAYMENT, output_field=CharField()),
+        document=F('alias_id'),
+        reference=Value(None, output_field=TextField()),
+        debit=Value(ZERO, output_field=AMOUNT),
+        credit=F('total_amount'),
+        archived=Value(archived, output_field=BooleanField()),
+    )
+
+
+def _sources(customer, **filters):
+    return [
+        _invoices(CreditInvoice, customer, False).filter(**filters),
+        _invoices(ArchivedCreditInvoice, customer, True).filter(**filters),
+        _payments(Payment, customer, False).filter(**filters),
+        _payments(ArchivedPayment, customer, True).filter(**filters),
+    ]
+
+
+def opening_balance(customer, date_from):
+    """Invoiced less paid before date_from, one row per source in a single query."""
+    first, *rest = [
+        source.values('kind').annotate(balance=Sum(F('debit') - F('credit'), output_field=AMOUNT)).values('balance')
+        for source in _sources(customer, date__lt=date_from)
+    ]
+    return sum((row['balance'] or ZERO for row in first.union(*rest, all=True)), ZERO)
+
+
+def customer_statement(customer, date_from=None, date_to=None):
+    filters = {}
+    if date_from:
+        filters['date__gte'] = date_from
+    if date_to:
+        filters['date__lte'] = date_to
+    first, *rest = [source.values(*COLUMNS) for source in _sources(customer, **filters)]
+
+    opening = opening_balance(customer, date_from) if date_from else ZERO
+    balance = opening
+    lines = []
+    for line in first.union(*rest, all=True).order_by('date', 'kind', 'document'):
+        balance += line['debit'] - line['credit']
+        lines.append({**line, 'balance': balance})
+    return {'opening_balance': opening, 'lines': lines, 'closing_balance': balance}
@@ -1,3 +1,1728 @@
-from django.test import TestCase
+import gzip
+import re
+import threading
+import uuid
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import FormParser, MultiPartParser
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
+from rest_framework.test import APIClient, force_authenticate
+from rest_framework.views import APIView
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import cache as shared_cache, db_router, metrics, partitions
+from .Instrument import PaymentInstrumentPolicy
+from .allocation import find_exact_subset, propose_allocation
+from .archive import archive_settled
+from .authentication import CachedJWTAuthentication
+from .db_router import PrimaryReplicaRouter
+from .exception_handler import VersionConflict
+from .middleware import CompressionMiddleware, PerformanceMiddleware, brotli
+from .models import (
+    ArchivedClaim, ArchivedCreditInvoice, ArchivedPayment, ArchivedPaymentDetails,
+    Branch, Claim, CreditInvoice, Customer, Payment, PaymentDetails, PaymentInstrument, PaymentInstrumentType,
+)
+from .nplusone import NPlusOneError, QueryShapeTracker, query_shape
+from .renderers import ORJSONParser, ORJSONRenderer
+from .serializers import CreditInvoiceSerializer
+from .views import ParentCustomerDueReport, PaymentViewSet
 
 # Create your tests here.
+
+
+def invoice_rows(count):
+    # Shaped like CreditInvoiceSerializer output
+    return [
+        {
+            'alias_id': f'{i:010x}',
+            'branch': 'a1b2c3d4e5',
+            'grn': f'GRN-{i:07d}',
+            'customer': f'{i % 200:010x}',
+            'customer_name': f'Customer {i % 200}',
+            'transaction_date': f'2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}',
+            'sales_amount': f'{Decimal(1000 + i * 7 % 9000):.4f}',
+            'sales_return': '0.0000',
+            'payment_grace_days': 30,
+            'payment': None,
+            'version': 1,
+        }
+        for i in range(count)
+    ]
+
+
+def reset_caches():
+    # Test databases reuse ids, so nothing cached by an earlier test may survive
+    cache.clear()
+    shared_cache._branch_id_by_alias.clear()
+    shared_cache._branch_alias_by_id.clear()
+    # Forget the memo's version too, or a check falling due mid-request
+    # would see the cleared namespace as a new version and reload the branch
+    shared_cache._branch_memo_version = None
+    shared_cache._branch_memo_checked_at = None
+    PaymentInstrumentPolicy.invalidate()
+
+
+def seed_dataset(invoices=5, payments=2):
+    """One branch with a parent and child customer, instruments, unpaid invoices and paid ones."""
+    user = User.objects.create_user('cashier', password='secret')
+    branch = Branch.objects.create(name='Main', branch_type=1)
+    parent = Customer.objects.create(branch=branch, name='Parent', is_parent=True)
+    child = Customer.objects.create(branch=branch, name='Child', parent=parent, grace_days=10)
+    cheque_type = PaymentInstrumentType.objects.create(branch=branch, serial_no=1, type_name='Cheque', prefix='CQ')
+    cash_type = PaymentInstrumentType.objects.create(
+        branch=branch, serial_no=2, type_name='Cash', prefix='CH', auto_number=True, is_cash_equivalent=True)
+    claim_type = PaymentInstrumentType.objects.create(
+        branch=branch, serial_no=3, type_name='Claim', prefix='CL', auto_number=True)
+    data = {
+        'user': user, 'branch': branch, 'parent': parent, 'child': child,
+        'cheque': PaymentInstrument.objects.create(
+            branch=branch, serial_no=1, instrument_type=cheque_type, instrument_name='Cheque'),
+        'cash': PaymentInstrument.objects.create(
+            branch=branch, serial_no=2, instrument_type=cash_type, instrument_name='Cash'),
+        'claim': PaymentInstrument.objects.create(
+            branch=branch, serial_no=3, instrument_type=claim_type, instrument_name='Damage claim'),
+        'invoices': [], 'payments': [], 'claims': [],
+    }
+    add_history(data, invoices, payments)
+    return data
+
+
+def add_history(data, invoices, payments, customers=0):
+    """
+    More rows for the branch of seed_dataset(): unpaid invoices, payments
+    (cheque, cash and claim details, three paid invoices each) and extra
+    parent/child customers with invoices of their own.
+    """
+    branch, child = data['branch'], data['child']
+    for n in range(customers):
+        parent = Customer.objects.create(branch=branch, name=f'Parent {n}', is_parent=True)
+        other = Customer.objects.create(branch=branch, name=f'Child {n}', parent=parent, grace_days=5)
+        CreditInvoice.objects.create(branch=branch, customer=other, transaction_date=date(2025, 1, 5),
+                                     sales_amount=Decimal(50), sales_return=Decimal(0), payment_grace_days=5)
+
+    data['invoices'] += [
+        CreditInvoice.objects.create(
+            branch=branch, customer=child, transaction_date=date(2025, 1, i % 28 + 1),
+            sales_amount=Decimal(100 * (i + 1)), sales_return=Decimal(0), payment_grace_days=10)
+        for i in range(invoices)
+    ]
+    for i in range(payments):
+        payment = Payment.objects.create(branch=branch, customer=data['parent'], received_date=date(2025, 2, i % 28 + 1),
+                                         total_amount=Decimal(300))
+        for n, instrument in enumerate([data['cheque'], data['cash']]):
+            PaymentDetails.objects.create(branch=branch, payment=payment, payment_instrument=instrument,
+                                          id_number=f'P{payment.pk}D{n}', amount=Decimal(100))
+        data['claims'].append(add_claim(data, payment))
+        for n in range(3):
+            CreditInvoice.objects.create(
+                branch=branch, customer=child, transaction_date=date(2025, 1, n + 1), payment=payment,
+                sales_amount=Decimal(100), sales_return=Decimal(0), payment_grace_days=10)
+        data['payments'].append(payment)
+
+
+# Payments added by add_settled_history() are received before this, the rest after
+ARCHIVE_CUTOFF = date(2024, 1, 1)
+
+
+def add_settled_history(data, payments):
+    """
+    Fully settled payments of 2023 for the branch of seed_dataset(): cash and
+    refunded claim details, two paid invoices each. Nothing refers to them
+    after ARCHIVE_CUTOFF, so archive_settled() moves them all.
+    """
+    branch, child = data['branch'], data['child']
+    settled = []
+    for i in range(payments):
+        payment = Payment.objects.create(branch=branch, customer=data['parent'], received_date=date(2023, 3, i % 28 + 1),
+                                         total_amount=Decimal(200))
+        PaymentDetails.objects.create(branch=branch, payment=payment, payment_instrument=data['cash'],
+                                      id_number=f'P{payment.pk}D0', amount=Decimal(100))
+        claim = add_claim(data, payment)
+        claim.submitted_date, claim.refund_date, claim.refund_amount = date(2023, 4, 1), date(2023, 5, 1), claim.claim_amount
+        claim.save()
+        for n in range(2):
+            CreditInvoice.objects.create(
+                branch=branch, customer=child, transaction_date=date(2023, 2, n + 1), payment=payment, status=True,
+                sales_amount=Decimal(100), sales_return=Decimal(0), payment_grace_days=10)
+        settled.append((payment, claim))
+    data.setdefault('settled', []).extend(settled)
+    return settled
+
+
+@override_settings(COMPRESSION_MIN_SIZE=1024)
+class CompressionMiddlewareTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def respond(self, response, accept_encoding):
+        middleware = CompressionMiddleware(lambda request: response)
+        return middleware(self.factory.get('/', HTTP_ACCEPT_ENCODING=accept_encoding))
+
+    def json_response(self, payload):
+        return HttpResponse(ORJSONRenderer().render(payload), content_type='application/json')
+
+    def test_gzip_saves_bytes_on_invoice_list(self):
+        body = ORJSONRenderer().render(invoice_rows(2000))
+        response = self.respond(self.json_response(invoice_rows(2000)), 'gzip, deflate')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), body)
+        self.assertGreater(1 - len(response.content) / len(body), 0.8)
+
+    def test_brotli_preferred_and_smaller_than_gzip(self):
+        if brotli is None:
+            self.skipTest('brotli is not installed')
+        body = ORJSONRenderer().render(invoice_rows(2000))
+        gzipped = self.respond(self.json_response(invoice_rows(2000)), 'gzip')
+        response = self.respond(self.json_response(invoice_rows(2000)), 'gzip, deflate, br')
+
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), body)
+        self.assertLess(len(response.content), len(gzipped.content))
+
+    def test_brotli_length_is_randomised(self):
+        if brotli is None:
+            self.skipTest('brotli is not installed')
+        body = ORJSONRenderer().render(invoice_rows(200))
+        sizes = set()
+        for _ in range(20):
+            response = self.respond(self.json_response(invoice_rows(200)), 'br')
+            self.assertEqual(brotli.decompress(response.content), body)
+            sizes.add(len(response.content))
+        self.assertGreater(len(sizes), 1)
+
+        for content in (b'', b'x', body):
+            with self.subTest(size=len(content)):
+                padded = CompressionMiddleware(lambda request: None).compress(content, 'br')
+                self.assertEqual(brotli.decompress(padded), content)
+
+    def test_small_responses_are_left_alone(self):
+        response = self.respond(self.json_response({'detail': 'ok'}), 'gzip, br')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_content_type_allowlist(self):
+        response = self.respond(HttpResponse(b'\x89PNG' + b'\0' * 4096, content_type='image/png'), 'gzip, br')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_q_zero_refuses_encoding(self):
+        response = self.respond(self.json_response(invoice_rows(200)), 'br;q=0, gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_streaming_export_is_compressed(self):
+        rows = [f'{r["grn"]},{r["customer_name"]},{r["sales_amount"]}\n'.encode() for r in invoice_rows(2000)]
+        response = self.respond(StreamingHttpResponse(iter(rows), content_type='text/csv'), 'gzip')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        compressed = b''.join(response.streaming_content)
+        self.assertEqual(gzip.decompress(compressed), b''.join(rows))
+        self.assertLess(len(compressed), len(b''.join(rows)) / 3)
+
+    def test_streaming_export_brotli(self):
+        if brotli is None:
+            self.skipTest('brotli is not installed')
+        rows = [f'{r["grn"]},{r["customer_name"]}\n'.encode() for r in invoice_rows(500)]
+        response = self.respond(StreamingHttpResponse(iter(rows), content_type='text/csv'), 'br')
+
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(b''.join(response.streaming_content)), b''.join(rows))
+
+    def test_already_encoded_response_untouched(self):
+        response = self.json_response(invoice_rows(200))
+        response['Content-Encoding'] = 'gzip'
+        content = response.content
+        self.assertEqual(self.respond(response, 'gzip, br').content, content)
+
+
+def add_claim(data, payment=None):
+    """A claim detail of 100 on `payment` (a new one when omitted) and its claim."""
+    branch = data['branch']
+    if payment is None:
+        payment = Payment.objects.create(branch=branch, customer=data['parent'], received_date=date(2025, 2, 1),
+                                         total_amount=Decimal(100))
+    detail = PaymentDetails.objects.create(branch=branch, payment=payment, payment_instrument=data['claim'],
+                                           id_number=f'P{payment.pk}C', amount=Decimal(100))
+    return Claim.objects.create(branch=branch, payment_details=detail, customer=data['parent'],
+                                claim_amount=detail.amount, claim_date=payment.received_date)
+
+
+class QueryShapeTests(SimpleTestCase):
+    def test_shape_ignores_literals_and_in_list_length(self):
+        self.assertEqual(
+            query_shape('SELECT * FROM "customer" WHERE "customer"."id" IN (%s, %s, %s)'),
+            query_shape('SELECT * FROM "customer" WHERE "customer"."id" IN (%s)'),
+        )
+        self.assertEqual(
+            query_shape("SELECT * FROM t WHERE name = 'a' AND id = 7"),
+            query_shape("SELECT * FROM t WHERE name = 'it''s' AND id = 12"),
+        )
+
+    def test_tracker_reports_shapes_at_threshold(self):
+        tracker = QueryShapeTracker(threshold=3)
+        for _ in range(3):
+            tracker.add('SELECT * FROM "customer" WHERE "customer"."id" = %s')
+        tracker.add('SELECT * FROM "branch" WHERE "branch"."id" = %s')
+        tracker.add('UPDATE "customer" SET "name" = %s')
+        tracker.add('UPDATE "customer" SET "name" = %s')
+        tracker.add('UPDATE "customer" SET "name" = %s')
+
+        repeated = tracker.repeated()
+        self.assertEqual(len(repeated), 1)
+        self.assertEqual(repeated[0][0], 3)
+        self.assertIn('"customer"', repeated[0][2])
+
+
+@override_settings(NPLUSONE_DETECTION='raise', NPLUSONE_THRESHOLD=3)
+class NPlusOneDetectionTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=6)
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def test_detector_names_the_serializer_field(self):
+        def view(request):
+            # No select_related: one customer query per invoice
+            CreditInvoiceSerializer(CreditInvoice.objects.order_by('pk'), many=True).data
+            return HttpResponse()
+
+        with self.assertRaises(NPlusOneError) as raised:
+            PerformanceMiddleware(view)(RequestFactory().get('/'))
+        self.assertIn('CreditInvoiceSerializer.customer', str(raised.exception))
+
+    def test_log_mode_does_not_fail_the_request(self):
+        def view(request):
+            CreditInvoiceSerializer(CreditInvoice.objects.order_by('pk'), many=True).data
+            return HttpResponse()
+
+        with override_settings(NPLUSONE_DETECTION='log'), self.assertLogs('cheques.nplusone', 'WARNING'):
+            response = PerformanceMiddleware(view)(RequestFactory().get('/'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_credit_invoice_list(self):
+        response = self.client.get('/v1/chq/credit-invoices/', {'branch': self.data['branch'].alias_id})
+        self.assertEqual(response.status_code, 200)
+
+    def test_payment_retrieve(self):
+        payment = self.data['payments'][0]
+        response = self.client.get(f'/v1/chq/payments/{payment.alias_id}/', {'expand': 'payment_details,invoices'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['payment_details']), 3)
+
+    def test_payment_list_expanded(self):
+        response = self.client.get('/v1/chq/payments/', {'expand': 'payment_details,invoices'})
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(METRICS_TOKEN='scrape-token', METRICS_SERVER_TIMING=True)
+class MetricsTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=3)
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def scrape(self, token='scrape-token'):
+        return self.client.get('/metrics', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_metrics_needs_the_token(self):
+        self.assertEqual(self.scrape('wrong').status_code, 404)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.scrape('').status_code, 404)
+
+    def test_metrics_reports_endpoint_histograms(self):
+        self.client.get('/v1/chq/credit-invoices/', {'branch': self.data['branch'].alias_id})
+        response = self.scrape()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE chequestore_request_duration_seconds histogram', body)
+        self.assertRegex(body, r'chequestore_request_duration_seconds_count\{endpoint="CreditInvoiceViewSet.list"\} [1-9]')
+        self.assertRegex(body, r'chequestore_db_queries_bucket\{endpoint="CreditInvoiceViewSet.list",le="\+Inf"\} [1-9]')
+
+    def test_server_timing_header(self):
+        response = self.client.get('/v1/chq/credit-invoices/', {'branch': self.data['branch'].alias_id})
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="[1-9]\d* queries", ser;dur=[\d.]+, render;dur=[\d.]+, total;dur=[\d.]+$')
+        with override_settings(METRICS_SERVER_TIMING=False):
+            response = self.client.get('/v1/chq/credit-invoices/', {'branch': self.data['branch'].alias_id})
+        self.assertNotIn('Server-Timing', response)
+
+    def test_slow_requests_are_logged(self):
+        def view(request):
+            list(CreditInvoice.objects.all())
+            return HttpResponse()
+
+        with override_settings(SLOW_REQUEST_MS=0, SLOW_REQUEST_SAMPLE_RATE=1.0), \
+                self.assertLogs('cheques.slow_requests', 'WARNING') as logs:
+            PerformanceMiddleware(view)(RequestFactory().get('/slow/'))
+        self.assertIn('GET /slow/ 200', logs.output[0])
+        self.assertIn('db=', logs.output[0])
+        self.assertIn('/1 queries', logs.output[0])
+
+    def test_queries_are_counted_not_kept(self):
+        request_metrics, token = metrics.begin()
+        try:
+            list(CreditInvoice.objects.all())
+            list(Customer.objects.all())
+        finally:
+            metrics.end(token)
+        self.assertEqual(request_metrics.query_count, 2)
+        self.assertGreater(request_metrics.db_time, 0)
+        self.assertFalse(hasattr(request_metrics, 'queries'))
+
+    def test_worker_key_follows_the_pid(self):
+        # preload_app imports this module in the master; forked workers must
+        # not share its key
+        registry = metrics.Registry()
+        with mock.patch('cheques.metrics.os.getpid', return_value=100):
+            master_key = registry.worker_key
+        with mock.patch('cheques.metrics.os.getpid', return_value=101):
+            worker_key = registry.worker_key
+            registry.maybe_flush(force=True)
+        self.assertTrue(master_key.endswith(':100'))
+        self.assertTrue(worker_key.endswith(':101'))
+        self.assertIn(worker_key, cache.get('metrics:workers'))
+        self.assertNotIn(master_key, cache.get('metrics:workers'))
+
+
+# Most queries each endpoint may run, with cold caches. Every route of
+# src/urls.py and cheques/urls.py is listed (keys are ViewClass.action, as in
+# the /metrics labels); None marks routes that can't be exercised. Raising
+# a budget should be a reviewed decision, not a side effect.
+QUERY_BUDGETS = {
+    'APIRootView.get': 0,
+    'BranchViewSet.list': 1,
+    'BranchViewSet.create': 1,
+    'BranchViewSet.retrieve': 1,
+    'BranchViewSet.update': 2,
+    'BranchViewSet.partial_update': 2,
+    'BranchViewSet.destroy': 14,
+    'CustomerViewSet.list': 2,
+    'CustomerViewSet.create': 3,
+    'CustomerViewSet.retrieve': 2,
+    'CustomerViewSet.update': 5,
+    'CustomerViewSet.partial_update': 3,
+    'CustomerViewSet.destroy': 9,
+    'CustomerViewSet.tree': 2,
+    'CreditInvoiceViewSet.list': 3,
+    'CreditInvoiceViewSet.create': 6,
+    'CreditInvoiceViewSet.retrieve': 2,
+    'CreditInvoiceViewSet.update': 5,
+    'CreditInvoiceViewSet.partial_update': 3,
+    'CreditInvoiceViewSet.destroy': 2,
+    'PaymentInstrumentTypeViewSet.list': 2,
+    'PaymentInstrumentTypeViewSet.retrieve': 1,
+    'PaymentInstrumentsViewSet.list': 2,
+    'PaymentInstrumentsViewSet.create': 3,
+    'PaymentInstrumentsViewSet.retrieve': 1,
+    'PaymentInstrumentsViewSet.update': 4,
+    'PaymentInstrumentsViewSet.partial_update': 2,
+    'PaymentInstrumentsViewSet.destroy': 4,
+    'PaymentViewSet.list': 2,
+    'PaymentViewSet.create': 19,
+    'PaymentViewSet.retrieve': 4,
+    'PaymentViewSet.update': 16,
+    'PaymentViewSet.partial_update': 15,
+    'PaymentViewSet.destroy': 6,
+    'PaymentViewSet.allocate': 2,
+    'ClaimViewSet.list': 2,
+    # Claims are opened by PaymentViewSet.create; ClaimListSerializer has no payment_details to create one from
+    'ClaimViewSet.create': None,
+    'ClaimViewSet.retrieve': 1,
+    'ClaimViewSet.update': 2,
+    'ClaimViewSet.partial_update': 2,
+    'ClaimViewSet.destroy': 2,
+    'ClaimViewSet.update_claim': 2,
+    'ClaimViewSet.settle_refunds': 5,
+    'ClaimViewSet.summary': 2,
+    'ParentCustomerDueReport.get': 3,
+    'CustomerViewSet.statement': 3,
+    'ArchivedCreditInvoiceViewSet.list': 3,
+    'ArchivedCreditInvoiceViewSet.retrieve': 2,
+    'ArchivedPaymentViewSet.list': 5,
+    'ArchivedPaymentViewSet.retrieve': 4,
+    'ArchivedClaimViewSet.list': 3,
+    'ArchivedClaimViewSet.retrieve': 1,
+    'CustomTokenObtainPairView.post': 2,
+    'TokenRefreshView.post': 1,
+    'user_detail.get': 0,
+    'metrics.get': 0,
+}
+
+# Django admin and media serving are not ours to budget
+UNBUDGETED_PREFIXES = ('admin/', '^media/')
+
+
+def project_routes(patterns=None, prefix=''):
+    """(route, endpoint name) for every method of every URL pattern."""
+    from django.urls import URLResolver, get_resolver
+    for pattern in get_resolver().url_patterns if patterns is None else patterns:
+        route = prefix + str(pattern.pattern)
+        if route.startswith(UNBUDGETED_PREFIXES):
+            continue
+        if isinstance(pattern, URLResolver):
+            yield from project_routes(pattern.url_patterns, route)
+            continue
+        view = pattern.callback
+        view_class = getattr(view, 'cls', None) or getattr(view, 'view_class', None)
+        if getattr(view, 'actions', None):
+            actions = view.actions.values()
+        elif view_class is not None:
+            actions = [m for m in view_class.http_method_names if m not in ('head', 'options') and hasattr(view_class, m)]
+        else:
+            actions = ['get']
+        name = view_class.__name__ if view_class else pattern.name
+        for action in actions:
+            yield route, f'{name}.{action}'
+
+
+@override_settings(NPLUSONE_DETECTION='raise', METRICS_TOKEN='scrape')
+class QueryBudgetTests(TestCase):
+    """
+    Every endpoint runs once on a small dataset and once after more rows were
+    added; its query count has to stay within QUERY_BUDGETS and must not
+    grow with the data.
+    """
+
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=4, payments=2)
+        add_settled_history(self.data, payments=2)
+        archive_settled(ARCHIVE_CUTOFF)
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def test_every_route_has_a_budget(self):
+        endpoints = {endpoint for _, endpoint in project_routes()}
+        self.assertEqual(endpoints - set(QUERY_BUDGETS), set(), 'routes without a query budget')
+        self.assertEqual(set(QUERY_BUDGETS) - endpoints, set(), 'budgets of routes that no longer exist')
+
+    def endpoint_requests(self, round_no):
+        """endpoint -> (method, url, payload); objects that get deleted or consumed are made per round."""
+        data = self.data
+        branch, parent, child = data['branch'], data['parent'], data['child']
+        alias = branch.alias_id
+        invoice = data['invoices'][0]
+        payment = data['payments'][0]
+        claim = data['claims'][0]
+        archived_payment, archived_claim = data['settled'][0]
+        archived_invoice = ArchivedCreditInvoice.objects.filter(payment_id=archived_payment.pk).first()
+        instrument = data['cheque']
+        refresh_token = str(RefreshToken.for_user(data['user']))
+        unpaid = [i.alias_id for i in data['invoices'][2 * round_no + 1:2 * round_no + 3]]
+        for model in (branch, invoice, payment, claim, instrument):
+            model.refresh_from_db()
+
+        spare_branch = Branch.objects.create(name=f'Spare {round_no}')
+        spare_customer = Customer.objects.create(branch=branch, name=f'Spare {round_no}')
+        spare_invoice = CreditInvoice.objects.create(
+            branch=branch, customer=child, transaction_date=date(2025, 3, 1),
+            sales_amount=Decimal(10), sales_return=Decimal(0))
+        spare_instrument = PaymentInstrument.objects.create(
+            branch=branch, serial_no=9, instrument_type=data['cheque'].instrument_type, instrument_name='Spare')
+        spare_payment = Payment.objects.create(branch=branch, customer=parent, received_date=date(2025, 3, 1))
+        spare_claim = add_claim(data)
+
+        payment_body = {
+            'branch': alias, 'customer': parent.alias_id, 'received_date': '2025-03-01',
+            'payment_details': [
+                {'payment_instrument': data['cash'].id, 'amount': '100'},
+                {'payment_instrument': data['cheque'].id, 'amount': '100', 'id_number': f'NEW{round_no}'},
+                {'payment_instrument': data['claim'].id, 'amount': '10'},
+            ],
+            'invoices': [{'alias_id': alias_id} for alias_id in unpaid],
+            'total_amount': '210', 'cash_equivalent_amount': '100', 'shortage_amount': '0',
+        }
+        payment_update = {
+            'branch': alias, 'customer': parent.alias_id, 'received_date': str(payment.received_date),
+            'payment_details': [
+                {'alias_id': d.alias_id, 'payment_instrument': d.payment_instrument_id,
+                 'id_number': d.id_number, 'amount': str(d.amount + 1)}
+                for d in payment.paymentdetails_set.all()
+            ],
+            'invoices': [{'alias_id': i.alias_id} for i in payment.invoice_set.all()],
+            'total_amount': '300', 'version': payment.version,
+        }
+        invoice_body = {
+            'branch': alias, 'customer': child.alias_id, 'grn': 'GRN-1', 'transaction_date': '2025-03-02',
+            'sales_amount': '250', 'sales_return': '0',
+        }
+        instrument_body = {
+            'branch': branch.id, 'serial_no': 1, 'instrument_type': instrument.instrument_type_id,
+            'instrument_name': 'Cheque', 'is_active': True,
+        }
+        refund = {'submitted_date': '2025-03-01', 'refund_amount': '10', 'refund_date': '2025-03-05'}
+
+        api = '/v1/chq'
+        return {
+            'APIRootView.get': ('get', f'{api}/', None),
+            'BranchViewSet.list': ('get', f'{api}/branches/', None),
+            'BranchViewSet.create': ('post', f'{api}/branches/', {'name': 'New', 'branch_type': 2}),
+            'BranchViewSet.retrieve': ('get', f'{api}/branches/{alias}/', None),
+            'BranchViewSet.update': ('put', f'{api}/branches/{alias}/',
+                                     {'name': 'Main', 'branch_type': 1, 'version': branch.version}),
+            'BranchViewSet.partial_update': ('patch', f'{api}/branches/{alias}/',
+                                             {'contact': '555', 'version': branch.version + 1}),
+            'BranchViewSet.destroy': ('delete', f'{api}/branches/{spare_branch.alias_id}/', None),
+            'CustomerViewSet.list': ('get', f'{api}/customers/?branch={alias}', None),
+            'CustomerViewSet.create': ('post', f'{api}/customers/', {'branch': alias, 'name': 'New', 'is_parent': True}),
+            'CustomerViewSet.retrieve': ('get', f'{api}/customers/{child.alias_id}/', None),
+            'CustomerViewSet.update': ('put', f'{api}/customers/{child.alias_id}/', {
+                'branch': alias, 'name': 'Child', 'parent': parent.alias_id, 'grace_days': 10, 'is_active': True}),
+            'CustomerViewSet.partial_update': ('patch', f'{api}/customers/{child.alias_id}/',
+                                               {'phone': '555', 'is_active': True}),
+            'CustomerViewSet.destroy': ('delete', f'{api}/customers/{spare_customer.alias_id}/', None),
+            'CustomerViewSet.tree': ('get', f'{api}/customers/tree/?branch={alias}', None),
+            'CreditInvoiceViewSet.list': ('get', f'{api}/credit-invoices/?branch={alias}', None),
+            'CreditInvoiceViewSet.create': ('post', f'{api}/credit-invoices/', invoice_body),
+            'CreditInvoiceViewSet.retrieve': ('get', f'{api}/credit-invoices/{invoice.alias_id}/', None),
+            'CreditInvoiceViewSet.update': ('put', f'{api}/credit-invoices/{invoice.alias_id}/',
+                                            dict(invoice_body, version=invoice.version)),
+            'CreditInvoiceViewSet.partial_update': ('patch', f'{api}/credit-invoices/{invoice.alias_id}/',
+                                                    {'grn': 'GRN-2', 'version': invoice.version + 1}),
+            'CreditInvoiceViewSet.destroy': ('delete', f'{api}/credit-invoices/{spare_invoice.alias_id}/', None),
+            'PaymentInstrumentTypeViewSet.list': ('get', f'{api}/PaymentInstrumentType/?branch={alias}', None),
+            'PaymentInstrumentTypeViewSet.retrieve': (
+                'get', f'{api}/PaymentInstrumentType/{instrument.instrument_type_id}/', None),
+            'PaymentInstrumentsViewSet.list': ('get', f'{api}/payment-instruments/?branch={alias}', None),
+            'PaymentInstrumentsViewSet.create': ('post', f'{api}/payment-instruments/',
+                                                 dict(instrument_body, serial_no=10 + round_no, instrument_name='New')),
+            'PaymentInstrumentsViewSet.retrieve': ('get', f'{api}/payment-instruments/{instrument.id}/', None),
+            'PaymentInstrumentsViewSet.update': ('put', f'{api}/payment-instruments/{instrument.id}/',
+                                                 dict(instrument_body, version=instrument.version)),
+            'PaymentInstrumentsViewSet.partial_update': ('patch', f'{api}/payment-instruments/{instrument.id}/',
+                                                         {'instrument_name': 'Cheques', 'version': instrument.version + 1}),
+            'PaymentInstrumentsViewSet.destroy': ('delete', f'{api}/payment-instruments/{spare_instrument.id}/', None),
+            'PaymentViewSet.list': ('get', f'{api}/payments/?branch={alias}', None),
+            'PaymentViewSet.create': ('post', f'{api}/payments/', payment_body),
+            'PaymentViewSet.retrieve': ('get', f'{api}/payments/{payment.alias_id}/', None),
+            'PaymentViewSet.update': ('put', f'{api}/payments/{payment.alias_id}/', payment_update),
+            'PaymentViewSet.partial_update': ('patch', f'{api}/payments/{payment.alias_id}/',
+                                              dict(payment_update, version=payment.version + 1)),
+            'PaymentViewSet.destroy': ('delete', f'{api}/payments/{spare_payment.alias_id}/', None),
+            'PaymentViewSet.allocate': (
+                'get', f'{api}/payments/allocate/?branch={alias}&customer={parent.alias_id}&amount=300', None),
+            'ClaimViewSet.list': ('get', f'{api}/claims/?branch={alias}', None),
+            'ClaimViewSet.retrieve': ('get', f'{api}/claims/{claim.alias_id}/', None),
+            'ClaimViewSet.update': ('put', f'{api}/claims/{claim.alias_id}/',
+                                    dict(refund, remarks='Put', version=claim.version)),
+            'ClaimViewSet.partial_update': ('patch', f'{api}/claims/{claim.alias_id}/',
+                                            {'remarks': 'Patch', 'version': claim.version + 1}),
+            'ClaimViewSet.destroy': ('delete', f'{api}/claims/{spare_claim.alias_id}/', None),
+            'ClaimViewSet.update_claim': ('patch', f'{api}/claims/{claim.alias_id}/update_claim/',
+                                          dict(refund, version=claim.version + 2)),
+            'ClaimViewSet.settle_refunds': ('post', f'{api}/claims/settle_refunds/', {
+                'branch': alias,
+                'rows': [dict(refund, claim=c.alias_id) for c in data['claims'][1:3]],
+            }),
+            'ClaimViewSet.summary': ('get', f'{api}/claims/summary/?branch={alias}', None),
+            'ParentCustomerDueReport.get': ('get', f'{api}/parent-customer-due-report/?branch={alias}', None),
+            'CustomerViewSet.statement': (
+                'get', f'{api}/customers/{parent.alias_id}/statement/?date_from=2025-01-01', None),
+            'ArchivedCreditInvoiceViewSet.list': ('get', f'{api}/archive/credit-invoices/?branch={alias}', None),
+            'ArchivedCreditInvoiceViewSet.retrieve': (
+                'get', f'{api}/archive/credit-invoices/{archived_invoice.alias_id}/', None),
+            'ArchivedPaymentViewSet.list': ('get', f'{api}/archive/payments/?branch={alias}', None),
+            'ArchivedPaymentViewSet.retrieve': ('get', f'{api}/archive/payments/{archived_payment.alias_id}/', None),
+            'ArchivedClaimViewSet.list': ('get', f'{api}/archive/claims/?branch={alias}', None),
+            'ArchivedClaimViewSet.retrieve': ('get', f'{api}/archive/claims/{archived_claim.alias_id}/', None),
+            'CustomTokenObtainPairView.post': ('post', f'{api}/token/', {'username': 'cashier', 'password': 'secret'}),
+            'TokenRefreshView.post': ('post', f'{api}/token/refresh/', {'refresh': refresh_token}),
+            'user_detail.get': ('get', f'{api}/user/', None),
+            'metrics.get': ('get', '/metrics', None),
+        }
+
+    def measure(self, round_no):
+        counts = {}
+        for endpoint, (method, url, payload) in self.endpoint_requests(round_no).items():
+            reset_caches()
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(self.client, method)(
+                    url, payload, format='json', HTTP_AUTHORIZATION='Bearer scrape')
+            self.assertLess(response.status_code, 400, f'{endpoint}: {response.content[:500]}')
+            counts[endpoint] = len(queries)
+        return counts
+
+    def test_query_budgets(self):
+        small = self.measure(0)
+        add_history(self.data, invoices=20, payments=8, customers=5)
+        add_settled_history(self.data, payments=8)
+        archive_settled(ARCHIVE_CUTOFF)
+        large = self.measure(1)
+
+        for endpoint, budget in QUERY_BUDGETS.items():
+            if budget is None:
+                continue
+            with self.subTest(endpoint):
+                self.assertLessEqual(large[endpoint], budget)
+                self.assertEqual(large[endpoint], small[endpoint], 'query count grows with the data')
+
+
+@override_settings(REPLICA_READS=True, REPLICA_STICKY_SECONDS=60)
+class ReplicaRoutingTests(TransactionTestCase):
+    # The replica alias mirrors the test database, so committed rows are visible through it
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        reset_caches()
+        self.branch = Branch.objects.create(name='Main', branch_type=1)
+        self.parent = Customer.objects.create(branch=self.branch, name='Parent', is_parent=True)
+        self.cashier_user = User.objects.create_user('cashier')
+        self.cashier = APIClient()
+        self.cashier.force_authenticate(self.cashier_user)
+        self.manager = APIClient()
+        self.manager.force_authenticate(User.objects.create_user('manager'))
+        # Writes made while setting up don't count
+        cache.clear()
+
+    def reads(self, client, path, table):
+        """(primary, replica): whether the request read `table` on each alias."""
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = client.get(path, {'branch': self.branch.alias_id})
+        self.assertEqual(response.status_code, 200)
+        return (any(f'"{table}"' in q['sql'] for q in primary.captured_queries),
+                any(f'"{table}"' in q['sql'] for q in replica.captured_queries))
+
+    def test_router(self):
+        router = PrimaryReplicaRouter()
+        self.assertEqual(router.db_for_write(Customer), 'default')
+        self.assertIsNone(router.db_for_read(Customer))
+        with db_router.reads_from('replica'):
+            self.assertEqual(router.db_for_read(Customer), 'replica')
+            # Related rows come from where their instance was read
+            self.assertEqual(router.db_for_read(Branch, instance=self.parent), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'cheques'))
+        self.assertTrue(router.allow_migrate('default', 'cheques'))
+
+    def test_lists_read_from_the_replica(self):
+        table = Customer._meta.db_table
+        self.assertEqual(self.reads(self.cashier, '/v1/chq/customers/', table), (False, True))
+        self.assertEqual(self.reads(self.cashier, '/v1/chq/parent-customer-due-report/', table), (False, True))
+
+    def test_writes_pin_the_writer_to_the_primary(self):
+        table = Customer._meta.db_table
+        response = self.cashier.post('/v1/chq/customers/', {'branch': self.branch.alias_id, 'name': 'New'})
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(self.reads(self.cashier, '/v1/chq/customers/', table), (True, False))
+        self.assertEqual(self.reads(self.manager, '/v1/chq/customers/', table), (False, True))
+
+        # The window is over
+        cache.delete(f'db-written:{db_router.user_key(self.cashier_user.pk)}')
+        self.assertEqual(self.reads(self.cashier, '/v1/chq/customers/', table), (False, True))
+
+    def test_cache_fills_after_a_write_read_from_the_primary(self):
+        # The customer write bumps the 'dues' namespace; the report cached next
+        # must not come from a replica that may not have the customer yet
+        self.cashier.post('/v1/chq/customers/', {'branch': self.branch.alias_id, 'name': 'New'})
+        table = Customer._meta.db_table
+        self.assertEqual(self.reads(self.manager, '/v1/chq/parent-customer-due-report/', table), (True, False))
+
+
+class PaymentDetailsReceivedDateTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=2, payments=1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def test_details_follow_the_payment_date(self):
+        payment = self.data['payments'][0]
+        self.assertEqual({d.received_date for d in payment.paymentdetails_set.all()}, {payment.received_date})
+
+        response = self.client.put(f'/v1/chq/payments/{payment.alias_id}/', {
+            'received_date': '2025-04-30', 'version': payment.version,
+            'payment_details': [
+                {'alias_id': d.alias_id, 'payment_instrument': d.payment_instrument_id,
+                 'id_number': d.id_number, 'amount': str(d.amount)}
+                for d in payment.paymentdetails_set.all()
+            ],
+            'invoices': [{'alias_id': i.alias_id} for i in payment.invoice_set.all()],
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual({d.received_date for d in payment.paymentdetails_set.all()}, {date(2025, 4, 30)})
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=2, payments=1)
+        self.settled = add_settled_history(self.data, payments=2)
+        branch, parent = self.data['branch'], self.data['parent']
+        # Old enough, but one claim is still open and the other was refunded after the cutoff
+        self.open_claim = add_claim(self.data, Payment.objects.create(
+            branch=branch, customer=parent, received_date=date(2023, 6, 1), total_amount=Decimal(100)))
+        self.late_claim = add_claim(self.data, Payment.objects.create(
+            branch=branch, customer=parent, received_date=date(2023, 7, 1), total_amount=Decimal(100)))
+        self.late_claim.submitted_date, self.late_claim.refund_date = date(2023, 8, 1), date(2024, 2, 1)
+        self.late_claim.refund_amount = self.late_claim.claim_amount
+        self.late_claim.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def statement(self):
+        response = self.client.get(f"/v1/chq/customers/{self.data['parent'].alias_id}/statement/")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_settled_history_moves_to_the_archive(self):
+        before = self.statement()
+        payment_ids = [payment.pk for payment, _ in self.settled]
+
+        totals = archive_settled(ARCHIVE_CUTOFF)
+
+        self.assertEqual(totals, {'payment': 2, 'payment_details': 4, 'claim': 2, 'credit_invoice': 4})
+        self.assertFalse(Payment.objects.filter(pk__in=payment_ids).exists())
+        self.assertFalse(PaymentDetails.objects.filter(payment_id__in=payment_ids).exists())
+        self.assertFalse(CreditInvoice.objects.filter(payment_id__in=payment_ids).exists())
+        self.assertFalse(Claim.objects.filter(pk__in=[claim.pk for _, claim in self.settled]).exists())
+        self.assertEqual(ArchivedPayment.objects.filter(pk__in=payment_ids).count(), 2)
+        self.assertEqual(ArchivedPaymentDetails.objects.filter(payment_id__in=payment_ids).count(), 4)
+        self.assertEqual(set(ArchivedClaim.objects.values_list('alias_id', flat=True)),
+                         {claim.alias_id for _, claim in self.settled})
+        self.assertEqual(Claim.objects.filter(pk__in=[self.open_claim.pk, self.late_claim.pk]).count(), 2)
+        self.assertEqual(Payment.objects.count(), 3)
+
+        # Statements read the archive too, so nothing changes for them
+        after = self.statement()
+        self.assertEqual(after['closing_balance'], before['closing_balance'])
+        self.assertEqual([line['document'] for line in after['lines']], [line['document'] for line in before['lines']])
+        self.assertEqual(sum(line['archived'] for line in after['lines']), 6)
+        self.assertEqual(archive_settled(ARCHIVE_CUTOFF)['payment'], 0)
+
+    def test_statement_opening_balance_includes_archived_history(self):
+        archive_settled(ARCHIVE_CUTOFF)
+        url = f"/v1/chq/customers/{self.data['parent'].alias_id}/statement/"
+
+        # Before Mar 2, 2023: the four archived invoices (400) less the Mar 1 payment (200)
+        response = self.client.get(url, {'date_from': '2023-03-02'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['opening_balance'], '200.0000')
+        self.assertEqual(response.json()['closing_balance'], self.statement()['closing_balance'])
+        self.assertEqual([line['archived'] for line in response.json()['lines']][:1], [True])
+
+        response = self.client.get(url, {'date_from': '2023-06-01'})
+        self.assertEqual(response.json()['opening_balance'], '0.0000')
+        self.assertFalse(any(line['archived'] for line in response.json()['lines']))
+        self.assertEqual(self.client.get(url, {'date_from': 'March'}).status_code, 400)
+
+    def test_archive_endpoints_are_read_only(self):
+        archive_settled(ARCHIVE_CUTOFF)
+        payment, claim = self.settled[0]
+
+        response = self.client.get(f'/v1/chq/archive/payments/{payment.alias_id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['payment_details']), 2)
+        self.assertEqual(len(response.json()['invoices']), 2)
+        response = self.client.get('/v1/chq/archive/claims/', {'customer': self.data['parent'].alias_id})
+        self.assertEqual(response.json()['count'], 2)
+        response = self.client.get('/v1/chq/archive/credit-invoices/', {'date_to': '2023-02-01'})
+        self.assertEqual(response.json()['count'], 2)
+
+        self.assertEqual(self.client.delete(f'/v1/chq/archive/payments/{payment.alias_id}/').status_code, 405)
+        self.assertEqual(self.client.post('/v1/chq/archive/claims/', {}).status_code, 405)
+
+    def test_command_dry_run_moves_nothing(self):
+        older_than = str((timezone.localdate() - ARCHIVE_CUTOFF).days)
+        out = StringIO()
+        call_command('archive_history', '--older-than', older_than, '--dry-run', stdout=out)
+        self.assertIn('payment: 2', out.getvalue())
+        self.assertFalse(ArchivedPayment.objects.exists())
+
+        call_command('archive_history', '--older-than', older_than, stdout=out)
+        self.assertEqual(ArchivedPayment.objects.count(), 2)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'table partitioning needs PostgreSQL')
+class PartitionPruningTests(TestCase):
+    def setUp(self):
+        self.data = seed_dataset(invoices=0, payments=0)
+        self.month = partitions.month_start(timezone.localdate())
+        self.next_month = partitions.add_months(self.month, 1)
+
+    def scanned(self, queryset, table):
+        """Partitions of `table` in the query plan."""
+        plan = queryset.explain()
+        return {name for name in re.findall(rf'\b{table}_(?:p\d{{4}}_\d{{2}}|default)\b', plan)}
+
+    def test_date_filters_scan_only_their_months(self):
+        branch, child, parent = self.data['branch'], self.data['child'], self.data['parent']
+        for day in (self.month, self.next_month):
+            CreditInvoice.objects.create(branch=branch, customer=child, transaction_date=day,
+                                         sales_amount=Decimal(100), sales_return=Decimal(0))
+            payment = Payment.objects.create(branch=branch, customer=parent, received_date=day)
+            PaymentDetails.objects.create(branch=branch, payment=payment, payment_instrument=self.data['cash'],
+                                          id_number=f'CH{day.month:02d}', amount=Decimal(100))
+
+        in_month = {'gte': self.month, 'lt': self.next_month}
+        for model, column in ((CreditInvoice, 'transaction_date'), (Payment, 'received_date'),
+                              (PaymentDetails, 'received_date')):
+            with self.subTest(model.__name__):
+                queryset = model.objects.filter(**{f'{column}__{op}': day for op, day in in_month.items()})
+                self.assertEqual(self.scanned(queryset, model._meta.db_table),
+                                 {partitions.partition_name(model._meta.db_table, self.month)})
+
+    def test_rows_outside_the_partitions_move_out_of_the_default_partition(self):
+        old_month = partitions.add_months(self.month, -60)
+        invoice = CreditInvoice.objects.create(
+            branch=self.data['branch'], customer=self.data['child'], transaction_date=old_month,
+            sales_amount=Decimal(100), sales_return=Decimal(0))
+        self.assertEqual(self.scanned(CreditInvoice.objects.filter(transaction_date=old_month), 'credit_invoice'),
+                         {'credit_invoice_default'})
+
+        # Run the deferred foreign key checks of the rows above, as a commit would,
+        # before the partition is attached
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        created = partitions.ensure_partitions(connection)
+        old_partition = partitions.partition_name('credit_invoice', old_month)
+        self.assertIn(old_partition, created)
+        self.assertEqual(self.scanned(CreditInvoice.objects.filter(transaction_date=old_month), 'credit_invoice'),
+                         {old_partition})
+        self.assertTrue(CreditInvoice.objects.filter(pk=invoice.pk).exists())
+        self.assertEqual(partitions.ensure_partitions(connection), [])
+
+    def test_id_numbers_stay_unique_per_branch_across_partitions(self):
+        branch, parent = self.data['branch'], self.data['parent']
+        first = Payment.objects.create(branch=branch, customer=parent, received_date=self.month)
+        later = Payment.objects.create(branch=branch, customer=parent, received_date=self.next_month)
+        PaymentDetails.objects.create(branch=branch, payment=first, payment_instrument=self.data['cheque'],
+                                      id_number='000123', amount=Decimal(10))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            PaymentDetails.objects.create(branch=branch, payment=later, payment_instrument=self.data['cheque'],
+                                          id_number='000123', amount=Decimal(10))
+
+    def test_alias_ids_stay_unique_across_partitions(self):
+        branch, parent = self.data['branch'], self.data['parent']
+        first = Payment.objects.create(branch=branch, customer=parent, received_date=self.month)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Payment.objects.create(branch=branch, customer=parent, received_date=self.next_month,
+                                   alias_id=first.alias_id)
+        invoice = CreditInvoice.objects.create(branch=branch, customer=self.data['child'], transaction_date=self.month,
+                                               sales_amount=Decimal(100), sales_return=Decimal(0))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CreditInvoice.objects.create(branch=branch, customer=self.data['child'], transaction_date=self.next_month,
+                                         sales_amount=Decimal(100), sales_return=Decimal(0), alias_id=invoice.alias_id)
+        # A row moving to another month keeps its alias_id, a deleted one releases it
+        first.received_date = self.next_month
+        first.save()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Payment.objects.create(branch=branch, customer=parent, received_date=self.month, alias_id=first.alias_id)
+        first.delete()
+        Payment.objects.create(branch=branch, customer=parent, received_date=self.month, alias_id=first.alias_id)
+
+
+class SparseFieldsetTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=2, payments=2)
+        self.payment = self.data['payments'][0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def test_list_is_slim_until_expanded(self):
+        rows = self.client.get('/v1/chq/payments/').json()
+        self.assertNotIn('payment_details', rows[0])
+        self.assertEqual(rows[0]['details_count'], 3)
+
+        rows = self.client.get('/v1/chq/payments/', {'expand': 'invoices'}).json()
+        self.assertEqual(len(rows[0]['invoices']), 3)
+        self.assertNotIn('payment_details', rows[0])
+
+    def test_fields_limit_retrieve_including_expandable_fields(self):
+        url = f'/v1/chq/payments/{self.payment.alias_id}/'
+        self.assertIn('payment_details', self.client.get(url).json())
+
+        response = self.client.get(url, {'fields': 'alias_id,received_date'})
+        self.assertEqual(set(response.json()), {'alias_id', 'received_date'})
+
+        response = self.client.get(url, {'fields': 'alias_id', 'expand': 'invoices'})
+        self.assertEqual(set(response.json()), {'alias_id', 'invoices'})
+
+    def test_summary_columns_only_on_reads(self):
+        payment = self.payment
+        response = self.client.patch(f'/v1/chq/payments/{payment.alias_id}/', {
+            'branch': self.data['branch'].alias_id, 'customer': self.data['parent'].alias_id,
+            'received_date': str(payment.received_date), 'version': payment.version,
+            'payment_details': [
+                {'alias_id': d.alias_id, 'payment_instrument': d.payment_instrument_id,
+                 'id_number': d.id_number, 'amount': str(d.amount)}
+                for d in payment.paymentdetails_set.all()
+            ],
+            'invoices': [{'alias_id': i.alias_id} for i in payment.invoice_set.all()],
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertNotIn('details_count', response.json())
+
+
+class PaymentUpdateTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=2, payments=2)
+        self.payment = self.data['payments'][0]
+        self.details = list(self.payment.paymentdetails_set.order_by('pk'))
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def update(self, details, invoices=None):
+        payment = self.payment
+        if invoices is None:
+            invoices = [{'alias_id': i.alias_id} for i in payment.invoice_set.all()]
+        return self.client.put(f'/v1/chq/payments/{payment.alias_id}/', {
+            'branch': self.data['branch'].alias_id, 'customer': self.data['parent'].alias_id,
+            'received_date': str(payment.received_date), 'version': payment.version,
+            'payment_details': details, 'invoices': invoices, 'total_amount': '300',
+        }, format='json')
+
+    def detail_rows(self, details=None, **changes):
+        return [
+            {'alias_id': d.alias_id, 'payment_instrument': d.payment_instrument_id,
+             'id_number': d.id_number, 'amount': str(d.amount), **changes.get(d.alias_id, {})}
+            for d in details or self.details
+        ]
+
+    def test_changed_details_are_updated_in_one_query(self):
+        first = self.details[0]
+        rows = self.detail_rows(**{first.alias_id: {'amount': '150', 'detail': 'topped up'}})
+        rows.append({'payment_instrument': self.data['cheque'].pk, 'id_number': 'CQ-NEW', 'amount': '25'})
+        unpaid = self.data['invoices'][0]
+        invoices = [{'alias_id': unpaid.alias_id}]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.update(rows, invoices)
+        self.assertEqual(response.status_code, 200, response.content)
+        detail_updates = [q['sql'] for q in queries
+                          if q['sql'].startswith('UPDATE') and 'payment_details' in q['sql'].split('SET')[0]]
+        self.assertEqual(len(detail_updates), 1)
+
+        first.refresh_from_db()
+        self.assertEqual((first.amount, first.detail), (Decimal(150), 'topped up'))
+        self.assertEqual(self.details[1].amount, PaymentDetails.objects.get(pk=self.details[1].pk).amount)
+        self.assertTrue(self.payment.paymentdetails_set.filter(id_number='CQ-NEW', amount=25).exists())
+        self.assertEqual(list(self.payment.invoice_set.values_list('alias_id', flat=True)), [unpaid.alias_id])
+
+    def test_unchanged_details_are_not_written(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.update(self.detail_rows())
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertFalse([q for q in queries
+                          if q['sql'].startswith('UPDATE') and 'payment_details' in q['sql'].split('SET')[0]])
+
+    def test_details_of_another_payment_are_rejected(self):
+        other = self.data['payments'][1].paymentdetails_set.first()
+        new_row = {'payment_instrument': self.data['cheque'].pk, 'id_number': 'CQ-NEW', 'amount': '25'}
+        for rows in (self.detail_rows() + [new_row] + self.detail_rows([other], **{other.alias_id: {'amount': '1'}}),
+                     self.detail_rows() + [new_row, {'alias_id': 'nosuchrow0', 'payment_instrument': 1}]):
+            response = self.update(rows)
+            self.assertEqual(response.status_code, 400, response.content)
+        other.refresh_from_db()
+        self.assertEqual(other.amount, Decimal(100))
+        self.assertFalse(PaymentDetails.objects.filter(id_number='CQ-NEW').exists())
+
+    def test_existing_details_cannot_be_removed(self):
+        response = self.update(self.detail_rows(self.details[1:]))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.payment.paymentdetails_set.count(), len(self.details))
+
+    def test_instrument_and_id_number_of_existing_details_are_fixed(self):
+        first = self.details[0]
+        response = self.update(self.detail_rows(**{first.alias_id: {'id_number': 'CHANGED'}}))
+        self.assertEqual(response.status_code, 400)
+        first.refresh_from_db()
+        self.assertNotEqual(first.id_number, 'CHANGED')
+
+    def test_id_number_taken_by_a_concurrent_request_is_a_400(self):
+        validate_new_details = PaymentViewSet.validate_new_details
+
+        def racing(view, new_details, branch_id):
+            # Another request saves the same number between the check and the insert
+            error = validate_new_details(view, new_details, branch_id)
+            other = self.data['payments'][1]
+            PaymentDetails.objects.create(branch=other.branch, payment=other, payment_instrument=self.data['cheque'],
+                                          id_number='CQ-RACE', amount=Decimal(10), received_date=other.received_date)
+            return error
+
+        rows = self.detail_rows() + [{'payment_instrument': self.data['cheque'].pk, 'id_number': 'CQ-RACE',
+                                      'amount': '10'}]
+        with mock.patch.object(PaymentViewSet, 'validate_new_details', racing):
+            response = self.update(rows)
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(response.json()['error']['message'], 'Duplicate ID number detected')
+
+    def test_duplicate_alias_id_is_a_400(self):
+        # In another month than the existing detail, so on PostgreSQL the
+        # alias_id guard table catches it rather than the per-date constraint
+        response = self.client.post('/v1/chq/payments/', {
+            'branch': self.data['branch'].alias_id, 'customer': self.data['parent'].alias_id,
+            'received_date': '2025-06-01', 'total_amount': '10',
+            'payment_details': [{'payment_instrument': self.data['cash'].pk, 'amount': '10',
+                                 'alias_id': self.details[0].alias_id}],
+        }, format='json')
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(response.json()['error']['message'], 'Duplicate alias_id detected')
+        self.assertFalse(Payment.objects.filter(received_date=date(2025, 6, 1)).exists())
+
+    def test_payment_cannot_move_to_another_branch(self):
+        other = Branch.objects.create(name='Other', branch_type=1)
+        response = self.client.put(f'/v1/chq/payments/{self.payment.alias_id}/', {
+            'branch': other.alias_id, 'customer': self.data['parent'].alias_id,
+            'received_date': str(self.payment.received_date), 'version': self.payment.version,
+            'payment_details': self.detail_rows(), 'total_amount': '300',
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.branch_id, self.data['branch'].pk)
+
+    def test_new_details_are_created_in_bulk(self):
+        cash, claim = self.data['cash'], self.data['claim']
+        new_rows = [{'payment_instrument': instrument.pk, 'amount': '10'} for instrument in (cash, cash, claim, claim)]
+        new_rows.append({'payment_instrument': self.data['cheque'].pk, 'id_number': 'CQ-NEW', 'amount': '25'})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.update(self.detail_rows() + new_rows)
+        self.assertEqual(response.status_code, 200, response.content)
+        inserts = [q['sql'].split('(')[0] for q in queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(inserts.count('INSERT INTO "payment_details" '), 1)
+        self.assertEqual(inserts.count('INSERT INTO "claim" '), 1)
+
+        added = self.payment.paymentdetails_set.exclude(pk__in=[d.pk for d in self.details])
+        self.assertEqual(added.count(), 5)
+        numbers = [n for n in added.values_list('id_number', flat=True) if n != 'CQ-NEW']
+        self.assertEqual(len(set(numbers)), 4)
+        self.assertEqual(Claim.objects.filter(payment_details__in=added).count(), 2)
+
+    def test_new_details_with_unknown_instruments_are_rejected(self):
+        response = self.update(self.detail_rows() + [{'payment_instrument': 999999, 'amount': '10'}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.payment.paymentdetails_set.count(), len(self.details))
+
+    def test_new_details_with_taken_id_numbers_are_rejected(self):
+        taken = self.data['payments'][1].paymentdetails_set.filter(payment_instrument=self.data['cheque']).get()
+        rows = self.detail_rows() + [{'payment_instrument': self.data['cheque'].pk,
+                                      'id_number': taken.id_number, 'amount': '10'}]
+        response = self.update(rows)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(f'payment_details.{len(rows) - 1}.id_number', response.json()['errors'])
+        self.assertEqual(self.payment.paymentdetails_set.count(), len(self.details))
+
+
+class VersionedUpdateTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=2, payments=1)
+        self.claim = self.data['claims'][0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def test_save_versioned(self):
+        claim = self.claim
+        stale = Claim.objects.get(pk=claim.pk)
+        claim.remarks = 'first'
+        claim.save_versioned(claim.version)
+        self.assertEqual(claim.version, 2)
+
+        stale.remarks = 'second'
+        with self.assertRaises(VersionConflict):
+            stale.save_versioned(stale.version)
+        claim.refresh_from_db()
+        self.assertEqual((claim.remarks, claim.version), ('first', 2))
+
+    def test_stale_or_missing_version_is_rejected(self):
+        url = f'/v1/chq/claims/{self.claim.alias_id}/'
+        response = self.client.patch(url, {'remarks': 'no version'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.patch(url, {'remarks': 'fresh', 'version': 1}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['version'], 2)
+
+        response = self.client.patch(url, {'remarks': 'stale', 'version': 1}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.claim.refresh_from_db()
+        self.assertEqual((self.claim.remarks, self.claim.version), ('fresh', 2))
+
+    def test_stale_payment_edit_writes_nothing(self):
+        payment = self.data['payments'][0]
+        detail = payment.paymentdetails_set.order_by('pk').first()
+        body = {
+            'branch': self.data['branch'].alias_id, 'customer': self.data['parent'].alias_id,
+            'received_date': str(payment.received_date), 'total_amount': '300',
+            'payment_details': [
+                {'alias_id': d.alias_id, 'payment_instrument': d.payment_instrument_id,
+                 'id_number': d.id_number, 'amount': '150' if d == detail else str(d.amount)}
+                for d in payment.paymentdetails_set.all()
+            ],
+        }
+        url = f'/v1/chq/payments/{payment.alias_id}/'
+        self.assertEqual(self.client.put(url, body, format='json').status_code, 400)
+        self.assertEqual(self.client.put(url, dict(body, version=payment.version + 1), format='json').status_code, 409)
+        detail.refresh_from_db()
+        self.assertEqual(detail.amount, Decimal(100))
+
+
+def open_invoice(n, net_amount, grace_date=date(2025, 1, 1)):
+    # Shaped like a load_unpaid_invoices() row
+    return {
+        'id': n, 'alias_id': f'inv{n:07d}', 'grn': f'GRN-{n}', 'transaction_date': grace_date,
+        'payment_grace_days': 0, 'grace_date': grace_date, 'customer__alias_id': 'child00000',
+        'customer__name': 'Child', 'net_amount': Decimal(net_amount),
+    }
+
+
+class AllocationTests(SimpleTestCase):
+    def test_exact_match_prefers_older_invoices(self):
+        invoices = [open_invoice(n, amount, date(2025, 1, n + 1)) for n, amount in enumerate([30, 70, 50, 20, 100])]
+        proposal = propose_allocation(invoices, Decimal(100))
+        self.assertEqual(proposal['match'], 'exact')
+        self.assertEqual([i['alias_id'] for i in proposal['invoices']], ['inv0000000', 'inv0000001'])
+        self.assertEqual(proposal['unallocated_amount'], Decimal(0))
+
+    def test_credits_add_to_the_amount(self):
+        invoices = [open_invoice(0, 80), open_invoice(1, -30), open_invoice(2, 50)]
+        proposal = propose_allocation(invoices, Decimal(100))
+        self.assertEqual(proposal['match'], 'exact')
+        self.assertEqual(proposal['allocated_amount'], Decimal(100))
+        self.assertEqual({i['alias_id'] for i in proposal['invoices']}, {'inv0000000', 'inv0000001', 'inv0000002'})
+
+    def test_fifo_fallback_without_exact_match(self):
+        invoices = [open_invoice(n, 40, date(2025, 1, n + 1)) for n in range(4)]
+        proposal = propose_allocation(invoices, Decimal(100))
+        self.assertEqual(proposal['match'], 'fifo')
+        self.assertEqual([i['alias_id'] for i in proposal['invoices']], ['inv0000000', 'inv0000001'])
+        self.assertEqual(proposal['unallocated_amount'], Decimal(20))
+
+    def test_thousands_of_invoices_do_not_exhaust_the_stack(self):
+        amounts = [3] * 5000 + [1]
+        self.assertEqual(find_exact_subset(amounts, 1, budget_seconds=5), [5000])
+        # No exact match and no time left: the caller falls back to FIFO
+        self.assertIsNone(find_exact_subset([2] * 5000, 4001, budget_seconds=0))
+
+
+class AllocateEndpointTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=3, payments=0)
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def allocate(self, amount):
+        return self.client.get('/v1/chq/payments/allocate/', {
+            'branch': self.data['branch'].alias_id, 'customer': self.data['parent'].alias_id, 'amount': amount})
+
+    def test_proposes_unpaid_invoices(self):
+        response = self.allocate('300')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['match'], 'exact')
+        self.assertEqual({i['alias_id'] for i in response.json()['invoices']},
+                         {i.alias_id for i in self.data['invoices'][:2]})
+
+    def test_invalid_amounts(self):
+        for amount in ('', 'abc', 'NaN', '-5', '0'):
+            with self.subTest(amount=amount):
+                self.assertEqual(self.allocate(amount).status_code, 400)
+
+
+class ClaimSummaryColumnsTests(TestCase):
+    """Claim's denormalized customer/claim_amount/claim_date/remaining_amount follow every write."""
+
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=2, payments=0)
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def create_payment(self):
+        data = self.data
+        response = self.client.post('/v1/chq/payments/', {
+            'branch': data['branch'].alias_id, 'customer': data['parent'].alias_id, 'received_date': '2025-03-01',
+            'payment_details': [
+                {'payment_instrument': data['cash'].id, 'amount': '100'},
+                {'payment_instrument': data['claim'].id, 'amount': '40'},
+            ],
+            'invoices': [], 'total_amount': '140', 'cash_equivalent_amount': '100', 'shortage_amount': '0',
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return Payment.objects.get(alias_id=response.json()['alias_id'])
+
+    def assertSummary(self, claim, customer, amount, claim_date, remaining):
+        claim.refresh_from_db()
+        self.assertEqual(
+            (claim.customer_id, claim.claim_amount, claim.claim_date, claim.remaining_amount),
+            (customer.pk, Decimal(amount), claim_date, Decimal(remaining)),
+        )
+
+    def test_columns_follow_create_refund_and_payment_edit(self):
+        payment = self.create_payment()
+        claim = Claim.objects.get(payment_details__payment=payment)
+        self.assertSummary(claim, self.data['parent'], 40, date(2025, 3, 1), 40)
+
+        response = self.client.patch(f'/v1/chq/claims/{claim.alias_id}/update_claim/', {
+            'submitted_date': '2025-03-02', 'refund_amount': '15', 'refund_date': '2025-03-05',
+            'version': claim.version,
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['remaining_amount'], '25.0000')
+        self.assertSummary(claim, self.data['parent'], 40, date(2025, 3, 1), 25)
+
+        other = Customer.objects.create(branch=self.data['branch'], name='Other', is_parent=True)
+        payment.refresh_from_db()
+        response = self.client.put(f'/v1/chq/payments/{payment.alias_id}/', {
+            'branch': self.data['branch'].alias_id, 'customer': other.alias_id, 'received_date': '2025-03-10',
+            'version': payment.version, 'total_amount': '160',
+            'payment_details': [
+                {'alias_id': d.alias_id, 'payment_instrument': d.payment_instrument_id, 'id_number': d.id_number,
+                 'amount': '60' if d.payment_instrument_id == self.data['claim'].id else str(d.amount)}
+                for d in payment.paymentdetails_set.all()
+            ],
+            'invoices': [],
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertSummary(claim, other, 60, date(2025, 3, 10), 45)
+
+    def test_claims_list_filters_on_the_columns(self):
+        claim = Claim.objects.get(payment_details__payment=self.create_payment())
+        rows = self.client.get('/v1/chq/claims/', {'remaining_amount_min': '30'}).json()
+        self.assertEqual([row['alias_id'] for row in rows], [claim.alias_id])
+        self.assertEqual(self.client.get('/v1/chq/claims/', {'remaining_amount_min': '41'}).json(), [])
+
+
+class ClaimSearchTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=0, payments=0)
+        self.first, self.second = add_claim(self.data), add_claim(self.data)
+        detail = self.first.payment_details
+        detail.detail = 'Broken bottles, crate 7'
+        detail.save()
+        other = Customer.objects.create(branch=self.data['branch'], name='Harbour Stores', is_parent=True)
+        Claim.objects.filter(pk=self.second.pk).update(customer=other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def search(self, term):
+        response = self.client.get('/v1/chq/claims/', {'search': term})
+        self.assertEqual(response.status_code, 200, response.content)
+        return {row['alias_id'] for row in response.json()}
+
+    def test_search_across_customer_detail_and_id_number(self):
+        first, second = self.first.alias_id, self.second.alias_id
+        self.assertEqual(self.search('harbour'), {second})
+        self.assertEqual(self.search('BOTTLES'), {first})
+        self.assertEqual(self.search(self.second.payment_details.id_number), {second})
+        self.assertEqual(self.search('damage'), {first, second})
+        # Every term has to match, each on any of the tables
+        self.assertEqual(self.search('parent bottles'), {first})
+        self.assertEqual(self.search('harbour bottles'), set())
+
+
+class ClaimSettlementTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=0, payments=0)
+        self.claims = [add_claim(self.data) for _ in range(3)]
+        for claim in self.claims:
+            claim.submitted_date = date(2025, 2, 10)
+            claim.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def settle(self, rows, **body):
+        response = self.client.post('/v1/chq/claims/settle_refunds/', dict(body, rows=rows), format='json')
+        return response
+
+    def row(self, claim, amount, key=None):
+        return {'claim': key or claim.alias_id, 'refund_amount': str(amount), 'refund_date': '2025-03-01'}
+
+    def test_rows_match_by_alias_or_id_number(self):
+        first, second, _ = self.claims
+        response = self.settle([self.row(first, 100), self.row(second, 30, second.payment_details.id_number)],
+                               branch=self.data['branch'].alias_id)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual((response.json()['updated'], response.json()['errors']), (2, 0))
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.refund_amount, first.remaining_amount), (Decimal(100), Decimal(0)))
+        # Partial refunds leave the rest open
+        self.assertEqual((second.refund_amount, second.remaining_amount, second.version), (Decimal(30), Decimal(70), 2))
+
+    def test_id_number_of_several_branches_is_ambiguous_without_branch(self):
+        claim = self.claims[0]
+        id_number = claim.payment_details.id_number
+        other_branch = Branch.objects.create(name='Other', branch_type=1)
+        other = add_claim(dict(self.data, branch=other_branch))
+        PaymentDetails.objects.filter(pk=other.payment_details_id).update(id_number=id_number)
+
+        report = self.settle([self.row(claim, 10, id_number)]).json()
+        self.assertEqual(report['updated'], 0)
+        self.assertIn('more than one branch', report['rows'][0]['errors'][0])
+
+        report = self.settle([self.row(claim, 10, id_number)], branch=self.data['branch'].alias_id).json()
+        self.assertEqual(report['rows'][0]['claim'], claim.alias_id)
+        other.refresh_from_db()
+        self.assertEqual(other.refund_amount, Decimal(0))
+
+    def test_dry_run_writes_nothing(self):
+        claim = self.claims[0]
+        for dry_run, refund in ((True, 0), ('true', 0), ('false', 40)):
+            report = self.settle([self.row(claim, 40)], dry_run=dry_run).json()
+            self.assertEqual(report['updated'], 1)
+            claim.refresh_from_db()
+            self.assertEqual(claim.refund_amount, Decimal(refund))
+        self.assertEqual(self.settle([self.row(claim, 40)], dry_run='maybe').status_code, 400)
+
+    def test_invalid_rows_are_reported_per_row(self):
+        first, second, third = self.claims
+        response = self.settle([
+            'not a row',
+            {'claim': first.alias_id},
+            self.row(second, 500),
+            self.row(third, 50, 'nosuchclm'),
+            self.row(third, 50),
+            self.row(third, 60),
+        ])
+        self.assertEqual(response.status_code, 200, response.content)
+        report = response.json()
+        self.assertEqual((report['updated'], report['errors']), (1, 5))
+        self.assertEqual([row['status'] for row in report['rows']],
+                         ['error', 'error', 'error', 'error', 'updated', 'error'])
+        self.assertEqual(report['rows'][3]['errors'], ['Claim not found.'])
+        self.assertEqual(self.settle('rows').status_code, 400)
+        second.refresh_from_db()
+        self.assertEqual(second.refund_amount, Decimal(0))
+
+
+class ClaimsSummaryTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=0, payments=2)
+        self.branch = self.data['branch']
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def summary(self):
+        response = self.client.get('/v1/chq/claims/summary/', {'branch': self.branch.alias_id})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['totals']
+
+    def test_summary_is_invalidated_when_the_write_commits(self):
+        self.assertEqual(self.summary()['claim_count'], 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            add_claim(self.data)
+            # Not yet committed: another request could still rebuild from the old rows
+            self.assertEqual(self.summary()['claim_count'], 2)
+        self.assertEqual(self.summary()['claim_count'], 3)
+
+    def test_bulk_settlement_invalidates_the_summary(self):
+        self.assertEqual(self.summary()['claim_count'], 2)
+        claim = self.data['claims'][0]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/v1/chq/claims/settle_refunds/', {'rows': [{
+                'claim': claim.alias_id, 'refund_amount': '100', 'refund_date': '2025-03-01',
+                'submitted_date': '2025-02-20'}]}, format='json')
+        self.assertEqual(self.summary()['claim_count'], 1)
+
+
+class ReferenceCacheTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=0, payments=0)
+        self.cash = self.data['cash']
+
+    def test_instruments_are_served_from_memory(self):
+        PaymentInstrumentPolicy.get_instrument(self.cash.pk)
+        with self.assertNumQueries(0):
+            instrument = PaymentInstrumentPolicy.get_instrument(str(self.cash.pk))
+            self.assertTrue(instrument.instrument_type.auto_number)
+            self.assertEqual(
+                PaymentInstrumentPolicy.get_instrument_by_serial(self.data['branch'].pk, 3), self.data['claim'])
+
+    def test_edits_reload_once_committed(self):
+        self.assertEqual(PaymentInstrumentPolicy.get_instrument(self.cash.pk).instrument_name, 'Cash')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cash.instrument_name = 'Petty cash'
+            self.cash.save()
+            self.assertEqual(PaymentInstrumentPolicy.get_instrument(self.cash.pk).instrument_name, 'Cash')
+        self.assertEqual(PaymentInstrumentPolicy.get_instrument(self.cash.pk).instrument_name, 'Petty cash')
+
+    @override_settings(REFERENCE_CACHE_CHECK_SECONDS=0)
+    def test_a_bump_by_another_worker_reloads(self):
+        PaymentInstrumentPolicy.get_instrument(self.cash.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            PaymentInstrument.objects.filter(pk=self.cash.pk).update(instrument_name='Till')
+            shared_cache.bump_namespace('reference')
+        self.assertEqual(PaymentInstrumentPolicy.get_instrument(self.cash.pk).instrument_name, 'Till')
+
+    def test_auto_numbering_does_not_invalidate(self):
+        PaymentInstrumentPolicy.get_instrument(self.cash.pk)
+        version = shared_cache.namespace_version('reference')
+        instrument_type = self.cash.instrument_type
+        with self.captureOnCommitCallbacks() as callbacks:
+            instrument_type.last_number += 1
+            instrument_type.save(update_fields=['last_number'])
+        self.assertEqual(callbacks, [])
+        self.assertEqual(shared_cache.namespace_version('reference'), version)
+        with self.assertNumQueries(0):
+            PaymentInstrumentPolicy.get_instrument(self.cash.pk)
+
+
+class NamespaceInvalidationTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=1, payments=1)
+        self.branch_id = self.data['branch'].pk
+
+    def versions(self):
+        return [shared_cache.namespace_version(namespace, self.branch_id) for namespace in ('customers', 'dues')]
+
+    def test_writes_bump_their_namespaces_on_commit(self):
+        before = self.versions()
+        with self.captureOnCommitCallbacks(execute=True):
+            customer = self.data['child']
+            customer.name = 'Renamed'
+            customer.save()
+            self.assertEqual(self.versions(), before)
+        after = self.versions()
+        self.assertTrue(all(new > old for new, old in zip(after, before)))
+
+    def test_rolled_back_writes_bump_nothing(self):
+        before = self.versions()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                CreditInvoice.objects.create(branch=self.data['branch'], customer=self.data['child'],
+                                             transaction_date=date(2025, 3, 1), sales_amount=Decimal(1))
+                raise IntegrityError
+        self.assertEqual(self.versions(), before)
+
+    def test_cached_dues_follow_a_committed_payment_edit(self):
+        client = APIClient()
+        client.force_authenticate(self.data['user'])
+        url = '/v1/chq/parent-customer-due-report/'
+        params = {'branch': self.data['branch'].alias_id}
+        due = client.get(url, params).json()
+        payment = self.data['payments'][0]
+        unpaid = self.data['invoices'][0]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.put(f'/v1/chq/payments/{payment.alias_id}/', {
+                'branch': self.data['branch'].alias_id, 'customer': self.data['parent'].alias_id,
+                'received_date': str(payment.received_date), 'version': payment.version, 'total_amount': '300',
+                'payment_details': [
+                    {'alias_id': d.alias_id, 'payment_instrument': d.payment_instrument_id,
+                     'id_number': d.id_number, 'amount': str(d.amount)}
+                    for d in payment.paymentdetails_set.all()
+                ],
+                'invoices': [{'alias_id': i.alias_id} for i in payment.invoice_set.all()] + [{'alias_id': unpaid.alias_id}],
+            }, format='json')
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(client.get(url, params).json(), due)
+        self.assertNotEqual(client.get(url, params).json(), due)
+
+
+class BranchAliasCacheTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.branch = Branch.objects.create(name='Outlet', branch_type=2)
+
+    def test_lookups_are_memoised(self):
+        alias, pk = self.branch.alias_id, self.branch.pk
+        self.assertEqual(shared_cache.branch_id_for_alias(alias), pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(shared_cache.branch_id_for_alias(alias), pk)
+            self.assertEqual(shared_cache.branch_alias_for_id(pk), alias)
+
+    def test_saved_branch_row_is_reloaded_on_commit(self):
+        shared_cache.branch_for_alias(self.branch.alias_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.branch.name = 'Outlet 2'
+            self.branch.save()
+            self.assertEqual(shared_cache.branch_for_alias(self.branch.alias_id).name, 'Outlet')
+        self.assertEqual(shared_cache.branch_for_alias(self.branch.alias_id).name, 'Outlet 2')
+
+    @override_settings(REFERENCE_CACHE_CHECK_SECONDS=0)
+    def test_deleted_branch_is_forgotten_by_every_worker(self):
+        alias, pk = self.branch.alias_id, self.branch.pk
+        self.assertEqual(shared_cache.branch_id_for_alias(alias), pk)
+        # What another worker has memoised from before the delete
+        memo = (dict(shared_cache._branch_id_by_alias), dict(shared_cache._branch_alias_by_id),
+                shared_cache._branch_memo_version)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.branch.delete()
+            self.assertEqual(shared_cache.branch_id_for_alias(alias), pk)
+        self.assertIsNone(shared_cache.branch_id_for_alias(alias))
+
+        (shared_cache._branch_id_by_alias, shared_cache._branch_alias_by_id,
+         shared_cache._branch_memo_version) = memo
+        self.assertIsNone(shared_cache.branch_id_for_alias(alias))
+        self.assertIsNone(shared_cache.branch_alias_for_id(pk))
+
+
+class CachedAuthenticationTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.user = User.objects.create_user('clerk', email='clerk@example.com', password='secret')
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+
+    def authenticate(self):
+        auth = CachedJWTAuthentication()
+        return auth.get_user(auth.get_validated_token(self.token))
+
+    def test_profile_is_cached_without_the_password_hash(self):
+        self.authenticate()
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+            self.assertEqual((user.pk, user.username, user.email, user.is_active),
+                             (self.user.pk, 'clerk', 'clerk@example.com', True))
+        self.assertIn('password', user.get_deferred_fields())
+        jti = CachedJWTAuthentication().get_validated_token(self.token)['jti']
+        cached = cache.get(shared_cache.versioned_key('auth-user', self.user.pk, jti))
+        self.assertNotIn(self.user.password, cached)
+        self.assertEqual(self.client.get('/v1/chq/user/').json()['email'], 'clerk@example.com')
+
+    def test_deactivation_takes_effect_once_committed(self):
+        self.assertEqual(self.client.get('/v1/chq/user/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.client.get('/v1/chq/user/').status_code, 401)
+
+    def test_group_change_takes_effect(self):
+        self.assertFalse(self.authenticate().has_perm('cheques.change_claim'))
+        group = Group.objects.create(name='Claims')
+        group.permissions.add(Permission.objects.get(codename='change_claim'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.groups.add(group)
+        self.assertTrue(self.authenticate().has_perm('cheques.change_claim'))
+
+
+class CustomerTreeTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=0, payments=0)
+        branch = self.data['branch']
+        self.inactive = Customer.objects.create(branch=branch, name='Closed', is_parent=True, is_active=False)
+        Customer.objects.create(branch=branch, name='Annex', parent=self.inactive)
+        Customer.objects.create(branch=Branch.objects.create(name='Other'), name='Elsewhere')
+        self.client = APIClient()
+        self.client.force_authenticate(self.data['user'])
+
+    def tree(self, **params):
+        response = self.client.get('/v1/chq/customers/tree/', dict(params, branch=self.data['branch'].alias_id))
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['data']
+
+    def outline(self, nodes):
+        return [(node['name'], self.outline(node['children'])) for node in nodes]
+
+    def test_children_nest_under_their_parents(self):
+        self.assertEqual(self.outline(self.tree()), [('Closed', [('Annex', [])]), ('Parent', [('Child', [])])])
+
+    def test_children_of_filtered_out_parents_move_to_the_top(self):
+        self.assertEqual(self.outline(self.tree(is_active='true')), [('Annex', []), ('Parent', [('Child', [])])])
+        self.assertEqual(self.outline(self.tree(is_active='false')), [('Closed', [])])
+
+    def test_tree_is_cached_until_a_customer_changes(self):
+        self.tree()
+        with self.assertNumQueries(0):
+            self.tree()
+        with self.captureOnCommitCallbacks(execute=True):
+            Customer.objects.create(branch=self.data['branch'], name='Newcomer', parent=self.data['parent'])
+        self.assertEqual(self.outline(self.tree())[1], ('Parent', [('Child', []), ('Newcomer', [])]))
+
+    def test_branch_is_required(self):
+        self.assertEqual(self.client.get('/v1/chq/customers/tree/').status_code, 400)
+        self.assertEqual(self.client.get('/v1/chq/customers/tree/', {'branch': 'nosuchone'}).status_code, 400)
+
+
+class WorkerThreadOffloadTests(TransactionTestCase):
+    # A TransactionTestCase: the pool thread reads through its own connection
+
+    def setUp(self):
+        reset_caches()
+        self.data = seed_dataset(invoices=2, payments=1)
+
+    def test_views_stay_sync_unless_offloading(self):
+        self.assertFalse(iscoroutinefunction(ParentCustomerDueReport.as_view()))
+        with self.settings(OFFLOAD_SLOW_VIEWS=True):
+            self.assertTrue(iscoroutinefunction(ParentCustomerDueReport.as_view()))
+
+    @override_settings(OFFLOAD_SLOW_VIEWS=True)
+    def test_offloaded_view_runs_on_the_thread_pool(self):
+        view = ParentCustomerDueReport.as_view()
+        request = RequestFactory().get('/v1/chq/parent-customer-due-report/', {'branch': self.data['branch'].alias_id})
+        force_authenticate(request, self.data['user'])
+
+        threads = set()
+        with mock.patch('cheques.views.close_old_connections', lambda: threads.add(threading.get_ident())):
+            response = async_to_sync(view)(request)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertTrue(response.is_rendered)
+        self.assertEqual(response.data['data'][0]['alias_id'], self.data['parent'].alias_id)
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.get_ident(), threads)
+
+
+class ORJSONTests(SimpleTestCase):
+    def test_renders_what_drf_renders(self):
+        payload = {
+            'utc': datetime(2025, 3, 1, 9, 30, 15, 123456, tzinfo=dt_timezone.utc),
+            'offset': datetime(2025, 3, 1, 9, 30, 15, tzinfo=dt_timezone(timedelta(hours=5, minutes=30))),
+            'naive': datetime(2025, 3, 1, 9, 30, 15, 500),
+            'date': date(2025, 3, 1),
+            'time': time(9, 30, 15, 987654),
+            'amounts': [Decimal('12.5000'), Decimal('0.0001'), 3, 1.5, None, True],
+            'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+            'label': gettext_lazy('Cash'),
+            'name': 'Müller & Söhne',
+            1: 'int key',
+        }
+        self.assertEqual(ORJSONRenderer().render(payload), JSONRenderer().render(payload))
+        self.assertEqual(ORJSONRenderer().render(invoice_rows(50)), JSONRenderer().render(invoice_rows(50)))
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+
+    def test_non_finite_floats_render_as_null(self):
+        # The one documented difference: JSONRenderer refuses them
+        self.assertEqual(ORJSONRenderer().render({'ratio': float('nan')}), b'{"ratio":null}')
+        with self.assertRaises(ValueError):
+            JSONRenderer().render({'ratio': float('nan')})
+
+    def test_defaults_keep_browsable_api_and_form_parsers(self):
+        view = APIView()
+        self.assertEqual([type(r) for r in view.get_renderers()], [ORJSONRenderer, BrowsableAPIRenderer])
+        self.assertEqual([type(p) for p in view.get_parsers()], [ORJSONParser, FormParser, MultiPartParser])
+
+    def test_indent(self):
+        body = ORJSONRenderer().render({'a': [1]}, 'application/json; indent=4')
+        self.assertEqual(body, b'{\n  "a": [\n    1\n  ]\n}')
+
+    def test_parser(self):
+        parse = ORJSONParser().parse
+        self.assertEqual(parse(BytesIO('{"amount": 1.5, "name": "Müller"}'.encode())),
+                         {'amount': 1.5, 'name': 'Müller'})
+        for body in (b'{"amount": ', b'{"amount": NaN}', b'\xff'):
+            with self.subTest(body=body), self.assertRaises(ParseError):
+                parse(BytesIO(body))
+
+    def test_malformed_request_body_answers_400(self):
+        client = APIClient()
+        response = client.post('/v1/chq/token/', b'{"username": ', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response['Content-Type'], 'application/json')
@@ -9,6 +9,7 @@ from .views import ( CustomerViewSet
                     # , CustomerStatementViewSet) # InvoiceChequeMapViewSet, ChequeStoreViewSet,
 
 from .views import PaymentInstrumentTypeViewSet, PaymentInstrumentsViewSet, PaymentViewSet
+from .views import ArchivedClaimViewSet, ArchivedCreditInvoiceViewSet, ArchivedPaymentViewSet
 
 
 router = DefaultRouter()
@@ -20,6 +21,9 @@ router.register(r'payment-instruments', PaymentInstrumentsViewSet, basename='pay
 router.register(r'payments', PaymentViewSet, basename='payment')
 router.register(r'PaymentInstrumentType', PaymentInstrumentTypeViewSet, basename='PaymentInstrumentType')
 router.register(r'claims', ClaimViewSet, basename='claim')
+router.register(r'archive/credit-invoices', ArchivedCreditInvoiceViewSet, basename='archived-credit-invoice')
+router.register(r'archive/payments', ArchivedPaymentViewSet, basename='archived-payment')
+router.register(r'archive/claims', ArchivedClaimViewSet, basename='archived-claim')
 
 # 
 
@@ -3,18 +3,22 @@ import logging
 
 # --------------------Organized Imports--------------------
 # Standard Library Imports
+import functools
+import hmac
 import io
 import json
+from collections import Counter
 from datetime import datetime, timedelta, date
 from decimal import Decimal
 
 # Django Imports
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import connection, transaction, IntegrityError
+from django.db import close_old_connections, connection, transaction, IntegrityError
 from django.db.models import (
     F, Sum,Value, DecimalField,IntegerField, ExpressionWrapper, DurationField, DateField,
-    Subquery, OuterRef, Q, Case, When
+    Subquery, OuterRef, Q, Case, When, Count, Prefetch
 )
 from django.db.models.functions import Coalesce, Cast, Concat
 from django.http import HttpResponse, JsonResponse
@@ -28,10 +32,11 @@ from django_filters.rest_framework import DjangoFilterBackend , FilterSet, CharF
 
 
 # Django REST Framework Imports
-from rest_framework import viewsets, status, filters
+from rest_framework import viewsets, status, filters, exceptions
 from rest_framework.decorators import api_view, permission_classes, action
+from rest_framework.fields import BooleanField
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
 from rest_framework.views import APIView
 from rest_framework.viewsets import ViewSet
 from rest_framework_simplejwt.views import TokenObtainPairView
@@ -50,8 +55,20 @@ from .models import (
     #CustomerClaim, InvoiceChequeMap, InvoiceClaimMap, MasterClaim
 )
 from .models import PaymentInstrument, Payment, PaymentDetails, PaymentInstrumentType, Claim
-
-from cheques import serializers
+from .models import ArchivedClaim, ArchivedCreditInvoice, ArchivedPayment, ArchivedPaymentDetails
+
+from cheques import db_router, metrics, serializers
+from .exception_handler import VersionConflict
+from .allocation import load_unpaid_invoices, propose_allocation
+from .search import TrigramSearchFilter
+from .claim_settlement import settle_claim_refunds
+from .claim_summary import get_claims_summary, invalidate_claims_summary
+from .statement import customer_statement
+from .Instrument import PaymentInstrumentPolicy
+from .cache import (
+    branch_for_alias, bump_namespace, cache_branch_response, cached_for_branch,
+    request_branch_id,
+)
 from .serializers import ( # You'll need to create these serializers
     ClaimListSerializer, ClaimUpdateSerializer
     #CustomerPaymentSerializer,  #ChequeStoreSerializer, CustomerClaimSerializer,
@@ -62,6 +79,17 @@ from .serializers import PaymentInstrumentSerializer, PaymentSerializer, Payment
 
 logger = logging.getLogger(__name__)
 
+
+@never_cache
+def metrics_view(request):
+    """Prometheus scrape endpoint; answers 404 unless METRICS_TOKEN is configured and presented."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not token or not hmac.compare_digest(supplied, token):
+        return HttpResponse(status=404)
+    return HttpResponse(metrics.prometheus_text(metrics.collect()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def user_detail(request):
@@ -77,50 +105,138 @@ class StandardResultsSetPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 100
 
-class BranchViewSet(viewsets.ModelViewSet):
+def run_in_worker_thread(view):
+    """
+    Wrap a sync view in an async one that runs it on the thread pool.
+
+    Under ASGI, Django runs sync views one at a time per worker (thread
+    sensitive); slow, I/O bound views wrapped here run concurrently instead,
+    so a long report doesn't hold up the worker. Each pool thread keeps its
+    own DB connection, so stale ones are closed here, as
+    request_started/finished would.
+    """
+    def call(request, *args, **kwargs):
+        close_old_connections()
+        try:
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+            return response
+        finally:
+            close_old_connections()
+
+    @functools.wraps(view)
+    async def async_view(request, *args, **kwargs):
+        return await sync_to_async(call, thread_sensitive=False)(request, *args, **kwargs)
+
+    return async_view
+
+
+class WorkerThreadMixin:
+    # For APIViews/ViewSets whose handlers should run through run_in_worker_thread.
+    # Only with OFFLOAD_SLOW_VIEWS (on under SERVER_MODE=asgi): under WSGI an
+    # async view just costs every request a hop to another thread and back.
+    @classmethod
+    def as_view(cls, *args, **kwargs):
+        view = super().as_view(*args, **kwargs)
+        if not getattr(settings, 'OFFLOAD_SLOW_VIEWS', False):
+            return view
+        return run_in_worker_thread(view)
+
+
+class VersionedUpdateMixin:
+    """
+    Optimistic concurrency for viewsets of versioned models. The client's
+    `version` is checked by the UPDATE itself (see save_versioned), so a
+    concurrent edit answers 409 instead of being silently overwritten.
+    """
+    def get_expected_version(self, instance):
+        client_version = self.request.data.get('version')
+        if client_version in (None, ''):
+            raise exceptions.ValidationError({'version': 'This field is required.'})
+        try:
+            return int(client_version)
+        except (TypeError, ValueError):
+            raise exceptions.ValidationError({'version': 'A valid integer is required.'})
+
+    def perform_update(self, serializer):
+        serializer.save(
+            updated_by=self.request.user,
+            expected_version=self.get_expected_version(serializer.instance)
+        )
+
+
+class BranchScopedMixin:
+    """
+    Filters on ?branch=<alias> through the cached alias -> id map, so list
+    queries compare branch_id directly instead of joining branch.
+    """
+    def get_branch_id(self):
+        return request_branch_id(self.request)
+
+    def filter_branch(self, queryset):
+        if not self.request.query_params.get('branch'):
+            return queryset
+        branch_id = self.get_branch_id()
+        if branch_id is None:
+            return queryset.none()
+        return queryset.filter(branch_id=branch_id)
+
+
+class ReplicaReadsMixin:
+    """
+    Runs the reads of GET replica_actions (or handlers, for APIViews) on the
+    read replica, unless the user wrote something within the last
+    REPLICA_STICKY_SECONDS. Writes by an authenticated user start that window.
+    See cheques/db_router.py.
+    """
+    replica_actions = ('list', 'retrieve')
+
+    def dispatch(self, request, *args, **kwargs):
+        with db_router.reads_from(None):
+            return super().dispatch(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        user_id = request.user.pk if request.user.is_authenticated else None
+        if request.method not in SAFE_METHODS:
+            self.writing_user_id = user_id
+            return
+        action = getattr(self, 'action', None) or request.method.lower()
+        if action not in self.replica_actions or not db_router.replica_enabled():
+            return
+        if user_id is not None and db_router.written_recently(db_router.user_key(user_id)):
+            return
+        db_router.read_from_replica()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # Noted once the write is done, so the window covers the reads that follow it
+        if getattr(self, 'writing_user_id', None) is not None:
+            db_router.note_writes(db_router.user_key(self.writing_user_id))
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class BranchViewSet(ReplicaReadsMixin, VersionedUpdateMixin, viewsets.ModelViewSet):
     serializer_class = serializers.BranchSerializer
     queryset = Branch.objects.all()
     permission_classes = [IsAuthenticated]
     lookup_field = 'alias_id'
 
-    def update(self, request, *args, **kwargs):
-        with transaction.atomic():
-            client_version = int(request.data.get('version'))
-            instance = self.get_object()
-
-            # Concurrency check
-            if instance.version != client_version:
-                return Response(
-                    {'version': 'This branch has been modified by another user. Please refresh. current V, client_version v: ' + str(instance.version) + ' ' + str(client_version)},
-                    status=status.HTTP_409_CONFLICT
-                )
-
-            # Increment version
-            new_version = instance.version + 1
-
-            # Partial update handling
-            partial = kwargs.pop('partial', False)
-            serializer = self.get_serializer(instance, data=request.data, partial=partial)
-            serializer.is_valid(raise_exception=True)
-
-            # Save with updated information
-            serializer.save(updated_by=request.user, version=new_version)
-
-            return Response(serializer.data)
-
     def perform_create(self, serializer):
         serializer.save(updated_by=self.request.user)
 
-class CustomerViewSet(viewsets.ModelViewSet):
+class CustomerViewSet(ReplicaReadsMixin, BranchScopedMixin, viewsets.ModelViewSet):
     queryset = Customer.objects.all()
     serializer_class = serializers.CustomerSerializer
     permission_classes = [IsAuthenticated]
     lookup_field = 'alias_id'
+    replica_actions = ('list', 'retrieve', 'tree', 'statement')
     filterset_fields = ['is_parent', 'parent']
+    filter_backends = [DjangoFilterBackend, TrigramSearchFilter]
+    trigram_search = [('', Customer, ['name', 'alias_id'])]
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        branch_id = self.request.query_params.get('branch')        
+        queryset = super().get_queryset().select_related('parent')
          
         #if not self.request.user.is_staff:  # Example: admins see all
         if self.request.query_params.get('is_active'):
@@ -128,9 +244,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
             # print('is_active',is_active, 'self.request.query_params.get', self.request.query_params.get('is_active', 'true').lower())
             queryset = queryset.filter(is_active=is_active)
         
-        # Filter by branch alias_id
-        if branch_id:
-            queryset = queryset.filter(branch__alias_id=branch_id)
+        queryset = self.filter_branch(queryset)
             
         # Filter parent customers
         if self.request.query_params.get('is_parent'):
@@ -146,7 +260,67 @@ class CustomerViewSet(viewsets.ModelViewSet):
         
         # print('queryset :', print(str(queryset.query)))
         return queryset
-    
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def tree(self, request):
+        """
+        The branch's customers as parent -> children for pickers:
+        ?branch=<alias>[&is_active=true|false]
+        """
+        branch_id = self.get_branch_id()
+        if branch_id is None:
+            return Response({"error": "A valid branch is required"}, status=status.HTTP_400_BAD_REQUEST)
+        is_active = request.query_params.get('is_active')
+        if is_active is not None:
+            is_active = is_active.lower() == 'true'
+        return Response({'branch': request.query_params['branch'], 'data': self.build_tree(branch_id, is_active)})
+
+    @cached_for_branch('customers')
+    def build_tree(self, branch_id, is_active=None):
+        queryset = Customer.objects.filter(branch_id=branch_id)
+        if is_active is not None:
+            queryset = queryset.filter(is_active=is_active)
+        rows = list(queryset.order_by('name').values(
+            'id', 'alias_id', 'name', 'is_parent', 'parent_id', 'grace_days', 'is_active'
+        ))
+
+        nodes = {}
+        for row in rows:
+            nodes[row['id']] = {
+                'alias_id': row['alias_id'],
+                'name': row['name'],
+                'is_parent': row['is_parent'],
+                'grace_days': row['grace_days'],
+                'is_active': row['is_active'],
+                'children': [],
+            }
+
+        tree = []
+        for row in rows:
+            parent = nodes.get(row['parent_id'])
+            # Children of a filtered-out (or other branch) parent are listed at the top level
+            (parent['children'] if parent is not None else tree).append(nodes[row['id']])
+        return tree
+
+    @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated])
+    def statement(self, request, alias_id=None):
+        """
+        Invoices and payments with a running balance, archived history
+        included: ?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD (both optional).
+        A parent's statement covers its children's invoices.
+        """
+        customer = self.get_object()
+        dates = {}
+        for name in ('date_from', 'date_to'):
+            value = request.query_params.get(name)
+            try:
+                dates[name] = datetime.strptime(value, '%Y-%m-%d').date() if value else None
+            except ValueError:
+                return Response({"error": f"Invalid {name}. Use YYYY-MM-DD"}, status=status.HTTP_400_BAD_REQUEST)
+        statement = customer_statement(customer, **dates)
+        return Response(serializers.CustomerStatementSerializer(
+            {'customer': customer.alias_id, **dates, **statement}
+        ).data)
 
     def update(self, request, *args, **kwargs):
         try:
@@ -177,7 +351,7 @@ class HasCustomerActivity(viewsets.ModelViewSet):
         except Customer.DoesNotExist:
             return False
         
-class CreditInvoiceViewSet(viewsets.ModelViewSet):
+class CreditInvoiceViewSet(WorkerThreadMixin, ReplicaReadsMixin, BranchScopedMixin, VersionedUpdateMixin, viewsets.ModelViewSet):
     serializer_class = serializers.CreditInvoiceSerializer
     queryset = CreditInvoice.objects.all()
     lookup_field = 'alias_id'
@@ -190,18 +364,16 @@ class CreditInvoiceViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         params = self.request.query_params
-        branch = params.get('branch')
         customer = params.get('customer')
         date_from = params.get('transaction_date_after')
         date_to = params.get('transaction_date_before')
         payment_status = params.get('payment', 'all')
         report_date = params.get('report_date')
 
-        queryset = CreditInvoice.objects.all()
+        queryset = CreditInvoice.objects.select_related('customer', 'payment')
         
         # Apply filters
-        if branch:
-            queryset = queryset.filter(branch__alias_id=branch)
+        queryset = self.filter_branch(queryset)
         if date_from:
             queryset = queryset.filter(transaction_date__gte=date_from)
         if date_to:
@@ -299,26 +471,6 @@ class CreditInvoiceViewSet(viewsets.ModelViewSet):
     def create(self, request, *args, **kwargs):
         return super().create(request, *args, **kwargs)
 
-    @transaction.atomic
-    def update(self, request, *args, **kwargs):
-
-        instance = self.get_object()
-        if int(request.data.get('version')) != instance.version:
-            return Response({'error': 'Version conflict'}, status=status.HTTP_409_CONFLICT)
-        
-        partial = kwargs.pop('partial', False)
-        serializer = self.get_serializer(
-            instance, 
-            data=request.data,  
-            partial=partial
-        )
-        serializer.is_valid(raise_exception=True)
-    #     if 'customer' in validated_data:
-    #         validated_data['payment_grace_days'] = validated_data['customer'].grace_days 
-        serializer.save(updated_by=request.user, version=instance.version + 1)
-        
-        return Response(serializer.data)
-
     @method_decorator(never_cache)  # 👈 Disable caching
     def list(self, request, *args, **kwargs):
         response = super().list(request, *args, **kwargs)
@@ -328,69 +480,202 @@ class CreditInvoiceViewSet(viewsets.ModelViewSet):
 
 # payment implemente here 
 
-class PaymentInstrumentTypeViewSet(viewsets.ReadOnlyModelViewSet):
+class PaymentInstrumentTypeViewSet(ReplicaReadsMixin, BranchScopedMixin, viewsets.ReadOnlyModelViewSet):
     queryset = PaymentInstrumentType.objects.all()
     serializer_class = serializers.PaymentInstrumentTypeSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        branch_id = self.request.query_params.get('branch')
-
-        if branch_id:
-            # Use alias_id directly in the filter
-            queryset = queryset.filter(branch__alias_id=branch_id)
-
+        queryset = self.filter_branch(super().get_queryset())
         return queryset.order_by('serial_no')
+
+    @cache_branch_response('reference')
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
     
     
-class PaymentInstrumentsViewSet(viewsets.ModelViewSet):
+class PaymentInstrumentsViewSet(ReplicaReadsMixin, BranchScopedMixin, viewsets.ModelViewSet):
     queryset = PaymentInstrument.objects.all()
     serializer_class = PaymentInstrumentSerializer
     # Remove filterset_fields since we'll handle filtering manually
     # filterset_fields= ['branch', 'is_active']
+    filter_backends = [DjangoFilterBackend, TrigramSearchFilter]
+    trigram_search = [('', PaymentInstrument, ['instrument_name'])]
     
     def get_queryset(self):
         queryset = super().get_queryset()
-        branch_id = self.request.query_params.get('branch')
         instrument_type_serial_no = self.request.query_params.get('instrument_type_serial_no')
         is_active = self.request.query_params.get('is_active', 'true').lower() == 'true'
         
         
         queryset = queryset.filter(is_active=is_active)
-
-        if branch_id:
-            # Use alias_id directly in the filter
-            queryset = queryset.filter(branch__alias_id=branch_id)
+        queryset = self.filter_branch(queryset)
 
         if instrument_type_serial_no:
             queryset = queryset.filter(instrument_type__serial_no=instrument_type_serial_no)
 
         return queryset.order_by('serial_no')
+
+    @cache_branch_response('reference')
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
     
 
-class PaymentViewSet(viewsets.ModelViewSet):
+class PaymentViewSet(ReplicaReadsMixin, BranchScopedMixin, VersionedUpdateMixin, viewsets.ModelViewSet):
     queryset = Payment.objects.all()
     serializer_class = PaymentSerializer #PaymentViewSerializer
     lookup_field = 'alias_id'
+
+    # Fields of an existing PaymentDetails row that an update may change
+    DETAIL_EDITABLE_FIELDS = ['detail', 'amount']
     
     def get_serializer_class(self):
         # if self.action == 'create':
         #     return PaymentSerializer
         return PaymentSerializer #PaymentViewSerializer
-     
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        # List pages get the payment header plus summary columns; nested
+        # details/invoices are only rendered when asked for with ?expand=
+        context['slim'] = self.action == 'list'
+        return context
+
+    def payment_summary_annotations(self):
+        details = PaymentDetails.objects.filter(payment=OuterRef('pk')).order_by().values('payment')
+        invoices = CreditInvoice.objects.filter(payment=OuterRef('pk')).order_by().values('payment')
+        decimal_field = DecimalField(max_digits=18, decimal_places=4)
+        return {
+            'details_count': Coalesce(Subquery(details.annotate(c=Count('id')).values('c')), 0),
+            'details_amount': Coalesce(
+                Subquery(details.annotate(s=Sum('amount')).values('s'), output_field=decimal_field),
+                Value(0), output_field=decimal_field),
+            'invoice_count': Coalesce(Subquery(invoices.annotate(c=Count('id')).values('c')), 0),
+            'invoice_net_amount': Coalesce(
+                Subquery(invoices.annotate(s=Sum(F('sales_amount') - F('sales_return'))).values('s'),
+                         output_field=decimal_field),
+                Value(0), output_field=decimal_field),
+        }
+
+    @staticmethod
+    def prefetch_expansions(queryset, expanded):
+        if 'payment_details' in expanded:
+            queryset = queryset.prefetch_related(Prefetch(
+                'paymentdetails_set',
+                queryset=PaymentDetails.objects.select_related('payment_instrument__instrument_type')
+            ))
+        if 'invoices' in expanded:
+            queryset = queryset.prefetch_related(Prefetch(
+                'invoice_set',
+                queryset=CreditInvoice.objects.select_related('customer')
+            ))
+        return queryset
+
+    @staticmethod
+    def reserve_id_numbers(counts):
+        """
+        {instrument_type_id: count} -> {instrument_type_id: iterator of the next
+        `count` auto numbers}, locking each instrument type row once.
+        """
+        locked = PaymentInstrumentType.objects.select_for_update().in_bulk(counts)
+        numbers = {}
+        for type_id, count in counts.items():
+            instrument_type = locked[type_id]
+            first = instrument_type.last_number + 1
+            numbers[type_id] = iter([f"{instrument_type.prefix}{n:04d}" for n in range(first, first + count)])
+            instrument_type.last_number += count
+        # No post_save: the reference cache ignores last_number anyway
+        PaymentInstrumentType.objects.bulk_update(locked.values(), ['last_number'])
+        return numbers
+
+    def validate_new_details(self, new_details, branch_id):
+        """
+        Resolve the instruments of [(index, detail data)] to be created and
+        check their manual ID numbers against the branch, in at most one
+        query. Returns a 400 Response, or None when they can be created.
+        """
+        for index, detail_data in new_details:
+            payment_instrument = detail_data.get('payment_instrument')
+
+            if 'alias_id' in detail_data and not detail_data['alias_id']:
+                del detail_data['alias_id']
+
+            instrument = PaymentInstrumentPolicy.get_instrument(payment_instrument)
+            if instrument is None:
+                return Response({"error": f"Instruement with id {payment_instrument} does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+            detail_data['payment_instrument'] = instrument
+
+        # Manual ID numbers must be unique within the branch
+        manual_numbers = [detail_data.get('id_number') for _, detail_data in new_details
+                          if not detail_data['payment_instrument'].instrument_type.auto_number]
+        taken = set(PaymentDetails.objects.filter(
+            branch_id=branch_id, id_number__in=[n for n in manual_numbers if n]
+        ).values_list('id_number', flat=True)) if any(manual_numbers) else set()
+        errors = {}
+        seen = set()
+        for index, detail_data in new_details:
+            if detail_data['payment_instrument'].instrument_type.auto_number:
+                continue
+            id_number = detail_data.get('id_number')
+            if id_number in taken or (id_number and id_number in seen):
+                errors[f'payment_details.{index}.id_number'] = ["This ID number already exists in this branch."]
+            seen.add(id_number)
+
+        if errors:
+            return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+        return None
+
+    def create_details(self, payment, details_data, received_date):
+        """
+        bulk_create the validated details of `payment` (see validate_new_details)
+        and the claims of their claim instruments.
+        """
+        auto_numbered = Counter(
+            detail_data['payment_instrument'].instrument_type_id for detail_data in details_data
+            if detail_data['payment_instrument'].instrument_type.auto_number
+        )
+        numbers = self.reserve_id_numbers(auto_numbered) if auto_numbered else {}
+        details = []
+        for detail_data in details_data:
+            instrument = detail_data['payment_instrument']
+            if instrument.instrument_type.auto_number:
+                detail_data['id_number'] = next(numbers[instrument.instrument_type_id])
+            details.append(PaymentDetails(payment=payment, branch_id=payment.branch_id,
+                                          received_date=received_date, **detail_data))
+        details = PaymentDetails.objects.bulk_create(details)
+
+        claims = []
+        for payment_details in details:
+            if payment_details.payment_instrument.instrument_type.serial_no == 3:
+                claim = Claim(
+                    branch_id=payment.branch_id,
+                    payment_details=payment_details,
+                    customer=payment.customer,
+                    claim_amount=payment_details.amount,
+                    claim_date=payment.received_date,
+                )
+                claim._sync_remaining_amount()
+                claims.append(claim)
+        if claims:
+            Claim.objects.bulk_create(claims)
+            invalidate_claims_summary(payment.branch_id)  # bulk_create sends no post_save
+        return details
+
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = super().get_queryset().select_related('customer')
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.annotate(**self.payment_summary_annotations())
+
+        expanded = PaymentSerializer.requested_expansions(self.request, self.action == 'list')
+        queryset = self.prefetch_expansions(queryset, expanded)
 
-        branch_id = self.request.query_params.get('branch')
         date_from = self.request.query_params.get('date_from')
         date_to = self.request.query_params.get('date_to')
         customer_id = self.request.query_params.get('customer')
         # is_fully_allocated = self.request.query_params.get('is_fully_allocated')
         
     
-        if branch_id:
-            queryset = queryset.filter(branch__alias_id=branch_id)
+        queryset = self.filter_branch(queryset)
             
         if date_from:
             queryset = queryset.filter(received_date__gte=date_from)
@@ -419,9 +704,8 @@ class PaymentViewSet(viewsets.ModelViewSet):
 
        
         branch_alias_id = validated_data.get('branch')
-        try:
-            branch = Branch.objects.get(alias_id=branch_alias_id)
-        except Branch.DoesNotExist:
+        branch = branch_for_alias(branch_alias_id)
+        if branch is None:
             return Response({"error": f"Branch with alias_id {branch_alias_id} does not exist."}, status=status.HTTP_400_BAD_REQUEST)
         validated_data['branch'] = branch
 
@@ -431,58 +715,33 @@ class PaymentViewSet(viewsets.ModelViewSet):
         except Customer.DoesNotExist:
             return Response({"error": f"Customer with alias_id {customer_alias_id} does not exist."}, status=status.HTTP_400_BAD_REQUEST)
         validated_data['customer'] = customer
-         # Create the Payment instance
-        payment = Payment.objects.create(**validated_data)
-
-        # Handle PaymentDetails
-        errors = {}
-        for index, detail_data in enumerate(payment_details_data):
-            payment_instrument = detail_data['payment_instrument']
-            
-            if 'alias_id' in detail_data and not detail_data['alias_id']:
-                del detail_data['alias_id']
 
-            try:
-                instrument = PaymentInstrument.objects.get(id=payment_instrument)
-            except Customer.DoesNotExist:
-                return Response({"error": f"Instruement with id {payment_instrument} does not exist."}, status=status.HTTP_400_BAD_REQUEST)
-            payment_details_data[index]['payment_instrument'] = instrument
-            
-            # Handle auto-number generation
-            if instrument.instrument_type.auto_number:
-                locked_type = PaymentInstrumentType.objects.select_for_update().get(pk=instrument.instrument_type.id)
-                locked_type.last_number += 1
-                detail_data['id_number'] = f"{locked_type.prefix}{locked_type.last_number:04d}"
-                locked_type.save()
-            else:
-                # Check if the ID number is unique within the same branch
-                if PaymentDetails.objects.filter(branch=payment.branch, id_number=detail_data.get('id_number')).exists():
-                    errors[f'payment_details.{index}.id_number'] = ["This ID number already exists in this branch."]
-        
-        if errors:
-            return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+        # Validate details and invoices with a fixed number of queries before
+        # writing anything
+        error = self.validate_new_details(list(enumerate(payment_details_data)), branch.id)
+        if error:
+            return error
+
+        invoice_alias_ids = [invoice_data.get('alias_id') for invoice_data in invoices_data]
+        if not all(invoice_alias_ids):
+            return Response({"error": "Missing 'alias_id' for one or more invoices"}, status=status.HTTP_400_BAD_REQUEST)
+        if invoice_alias_ids:
+            found = set(CreditInvoice.objects.filter(alias_id__in=invoice_alias_ids).values_list('alias_id', flat=True))
+            missing = next((alias_id for alias_id in invoice_alias_ids if alias_id not in found), None)
+            if missing:
+                return Response({"error": f"Invoice with alias_id {missing} does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Create the Payment instance
+        payment = Payment.objects.create(**validated_data)
 
         # Create PaymentDetails and claim objects
-        for detail_data in payment_details_data:
-            
-            payment_details= PaymentDetails.objects.create(payment=payment, branch=payment.branch, **detail_data)
-            if instrument.instrument_type.serial_no == 3:
-                Claim.objects.create(branch=payment.branch, payment_details = payment_details
-                )
-
-        # Update CreditInvoices
-        for invoice_data in invoices_data:
-            invoice_alias_id = invoice_data.get('alias_id')
-            if not invoice_alias_id:
-                return Response({"error": "Missing 'alias_id' for one or more invoices"}, status=status.HTTP_400_BAD_REQUEST)
+        self.create_details(payment, payment_details_data, payment.received_date)
 
-            try:
-                invoice = CreditInvoice.objects.get(alias_id=invoice_alias_id)
-                invoice.payment = payment # Mark invoice as paid
-                invoice.status = True  
-                invoice.save()
-            except CreditInvoice.DoesNotExist:
-                return Response({"error": f"Invoice with alias_id {invoice_alias_id} does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+        # Mark the invoices paid
+        if invoice_alias_ids:
+            CreditInvoice.objects.filter(alias_id__in=invoice_alias_ids).update(
+                payment=payment, status=True, updated_at=timezone.now()
+            )
 
         # Update the Payment amounts
         payment.total_amount = total_amount
@@ -492,162 +751,167 @@ class PaymentViewSet(viewsets.ModelViewSet):
 
         # Return the created payment object with the serializer
         # return Response(PaymentViewSerializer(payment).data, status=status.HTTP_201_CREATED)
+        payment = self.prefetch_expansions(
+            Payment.objects.select_related('customer'), PaymentSerializer.Meta.expandable_fields
+        ).get(pk=payment.pk)
         return Response(PaymentSerializer(payment).data, status=status.HTTP_201_CREATED)
     
 
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def allocate(self, request):
+        """
+        Propose the invoices a received amount settles for a parent customer:
+        ?branch=<alias>&customer=<parent alias>&amount=<received amount>
+        The `invoices` list can be posted as-is to create().
+        """
+        branch_alias_id = request.query_params.get('branch')
+        customer_alias_id = request.query_params.get('customer')
+        if not customer_alias_id:
+            return Response({"error": "customer is required"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            amount = Decimal(request.query_params.get('amount', ''))
+        except ArithmeticError:
+            return Response({"error": "amount must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        if not amount.is_finite() or amount <= 0:
+            return Response({"error": "amount must be a positive number"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if branch_alias_id and self.get_branch_id() is None:
+            return Response({"error": f"Branch with alias_id {branch_alias_id} does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+
+        invoices = load_unpaid_invoices(customer_alias_id, self.get_branch_id())
+        proposal = propose_allocation(invoices, amount)
+        proposal.update({
+            'branch': branch_alias_id,
+            'customer': customer_alias_id,
+            'total_amount': proposal['received_amount'],
+        })
+        return Response(serializers.AllocationProposalSerializer(proposal).data)
+
     @transaction.atomic
     def update(self, request, *args, **kwargs):
         payment = self.get_object()
-        
-        # Version check
-        client_version = request.data.get('version')
-        if client_version and int(client_version) != payment.version:
-            return Response(
-                {"error": "This payment has been modified by another user. Please refresh."},
-                status=status.HTTP_409_CONFLICT
-            )
+        # Enforced by the final UPDATE; a conflict there rolls back the whole edit.
+        # Fail fast on an already stale version before touching details/invoices.
+        expected_version = self.get_expected_version(payment)
+        if expected_version != payment.version:
+            raise VersionConflict()
 
         # Extract data
         validated_data = request.data.copy()
         payment_details_data = validated_data.pop('payment_details', [])
         invoices_data = validated_data.pop('invoices', [])
-        print('payment_details_data:', payment_details_data)
 
         # Update payment fields
         for field, value in validated_data.items():
-            if field in ['branch', 'customer']:
+            if field == 'branch':
+                branch = branch_for_alias(value)
+                if branch is None:
+                    return Response({"error": "Branch matching query does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+                # Details and claims carry the payment's branch_id, and id
+                # numbers are unique per branch: a payment stays in its branch
+                if branch.pk != payment.branch_id:
+                    return Response({"error": "A payment can't be moved to another branch."}, status=status.HTTP_400_BAD_REQUEST)
+            elif field == 'customer':
                 try:
-                    if field == 'branch':
-                        obj = Branch.objects.get(alias_id=value)
-                    else:
-                        obj = Customer.objects.get(alias_id=value)
-                    setattr(payment, field, obj)
-                except (Branch.DoesNotExist, Customer.DoesNotExist) as e:
+                    payment.customer = Customer.objects.get(alias_id=value)
+                except Customer.DoesNotExist as e:
                     return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
             elif hasattr(payment, field):
                 setattr(payment, field, value)
-
-        # Handle payment details updates
-        #existing_detail_alias_ids = [d.alias_id for d in payment.paymentdetails_set.all()]
-        # request_detail_alias_ids = [d.get('alias_id') for d in payment_details_data if d.get('alias_id')]
-        updated_detail_ids = []
-
-        # if not set(existing_detail_id_numbers).issubset(set(request_detail_id_numbers)):
-        #     return Response({"error": "Numbers of existing information can't be deleted removed"}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # print('request_detail_id_numbers:', request_detail_id_numbers)
-
-        for detail_data in payment_details_data:
-            detail_alias_id = detail_data.get('alias_id')
-            if detail_alias_id: # and detail_alias_id in existing_detail_alias_ids:
-                # Update existing detail
-                try:
-                    detail = PaymentDetails.objects.get(alias_id=detail_alias_id)
-                    # instrument = PaymentInstrument.objects.get(id=detail_data['payment_instrument'])
-                    if not detail.payment_instrument.id == detail_data['payment_instrument'] or not detail.id_number == detail_data['id_number']:
-                        return Response({"error": "Numbers of existing instrument or Id Number can't be deleted or changed"}, status=status.HTTP_400_BAD_REQUEST)
-                        # No changes to instrument or ID number, just update other fields
-                    # For existing details, don't change ID number
-                    for field, value in detail_data.items():
-                        # if field == 'payment_instrument':
-                        #     setattr(detail, field, instrument)
-                        # elif 
-                        if field != 'id_number' and field != 'payment_instrument' and field != 'alias_id' and hasattr(detail, field):
-                            setattr(detail, field, value)
-                    detail.save()
-                    updated_detail_ids.append(detail.alias_id)
-                except (PaymentDetails.DoesNotExist, PaymentInstrument.DoesNotExist):
-                    continue
-            else:
-                # Create new detail
-                try:
-                    instrument = PaymentInstrument.objects.get(id=detail_data['payment_instrument'])
-                    id_number = None
-                    
-                    # Handle auto-numbering
-                    if instrument.instrument_type.auto_number:
-                        # Lock the type row to prevent concurrent updates
-                        # with transaction.atomic():
-                        locked_type = PaymentInstrumentType.objects.select_for_update().get(
-                            pk=instrument.instrument_type.id
-                        )
-                        locked_type.last_number += 1
-                        id_number = f"{locked_type.prefix}{locked_type.last_number:04d}"
-                        locked_type.save()
-                    else:
-                        id_number = detail_data.get('id_number', '')
-                        # Manual ID - check uniqueness
-                        if id_number and PaymentDetails.objects.filter(
-                            branch=payment.branch, 
-                            id_number=id_number
-                        ).exists():
-                            return Response(
-                                {"error": f"ID number {id_number} already exists in this branch"},
-                                status=status.HTTP_400_BAD_REQUEST
-                            )
-                    
-                    # Create detail
-                    detail = PaymentDetails.objects.create(
-                        payment=payment,
-                        branch=payment.branch,
-                        payment_instrument=instrument,
-                        id_number=id_number,
-                        amount=detail_data.get('amount', 0),
-                        detail=detail_data.get('detail', '')
-                    )
-                    updated_detail_ids.append(detail.alias_id)
-                    
-                    # Create claim if needed
-                    if instrument.instrument_type.serial_no == 3:
-                        Claim.objects.create(
-                            branch=payment.branch,
-                            payment_details=detail
-                        )
-                            
-                except PaymentInstrument.DoesNotExist:
-                    continue
-
-        # Delete removed details
-        if (PaymentDetails.objects.filter(payment=payment).exclude(alias_id__in=updated_detail_ids).exists()):
+        # Details carry a copy of the received date (their partition key)
+        received_date = Payment._meta.get_field('received_date').to_python(payment.received_date)
+
+        # Load the payment's current details and invoices once and diff the
+        # request against them in memory
+        existing_details = {d.alias_id: d for d in PaymentDetails.objects.filter(payment=payment)}
+        changed_details = []
+
+        # Reject the whole edit before anything is written: a detail of another
+        # payment (or none at all) can't be edited here, and existing details
+        # can't be removed
+        kept_detail_ids = {d.get('alias_id') for d in payment_details_data if d.get('alias_id')}
+        unknown = kept_detail_ids - set(existing_details)
+        if unknown:
+            return Response(
+                {"error": f"Payment details {', '.join(sorted(unknown))} do not belong to this payment."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if set(existing_details) - kept_detail_ids:
             return Response(
                 {"error": "Cannot remove existing payment details."},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        # PaymentDetails.objects.filter(payment=payment).exclude(id__in=updated_detail_ids).delete()
 
-        # Handle invoice updates
-        existing_invoice_ids = [i.alias_id for i in payment.invoice_set.all()]
-        updated_invoice_ids = []
-        
-        for invoice_data in invoices_data:
-            invoice_alias_id = invoice_data.get('alias_id')
-            if invoice_alias_id:
-                try:
-                    invoice = CreditInvoice.objects.get(alias_id=invoice_alias_id)
-                    invoice.payment = payment
-                    invoice.status = True
-                    invoice.save()
-                    updated_invoice_ids.append(invoice.alias_id)
-                except CreditInvoice.DoesNotExist:
-                    continue
+        new_details = [(index, d) for index, d in enumerate(payment_details_data) if not d.get('alias_id')]
+        error = self.validate_new_details(new_details, payment.branch_id)
+        if error:
+            return error
 
-        # Unlink removed invoices
-        CreditInvoice.objects.filter(
-            payment=payment
-        ).exclude(
-            alias_id__in=updated_invoice_ids
-        ).update(
-            payment=None,
-            status=False
+        for detail_data in payment_details_data:
+            detail_alias_id = detail_data.get('alias_id')
+            if not detail_alias_id:
+                continue
+            detail = existing_details[detail_alias_id]
+            if detail.payment_instrument_id != detail_data['payment_instrument'] or detail.id_number != detail_data['id_number']:
+                return Response({"error": "Numbers of existing instrument or Id Number can't be deleted or changed"}, status=status.HTTP_400_BAD_REQUEST)
+            # For existing details, only the free-text and amount can change
+            changed = False
+            for field in self.DETAIL_EDITABLE_FIELDS:
+                if field not in detail_data:
+                    continue
+                value = PaymentDetails._meta.get_field(field).to_python(detail_data[field])
+                if getattr(detail, field) != value:
+                    setattr(detail, field, value)
+                    changed = True
+            if changed:
+                changed_details.append(detail)
+
+        if new_details:
+            self.create_details(payment, [d for _, d in new_details], received_date)
+
+        detail_fields = list(self.DETAIL_EDITABLE_FIELDS)
+        moved = [d for d in existing_details.values() if d.received_date != received_date]
+        if moved:
+            # A new received date moves the details to another partition
+            for detail in moved:
+                detail.received_date = received_date
+            changed_details = list({d.pk: d for d in changed_details + moved}.values())
+            detail_fields.append('received_date')
+        if changed_details:
+            PaymentDetails.objects.bulk_update(changed_details, detail_fields)
+
+        # Handle invoice updates: one UPDATE to link, one to unlink
+        linked_invoice_ids = set(
+            CreditInvoice.objects.filter(payment=payment).values_list('alias_id', flat=True)
         )
+        requested_invoice_ids = {i.get('alias_id') for i in invoices_data if i.get('alias_id')}
+        now = timezone.now()
+
+        if requested_invoice_ids - linked_invoice_ids:
+            CreditInvoice.objects.filter(
+                alias_id__in=requested_invoice_ids - linked_invoice_ids
+            ).update(payment=payment, status=True, updated_at=now)
+
+        if linked_invoice_ids - requested_invoice_ids:
+            CreditInvoice.objects.filter(
+                payment=payment,
+                alias_id__in=linked_invoice_ids - requested_invoice_ids
+            ).update(payment=None, status=False, updated_at=now)
 
         # Update payment amounts and version
         payment.total_amount = validated_data.get('total_amount', 0)
         payment.cash_equivalent_amount = validated_data.get('cash_equivalent_amount', 0)
         payment.shortage_amount = validated_data.get('shortage_amount', 0)
-        payment.version = F('version') + 1
-        payment.save()
-        payment.refresh_from_db()
+        payment.updated_by = request.user
+        payment.save_versioned(expected_version)
+
+        # Amounts, customer or received date may have changed under the claims
+        Claim.objects.filter(payment_details__payment=payment).sync_summary()
+        invalidate_claims_summary(payment.branch_id)
+        # Invoice links were changed with queryset updates, which send no signals
+        bump_namespace('dues', payment.branch_id)
+        # Reload through get_queryset so the summary annotations reflect the edit
+        payment = self.get_queryset().get(pk=payment.pk)
 
         return Response(PaymentSerializer(payment).data)
     
@@ -677,13 +941,13 @@ class PaymentViewSet(viewsets.ModelViewSet):
 #                   'remaining_amount_min', 'remaining_amount_max']
 
 class ClaimFilter(FilterSet):
-    customer = CharFilter(field_name='payment_details__payment__customer__alias_id', lookup_expr='icontains')
+    customer = CharFilter(field_name='customer__alias_id', lookup_expr='icontains')
     instrument = CharFilter(field_name='payment_details__payment_instrument__serial_no', lookup_expr='exact')
-    claim_date = DateFilter(field_name='payment_details__payment__received_date', lookup_expr='gte')
+    claim_date = DateFilter(field_name='claim_date', lookup_expr='gte')
 
     # Range filters for claim_amount, refund_amount, and remaining_amount
-    claim_amount_min = NumberFilter(field_name='payment_details__amount', lookup_expr='gte')
-    claim_amount_max = NumberFilter(field_name='payment_details__amount', lookup_expr='lte')
+    claim_amount_min = NumberFilter(field_name='claim_amount', lookup_expr='gte')
+    claim_amount_max = NumberFilter(field_name='claim_amount', lookup_expr='lte')
     
     refund_amount_min = NumberFilter(field_name='refund_amount', lookup_expr='gte')
     refund_amount_max = NumberFilter(field_name='refund_amount', lookup_expr='lte')
@@ -705,37 +969,39 @@ class ClaimFilter(FilterSet):
             'remaining_amount_max'
         ]
 
-class ClaimViewSet(viewsets.ModelViewSet):
+class ClaimViewSet(ReplicaReadsMixin, BranchScopedMixin, VersionedUpdateMixin, viewsets.ModelViewSet):
+    # Claims are only created for claim instruments (serial_no 3), and the
+    # customer/amount/date/remaining columns are denormalized onto the claim,
+    # so filtering and sorting happen on the claim table alone. The joins
+    # below only feed the display columns.
     queryset = Claim.objects.select_related(
-        'payment_details__payment__customer',
+        'customer',
         'payment_details__payment_instrument',
-        'payment_details__payment_instrument__instrument_type',
-    ).filter(
-        payment_details__payment_instrument__instrument_type__serial_no=3
-    ).annotate(
-        remaining_amount=ExpressionWrapper(
-            F('payment_details__amount') - Coalesce(F('refund_amount'), 0),
-            output_field=DecimalField()
-        )
-    )  # Assuming serial_no 3 is for claims
-    # queryset =queryset.filter(instrument_type__serial_no=3)  # Assuming serial_no 3 is for claims
+    )
     serializer_class = ClaimListSerializer
     lookup_field = 'alias_id'
+    replica_actions = ('list', 'retrieve', 'summary')
 
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, TrigramSearchFilter, filters.OrderingFilter]
     filterset_class = ClaimFilter
+    ordering_fields = ['claim_date', 'claim_amount', 'remaining_amount', 'refund_amount', 'submitted_date', 'refund_date']
+    ordering = ['-claim_date']
     # filterset_fields = {
     #     'payment_details__payment__customer__alias_id': ['icontains'],
     #     'payment_details__payment_instrument__instrument_name': ['icontains'],
     #     'payment_details__payment__received_date': ['lte'], #['exact', 'gte', 'lte'],
     # }
-    search_fields = [
-        'payment_details__payment__customer__alias_id',
-        'payment_details__payment_instrument__instrument_name',
+    trigram_search = [
+        ('customer', Customer, ['name', 'alias_id']),
+        ('payment_details__payment_instrument', PaymentInstrument, ['instrument_name']),
+        ('payment_details', PaymentDetails, ['detail', 'id_number']),
     ]
     # Add this line to enable pagination for this ViewSet
     # pagination_class = StandardResultsSetPagination
 
+    def get_queryset(self):
+        return self.filter_branch(super().get_queryset())
+
     # def get_queryset(self):
     #     queryset = super().get_queryset()
 
@@ -772,14 +1038,96 @@ class ClaimViewSet(viewsets.ModelViewSet):
         claim = self.get_object()
         serializer = self.get_serializer(claim, data=request.data, partial=True)
         serializer.is_valid(raise_exception=True)
-        serializer.save(updated_by=request.user, version=claim.version + 1)
+        self.perform_update(serializer)
         return Response(serializer.data)
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAuthenticated])
+    def settle_refunds(self, request):
+        """
+        Apply a supplier refund statement in one go:
+        {"branch": <alias>, "dry_run": false,
+         "rows": [{"claim": <alias_id or id_number>, "refund_amount": .., "refund_date": ..}, ...]}
+        Valid rows are applied, the rest are reported per row.
+        """
+        rows = request.data.get('rows')
+        if not isinstance(rows, list):
+            return Response({"error": "rows must be a list"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            # "false" and 0 mean false, as they do for any serializer BooleanField
+            dry_run = BooleanField().to_internal_value(request.data.get('dry_run', False))
+        except exceptions.ValidationError:
+            return Response({"error": "dry_run must be true or false"}, status=status.HTTP_400_BAD_REQUEST)
+        report = settle_claim_refunds(
+            rows,
+            branch_alias_id=request.data.get('branch'),
+            user=request.user,
+            dry_run=dry_run,
+        )
+        return Response(report)
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def summary(self, request):
+        """
+        Outstanding claims per parent customer and instrument for ?branch=<alias>:
+        count, claimed, refunded and remaining amounts, oldest unsubmitted date.
+        """
+        branch_alias_id = request.query_params.get('branch')
+        branch_id = self.get_branch_id()
+        if branch_id is None:
+            return Response({"error": "A valid branch is required"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'branch': branch_alias_id, **get_claims_summary(branch_id)})
     
+
+class ArchiveViewSet(ReplicaReadsMixin, BranchScopedMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Settled history moved out of the live tables (cheques/archive.py):
+    ?branch=<alias>&customer=<alias>&date_from=..&date_to=.. , newest first,
+    paginated since it only grows.
+    """
+    permission_classes = [IsAuthenticated]
+    lookup_field = 'alias_id'
+    pagination_class = StandardResultsSetPagination
+    date_field = None
+
+    def get_queryset(self):
+        queryset = self.filter_branch(super().get_queryset())
+        params = self.request.query_params
+        if params.get('customer'):
+            queryset = queryset.filter(customer__alias_id=params['customer'])
+        if params.get('date_from'):
+            queryset = queryset.filter(**{f'{self.date_field}__gte': params['date_from']})
+        if params.get('date_to'):
+            queryset = queryset.filter(**{f'{self.date_field}__lte': params['date_to']})
+        return queryset.order_by(f'-{self.date_field}', '-id')
+
+
+class ArchivedCreditInvoiceViewSet(ArchiveViewSet):
+    queryset = ArchivedCreditInvoice.objects.select_related('customer', 'payment')
+    serializer_class = serializers.ArchivedCreditInvoiceSerializer
+    date_field = 'transaction_date'
+
+
+class ArchivedPaymentViewSet(ArchiveViewSet):
+    queryset = ArchivedPayment.objects.select_related('customer').prefetch_related(
+        Prefetch('details', queryset=ArchivedPaymentDetails.objects.select_related('payment_instrument')),
+        Prefetch('invoices', queryset=ArchivedCreditInvoice.objects.only('alias_id', 'payment_id')),
+    )
+    serializer_class = serializers.ArchivedPaymentSerializer
+    date_field = 'received_date'
+
+
+class ArchivedClaimViewSet(ArchiveViewSet):
+    queryset = ArchivedClaim.objects.select_related('customer', 'payment_details__payment_instrument')
+    serializer_class = serializers.ArchivedClaimSerializer
+    date_field = 'claim_date'
+
 # ----------------- end of payment implementation---------------------
 
 
 # --------Latest:01  parent customer due
-class ParentCustomerDueReport(APIView):
+class ParentCustomerDueReport(WorkerThreadMixin, ReplicaReadsMixin, APIView):
+    replica_actions = ('get',)
+
     def get(self, request):
         report_date_str = request.query_params.get('date')
         branch_alias_id = request.query_params.get('branch')  # New branch filter
@@ -797,23 +1145,28 @@ class ParentCustomerDueReport(APIView):
                 {"error": "Invalid date format. Use YYYY-MM-DD"},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
-        
-        customer_qs = Customer.objects.all()
-        invoice_qs = CreditInvoice.objects.all()
-        
-        # Apply branch filter if provided
-        if branch_alias_id:
-            customer_qs = customer_qs.filter(branch__alias_id=branch_alias_id)
-            invoice_qs = invoice_qs.filter(branch__alias_id=branch_alias_id)
+
+        branch_id = request_branch_id(request)
+        if branch_id is None:
+            return Response(
+                {"error": f"Branch with alias_id {branch_alias_id} does not exist."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        return Response(self.build_report(branch_id, report_date))
+
+    @cached_for_branch('dues')
+    def build_report(self, branch_id, report_date):
+        customer_qs = Customer.objects.filter(branch_id=branch_id)
+        invoice_qs = CreditInvoice.objects.filter(branch_id=branch_id)
         
         # Query 1: Get all parent-child relationships with alias_id
-        customer_hierarchy = Customer.objects.filter(
+        customer_hierarchy = customer_qs.filter(
             ( Q(is_parent=True) | Q(parent__isnull=False))
         ).values('alias_id', 'name', 'is_parent', 'parent__alias_id', 'parent__name')
         
         # Query 2: Get all due invoice amounts grouped by customer
-        due_amounts = CreditInvoice.objects.filter(
+        due_amounts = invoice_qs.filter(
             customer__parent__isnull=False,  # Only child customers
             transaction_date__lte=report_date
         ).filter(
@@ -833,7 +1186,11 @@ class ParentCustomerDueReport(APIView):
         
         # Process in Python
         parents = {c['alias_id']: c for c in customer_hierarchy if c['is_parent']}
-        children = {c['alias_id']: c for c in customer_hierarchy if not c['is_parent']}
+        children_by_parent = {}
+        for c in customer_hierarchy:
+            if not c['is_parent']:
+                children_by_parent.setdefault(c['parent__alias_id'], []).append(c)
+        dues_by_customer = {a['customer__alias_id']: a for a in due_amounts}
         
         report_data = []
         grand_total_matured = 0
@@ -850,32 +1207,27 @@ class ParentCustomerDueReport(APIView):
                 'children': []
             }
             
-            for child in children.values():
-                if child['parent__alias_id'] == parent['alias_id']:
-                    amounts = next(
-                        (a for a in due_amounts 
-                         if a['customer__alias_id'] == child['alias_id']), 
-                        {}
-                    )
-                    child_entry = {
-                        'alias_id': child['alias_id'],
-                        'name': child['name'],
-                        'matured_due': amounts.get('matured_due', Decimal(0)) or Decimal(0), 
-                        'immature_due': amounts.get('immature_due', Decimal(0)) or Decimal(0)
-                    }
-                    child_entry['total_due'] = child_entry['matured_due'] + child_entry['immature_due']
-                    parent_entry['children'].append(child_entry)
-                    parent_entry['matured_due'] += child_entry['matured_due']
-                    parent_entry['immature_due'] += child_entry['immature_due']
-                    parent_entry['total_due'] += child_entry['total_due']
-                    
-                    grand_total_matured += child_entry['matured_due']
-                    grand_total_immature += child_entry['immature_due']
-                    grand_total_due += child_entry['total_due']
-            
+            for child in children_by_parent.get(parent['alias_id'], []):
+                amounts = dues_by_customer.get(child['alias_id'], {})
+                child_entry = {
+                    'alias_id': child['alias_id'],
+                    'name': child['name'],
+                    'matured_due': amounts.get('matured_due', Decimal(0)) or Decimal(0), 
+                    'immature_due': amounts.get('immature_due', Decimal(0)) or Decimal(0)
+                }
+                child_entry['total_due'] = child_entry['matured_due'] + child_entry['immature_due']
+                parent_entry['children'].append(child_entry)
+                parent_entry['matured_due'] += child_entry['matured_due']
+                parent_entry['immature_due'] += child_entry['immature_due']
+                parent_entry['total_due'] += child_entry['total_due']
+                
+                grand_total_matured += child_entry['matured_due']
+                grand_total_immature += child_entry['immature_due']
+                grand_total_due += child_entry['total_due']
+
             report_data.append(parent_entry)
         
-        return Response({
+        return {
             'report_date': report_date.strftime('%Y-%m-%d'),
             'data': report_data,
             'grand_totals': {
@@ -883,4 +1235,4 @@ class ParentCustomerDueReport(APIView):
                 'immature_due': grand_total_immature,
                 'total_due': grand_total_due
             }
-        })
\ No newline at end of file
+        }
\ No newline at end of file
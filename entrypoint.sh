@@ -14,13 +14,13 @@ echo "Database is ready!"
 echo "Running database migrations..."
 python manage.py migrate --noinput
 
+# Next months' partitions of the invoice/payment tables; also run daily from cron
+echo "Creating upcoming table partitions..."
+python manage.py create_partitions
+
 echo "Collecting static files..."
 python manage.py collectstatic --noinput
 
+# Worker model, counts and SERVER_MODE=asgi are configured in gunicorn.conf.py
 echo "Starting Gunicorn server..."
-exec gunicorn --bind 0.0.0.0:9000 src.wsgi:application \
-    --workers 3 \
-    --timeout 120 \
-    --access-logfile - \
-    --error-logfile - \
-    "$@"
\ No newline at end of file
+exec gunicorn -c gunicorn.conf.py "$@"
\ No newline at end of file
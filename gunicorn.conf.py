@@ -0,0 +1,84 @@
+# gunicorn.conf.py
+#
+# gunicorn -c gunicorn.conf.py     (entrypoint.sh and procfile use this)
+#
+# Everything can be overridden from the environment:
+#   SERVER_MODE            wsgi (default) or asgi (uvicorn workers, see src/asgi.py)
+#   GUNICORN_WORKER_CLASS  sync | gthread   (WSGI only; default gthread)
+#   GUNICORN_WORKERS       default: sync 2*CPU+1, gthread CPU+1, asgi CPU+1
+#   GUNICORN_THREADS       threads per gthread worker (default 4)
+#   GUNICORN_MAX_WORKERS   cap on the derived worker count (default 12)
+#   GUNICORN_TIMEOUT, GUNICORN_MAX_REQUESTS, GUNICORN_MAX_REQUESTS_JITTER,
+#   GUNICORN_PRELOAD, PORT
+#
+# Each worker (and each gthread thread) holds its own DB connection, so
+# workers * threads must stay below the Postgres/PgBouncer connection limit.
+import os
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    return value.lower() in ('1', 'true', 'yes') if value not in (None, '') else default
+
+
+def available_cpus():
+    # CPUs this process may run on (respects container cpusets), not the host's
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+cpus = available_cpus()
+server_mode = os.environ.get('SERVER_MODE', 'wsgi')
+
+if server_mode == 'asgi':
+    wsgi_app = 'src.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    default_workers = cpus + 1
+else:
+    wsgi_app = 'src.wsgi:application'
+    worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+    # Requests mostly wait on Postgres: sync workers need more processes to
+    # cover that wait, gthread workers cover it with threads instead
+    default_workers = cpus * 2 + 1 if worker_class == 'sync' else cpus + 1
+
+workers = min(env_int('GUNICORN_WORKERS', default_workers), env_int('GUNICORN_MAX_WORKERS', 12))
+threads = env_int('GUNICORN_THREADS', 4) if worker_class == 'gthread' else 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '9000')}"
+timeout = env_int('GUNICORN_TIMEOUT', 120)
+graceful_timeout = 30
+keepalive = 5
+
+# Import the app once in the master and fork: workers share its memory
+# copy-on-write instead of each importing Django, DRF and reportlab
+preload_app = env_bool('GUNICORN_PRELOAD', True)
+
+# Recycle workers to bound slow memory growth; the jitter keeps them from
+# all restarting at the same moment
+max_requests = env_int('GUNICORN_MAX_REQUESTS', 1000)
+max_requests_jitter = env_int('GUNICORN_MAX_REQUESTS_JITTER', 100)
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Never share a connection opened in the master (preload_app) with the workers
+    if not server.cfg.preload_app:
+        return
+    from django.db import connections
+    connections.close_all()
+
+
+def when_ready(server):
+    server.log.info(
+        'mode=%s worker_class=%s workers=%s threads=%s cpus=%s preload=%s',
+        server_mode, worker_class, workers, threads, cpus, preload_app,
+    )
@@ -0,0 +1,73 @@
+# scripts/bench_db_connections.py
+#
+# Per-request latency with and without persistent DB connections.
+#
+#   python manage.py runscript bench_db_connections --script-args branch=<alias> requests=200
+#
+# Sends the same authenticated GET through the full Django stack (middleware,
+# JWT auth, view, request_finished) with CONN_MAX_AGE=0 - a new connection
+# per request, as before - and then with the configured CONN_MAX_AGE.
+# Run it against the real Postgres (or PgBouncer) the app uses; over a local
+# SQLite file the connect cost is close to zero.
+import statistics
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from cheques.models import Branch
+
+
+def parse_args(args):
+    options = {'requests': '200', 'path': '/v1/chq/payments/', 'branch': None, 'user': None}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        options[key] = value
+    return options
+
+
+def measure(client, path, params, headers, count, conn_max_age):
+    connection.close()
+    connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = client.get(path, params, **headers)
+        timings.append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            raise SystemExit(f'{path} answered {response.status_code}: {response.content[:200]!r}')
+
+    timings.sort()
+    return {
+        'mean': statistics.mean(timings),
+        'p50': timings[len(timings) // 2],
+        'p95': timings[int(len(timings) * 0.95) - 1],
+    }
+
+
+def run(*args):
+    options = parse_args(args)
+    count = int(options['requests'])
+
+    user = User.objects.get(username=options['user']) if options['user'] else User.objects.filter(is_active=True).first()
+    branch = options['branch'] or Branch.objects.values_list('alias_id', flat=True).first()
+    host = next((h.strip() for h in settings.ALLOWED_HOSTS if h.strip() not in ('', '*')), 'localhost')
+    headers = {
+        'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}',
+        'HTTP_HOST': host,
+    }
+    client = Client()
+    configured = settings.DATABASES['default'].get('CONN_MAX_AGE', 0)
+
+    # Warm up imports and caches first
+    measure(client, options['path'], {'branch': branch}, headers, 10, configured)
+
+    print(f"{options['path']}?branch={branch}  {count} requests  "
+          f"engine={connection.vendor} pool_mode={getattr(settings, 'DB_POOL_MODE', 'session')}")
+    for label, conn_max_age in (('CONN_MAX_AGE=0', 0), (f'CONN_MAX_AGE={configured}', configured)):
+        result = measure(client, options['path'], {'branch': branch}, headers, count, conn_max_age)
+        print(f"  {label:<18} mean {result['mean']:7.2f} ms   p50 {result['p50']:7.2f} ms   p95 {result['p95']:7.2f} ms")
@@ -0,0 +1,89 @@
+# scripts/bench_json_renderer.py
+#
+# Stdlib JSONRenderer vs cheques.renderers.ORJSONRenderer on large payloads.
+#
+#   python manage.py runscript bench_json_renderer --script-args rows=20000 repeat=5
+#
+# Two payloads: an unpaginated invoice list shaped like CreditInvoiceSerializer
+# output (decimals already strings), and a due report holding raw Decimals
+# (rendered through the encoder fallback). No database access.
+import datetime
+import time
+from decimal import Decimal
+
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from cheques.renderers import ORJSONRenderer
+
+
+def parse_args(args):
+    options = {'rows': '20000', 'repeat': '5'}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        options[key] = value
+    return int(options['rows']), int(options['repeat'])
+
+
+def invoice_list(rows):
+    now = timezone.now()
+    return [
+        {
+            'alias_id': f'{i:010x}',
+            'branch': 'a1b2c3d4e5',
+            'grn': f'GRN-{i:07d}',
+            'customer': f'{i % 500:010x}',
+            'customer_name': f'Customer {i % 500}',
+            'transaction_date': (datetime.date(2025, 1, 1) + datetime.timedelta(days=i % 365)).isoformat(),
+            'delivery_man': 'Rahim',
+            'transaction_details': None,
+            'sales_amount': f'{Decimal(1000 + i % 9000) + Decimal("0.2500"):.4f}',
+            'sales_return': '0.0000',
+            'payment_grace_days': 30,
+            'invoice_image': None,
+            'status': True,
+            'payment': None,
+            'updated_at': now.isoformat(),
+            'version': 1,
+        }
+        for i in range(rows)
+    ]
+
+
+def due_report(rows):
+    parents = []
+    for p in range(max(1, rows // 20)):
+        children = [
+            {
+                'alias_id': f'{p:05x}{c:05x}',
+                'name': f'Child {p}-{c}',
+                'matured_due': Decimal(1234 + c) + Decimal('0.5000'),
+                'immature_due': Decimal(321 + p) + Decimal('0.2500'),
+                'total_due': Decimal(1555 + c + p) + Decimal('0.7500'),
+            }
+            for c in range(20)
+        ]
+        parents.append({'alias_id': f'{p:010x}', 'name': f'Parent {p}', 'matured_due': Decimal('24690.0000'),
+                        'immature_due': Decimal('6425.0000'), 'total_due': Decimal('31115.0000'), 'children': children})
+    return {'report_date': '2025-06-30', 'data': parents,
+            'grand_totals': {'matured_due': Decimal('1.0000'), 'immature_due': Decimal('2.0000'), 'total_due': Decimal('3.0000')}}
+
+
+def best_of(renderer, payload, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = renderer.render(payload, 'application/json', {})
+        took = time.perf_counter() - start
+        best = took if best is None else min(best, took)
+    return best * 1000, len(body)
+
+
+def run(*args):
+    rows, repeat = parse_args(args)
+    for name, payload in (('invoice list', invoice_list(rows)), ('due report', due_report(rows))):
+        stdlib_ms, size = best_of(JSONRenderer(), payload, repeat)
+        orjson_ms, orjson_size = best_of(ORJSONRenderer(), payload, repeat)
+        print(f'{name:<13} {rows} rows  {size / 1024:8.0f} KiB   JSONRenderer {stdlib_ms:8.1f} ms   '
+              f'ORJSONRenderer {orjson_ms:7.1f} ms   x{stdlib_ms / orjson_ms:4.1f}'
+              + ('' if size == orjson_size else f'   (size differs: {orjson_size})'))
@@ -0,0 +1,214 @@
+# scripts/loadtest.py
+#
+# Small closed-loop HTTP load generator (standard library only), used to
+# compare gunicorn worker models (gunicorn.conf.py):
+#
+#   GUNICORN_WORKER_CLASS=sync    gunicorn -c gunicorn.conf.py
+#   GUNICORN_WORKER_CLASS=gthread gunicorn -c gunicorn.conf.py
+#   SERVER_MODE=asgi              gunicorn -c gunicorn.conf.py
+#
+#   python scripts/loadtest.py --token <JWT access token> --concurrency 16 --duration 20 \
+#       http://localhost:9000/v1/chq/payments/?branch=<alias> \
+#       http://localhost:9000/v1/chq/parent-customer-due-report/?branch=<alias>
+#
+# Each of the --concurrency clients requests the URLs in turn, back to back,
+# for --duration seconds; throughput and latency percentiles are printed per
+# URL and overall. Non-2xx answers (redirects included) count as errors;
+# when hitting gunicorn directly with DEBUG off, pass
+# --header "X-Forwarded-Proto: https" as nginx would, or every request is
+# redirected to https.
+#
+# Benchmark suite: against a dataset made by the generate_dataset command,
+#
+#   python manage.py generate_dataset --manifest dataset.json
+#   python scripts/loadtest.py --suite dataset.json --base-url http://localhost:9000 \
+#       --token <JWT> --concurrency 8 --duration 30 --label "gthread 4x8" --results loadtest-results.jsonl
+#
+# runs each scenario of SCENARIOS (invoice list, payment create, due report,
+# claims; pick some with --scenario) on its own and appends one JSON line per
+# run to --results, so runs before and after a change can be compared.
+# payment-create posts real cash payments to the first branch of the dataset.
+import argparse
+import json
+import random
+import threading
+import time
+from collections import namedtuple
+from datetime import date, datetime, timezone
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+
+# body: None for GET, or a function returning the JSON payload of each request
+Target = namedtuple('Target', 'name method url body')
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(timings, elapsed):
+    timings = sorted(timings)
+    return {
+        'requests': len(timings),
+        'throughput': len(timings) / elapsed if elapsed else 0.0,
+        'p50': percentile(timings, 0.50),
+        'p95': percentile(timings, 0.95),
+        'p99': percentile(timings, 0.99),
+    }
+
+
+def run_load(targets, concurrency, duration, headers, timeout=60):
+    """Run plain URLs (GET) or Targets; results are keyed by URL / target name."""
+    targets = [t if isinstance(t, Target) else Target(t, 'GET', t, None) for t in targets]
+    names = [target.name for target in targets]
+    timings = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    opener = urllib.request.build_opener(NoRedirect)
+
+    def client(offset):
+        position = offset
+        while time.perf_counter() < deadline:
+            target = targets[position % len(targets)]
+            position += 1
+            data = None
+            request_headers = headers
+            if target.body is not None:
+                data = json.dumps(target.body()).encode()
+                request_headers = dict(headers, **{'Content-Type': 'application/json'})
+            request = urllib.request.Request(target.url, data=data, headers=request_headers, method=target.method)
+            start = time.perf_counter()
+            try:
+                with opener.open(request, timeout=timeout) as response:
+                    response.read()
+                ok = True
+            except (urllib.error.URLError, OSError):
+                ok = False
+            took = (time.perf_counter() - start) * 1000
+            with lock:
+                if ok:
+                    timings[target.name].append(took)
+                else:
+                    errors[target.name] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    results = {name: dict(summarize(timings[name], elapsed), errors=errors[name]) for name in names}
+    results['total'] = dict(
+        summarize([t for name in names for t in timings[name]], elapsed),
+        errors=sum(errors.values()),
+    )
+    return results
+
+
+def suite_targets(manifest, base_url):
+    """SCENARIOS name -> Target, for the first branch of a generate_dataset manifest."""
+    branch = manifest['branches'][0]
+    alias = branch['alias_id']
+    api = base_url.rstrip('/') + '/v1/chq'
+    today = date.today().isoformat()
+
+    def payment():
+        amount = f'{random.randint(100, 5000)}.00'
+        return {
+            'branch': alias,
+            'customer': random.choice(branch['parents']),
+            'received_date': today,
+            'payment_details': [{'payment_instrument': branch['instruments']['cash'], 'amount': amount}],
+            'invoices': [],
+            'total_amount': amount,
+            'cash_equivalent_amount': amount,
+            'shortage_amount': '0',
+        }
+
+    return {
+        'invoice-list': Target('invoice-list', 'GET', f'{api}/credit-invoices/?branch={alias}&payment=unpaid', None),
+        'payment-create': Target('payment-create', 'POST', f'{api}/payments/', payment),
+        'due-report': Target('due-report', 'GET', f'{api}/parent-customer-due-report/?branch={alias}&date={today}', None),
+        'claims': Target('claims', 'GET', f'{api}/claims/?branch={alias}', None),
+    }
+
+
+SCENARIOS = ['invoice-list', 'payment-create', 'due-report', 'claims']
+
+
+def run_suite(manifest, base_url, scenarios, concurrency, duration, headers):
+    targets = suite_targets(manifest, base_url)
+    results = {}
+    for name in scenarios:
+        results[name] = run_load([targets[name]], concurrency, duration, headers)[name]
+    return results
+
+
+def save_results(path, label, options, results):
+    record = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'label': label,
+        'concurrency': options.concurrency,
+        'duration': options.duration,
+        'results': results,
+    }
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def print_results(results):
+    print(f"{'url / scenario':<60} {'req':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'err':>5}")
+    for url, result in results.items():
+        print(f"{url[-60:]:<60} {result['requests']:>7} {result['throughput']:>8.1f} "
+              f"{result['p50']:>8.1f} {result['p95']:>8.1f} {result['p99']:>8.1f} {result['errors']:>5}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Closed-loop HTTP load test')
+    parser.add_argument('urls', nargs='*')
+    parser.add_argument('--suite', metavar='MANIFEST', help='run the benchmark scenarios on a generate_dataset manifest')
+    parser.add_argument('--base-url', default='http://localhost:8000', help='server the suite runs against')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='suite scenario (default: all)')
+    parser.add_argument('--results', help='append the results as a JSON line to this file')
+    parser.add_argument('--label', default='', help='name of this run in the results file')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--token', help='JWT access token sent as a Bearer header')
+    parser.add_argument('--header', action='append', default=[], help='extra "Name: value" header')
+    options = parser.parse_args()
+
+    headers = dict(h.split(':', 1) for h in options.header)
+    headers = {name.strip(): value.strip() for name, value in headers.items()}
+    if options.token:
+        headers['Authorization'] = f'Bearer {options.token}'
+
+    if options.suite:
+        with open(options.suite) as f:
+            manifest = json.load(f)
+        results = run_suite(manifest, options.base_url, options.scenario or SCENARIOS,
+                            options.concurrency, options.duration, headers)
+    elif options.urls:
+        results = run_load(options.urls, options.concurrency, options.duration, headers)
+    else:
+        parser.error('give URLs or --suite')
+
+    print_results(results)
+    if options.results:
+        save_results(options.results, options.label, options, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 from datetime import timedelta
 import dj_database_url
@@ -71,6 +72,10 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Outermost, so its total covers the rest of the stack
+    'cheques.middleware.PerformanceMiddleware',
+    # Before anything that reads or changes the response body
+    'cheques.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -133,7 +138,7 @@ ROOT_URLCONF = 'src.urls'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'cheques.authentication.CachedJWTAuthentication',
         # 'rest_framework.authentication.SessionAuthentication', 
     ],
 
@@ -143,8 +148,14 @@ REST_FRAMEWORK = {
     
     'EXCEPTION_HANDLER': 'cheques.exception_handler.custom_exception_handler',
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-    ],  
+        'cheques.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'cheques.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 
     # 'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     # 'PAGE_SIZE': 10,  # Set a default page size
@@ -184,6 +195,12 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'src.wsgi.application'
+# Served by uvicorn workers under gunicorn when SERVER_MODE=asgi (see gunicorn.conf.py)
+ASGI_APPLICATION = 'src.asgi.application'
+SERVER_MODE = config('SERVER_MODE', default='wsgi')
+# Run the slow report/upload views on the thread pool (cheques.views.run_in_worker_thread);
+# only pays off under ASGI
+OFFLOAD_SLOW_VIEWS = config('OFFLOAD_SLOW_VIEWS', default=SERVER_MODE == 'asgi', cast=bool)
 
 
 # Database
@@ -225,9 +242,45 @@ DATABASES = {
         'PASSWORD': os.environ.get('DJANGO_DB_PASSWORD', os.environ.get('POSTGRES_PASSWORD', 'adam01')),
         'HOST': os.environ.get('DJANGO_DB_HOST', os.environ.get('DB_HOST', 'localhost')),
         'PORT': os.environ.get('DJANGO_DB_PORT', os.environ.get('DB_PORT', '5432')),
+        # Keep each worker's connection open for DB_CONN_MAX_AGE seconds instead of
+        # reconnecting (and authenticating) on every request; 0 closes it after each
+        # request. A reused connection is pinged first, so a dropped one is replaced.
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': config('DB_CONN_HEALTH_CHECKS', default=True, cast=bool),
+        'OPTIONS': {
+            'connect_timeout': config('DB_CONNECT_TIMEOUT', default=5, cast=int),
+        },
     }
 }
 
+# DB_POOL_MODE=transaction when connecting through a transaction-pooling proxy
+# (PgBouncer pool_mode = transaction): the server connection is only ours for
+# the length of one transaction, so nothing may rely on session state.
+#  - server-side cursors (QuerySet.iterator) outlive the transaction: disabled
+#  - Django sets the session time zone on connect unless the server already
+#    uses UTC, so set it on the role:  ALTER ROLE <user> SET timezone TO 'UTC';
+DB_POOL_MODE = config('DB_POOL_MODE', default='session')
+if DB_POOL_MODE == 'transaction':
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+# Read replica (cheques/db_router.py). With DJANGO_DB_REPLICA_HOST set, list/
+# retrieve GETs and reports read from the replica; writes, and each user's
+# reads for REPLICA_STICKY_SECONDS after their own writes, use the primary.
+# Keep the window above the usual replication lag.
+DB_REPLICA_HOST = os.environ.get('DJANGO_DB_REPLICA_HOST', '')
+TESTING = sys.argv[1:2] == ['test']
+if DB_REPLICA_HOST or TESTING:
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': DB_REPLICA_HOST or DATABASES['default']['HOST'],
+        'PORT': os.environ.get('DJANGO_DB_REPLICA_PORT', DATABASES['default']['PORT']),
+        # Tests read the primary's test database through this alias
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['cheques.db_router.PrimaryReplicaRouter']
+REPLICA_READS = config('REPLICA_READS', default=bool(DB_REPLICA_HOST), cast=bool)
+REPLICA_STICKY_SECONDS = config('REPLICA_STICKY_SECONDS', default=5, cast=int)
+
 #Development Database settings for PostgreSQL localhost
 # DATABASES = {
 #     'default': {
@@ -261,6 +314,30 @@ DATABASES = {
 # }
 
 
+# Shared cache. CACHE_URL picks the backend:
+#   redis://host:6379/1            Redis, shared by all gunicorn workers (production)
+#   file:///var/tmp/chequestore    file based, shared by workers on one host
+#   locmem://                      per-process memory (default; development and tests)
+CACHE_URL = config('CACHE_URL', default='locmem://')
+if CACHE_URL.startswith(('redis://', 'rediss://')):
+    CACHE_BACKEND, CACHE_LOCATION = 'django.core.cache.backends.redis.RedisCache', CACHE_URL
+elif CACHE_URL.startswith('file://'):
+    CACHE_BACKEND, CACHE_LOCATION = 'django.core.cache.backends.filebased.FileBasedCache', CACHE_URL[len('file://'):]
+else:
+    CACHE_BACKEND, CACHE_LOCATION = 'django.core.cache.backends.locmem.LocMemCache', 'chequestore'
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': CACHE_LOCATION,
+        'KEY_PREFIX': 'chequestore',
+        # Bump CACHE_VERSION to drop every cached entry at once (e.g. on a data format change)
+        'VERSION': config('CACHE_VERSION', default=1, cast=int),
+        'TIMEOUT': 300,
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -340,6 +417,54 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 DATE_FORMAT = '%b %d, %Y'  # Mar 04, 2025 format
 DECIMAL_PLACES = 0
 
+# Time allowed for the exact-match search of the invoice allocation endpoint
+ALLOCATION_SEARCH_BUDGET_MS = config('ALLOCATION_SEARCH_BUDGET_MS', default=50, cast=int)
+
+# Claims summary rollups are invalidated on write, so they can live long
+CLAIMS_SUMMARY_CACHE_SECONDS = config('CLAIMS_SUMMARY_CACHE_SECONDS', default=3600, cast=int)
+
+# Settled payments (with their details, claims and invoices) older than this
+# are moved to the archive tables by `manage.py archive_history` (cheques/archive.py)
+ARCHIVE_AFTER_DAYS = config('ARCHIVE_AFTER_DAYS', default=730, cast=int)
+
+# Payment instrument/type reference cache (cheques/Instrument.py), also dropped on write
+REFERENCE_CACHE_SECONDS = config('REFERENCE_CACHE_SECONDS', default=300, cast=int)
+# How often a worker checks the shared cache for reference data changed by another worker
+REFERENCE_CACHE_CHECK_SECONDS = config('REFERENCE_CACHE_CHECK_SECONDS', default=2, cast=int)
+
+# Authenticated users are cached per token (cheques/authentication.py) and dropped when the user changes
+AUTH_USER_CACHE_SECONDS = config('AUTH_USER_CACHE_SECONDS', default=60, cast=int)
+
+# Response compression (cheques/middleware.py): brotli when accepted, else gzip
+COMPRESSION_MIN_SIZE = config('COMPRESSION_MIN_SIZE', default=1024, cast=int)
+COMPRESSION_BROTLI_QUALITY = config('COMPRESSION_BROTLI_QUALITY', default=5, cast=int)
+COMPRESSION_CONTENT_TYPES = [
+    'application/json',
+    'text/csv',
+    'text/plain',
+    'text/html',
+    'application/javascript',
+    'text/css',
+]
+
+# Request metrics (cheques/metrics.py): Server-Timing header, /metrics (only
+# served when METRICS_TOKEN is set; scrape with Authorization: Bearer <token>)
+# and sampled slow requests in logs/slow_requests.log.
+# METRICS_SERVER_TIMING=True adds query counts and timings to every response,
+# for any client to read: opt in on development or internal deployments only
+METRICS_SERVER_TIMING = config('METRICS_SERVER_TIMING', default=False, cast=bool)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+METRICS_FLUSH_SECONDS = config('METRICS_FLUSH_SECONDS', default=10, cast=int)
+SLOW_REQUEST_MS = config('SLOW_REQUEST_MS', default=1000, cast=int)
+SLOW_REQUEST_SAMPLE_RATE = config('SLOW_REQUEST_SAMPLE_RATE', default=1.0, cast=float)
+
+# N+1 query detection (cheques/nplusone.py): 'log', 'raise' or 'off'. A
+# request fails or logs when one query shape repeats NPLUSONE_THRESHOLD times.
+# It walks the stack on every query, so it is 'raise' under `manage.py test`
+# and off otherwise; set NPLUSONE_DETECTION=log in development to opt in
+NPLUSONE_DETECTION = config('NPLUSONE_DETECTION', default='raise' if TESTING else 'off')
+NPLUSONE_THRESHOLD = config('NPLUSONE_THRESHOLD', default=3, cast=int)
+
 
 
 # import os
@@ -370,6 +495,14 @@ LOGGING = {
             'class': 'logging.StreamHandler',
             'formatter': 'verbose'
         },
+        'slow_requests': {
+            'level': 'WARNING',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': os.path.join(LOGS_DIR, 'slow_requests.log'),
+            'maxBytes': 1024*1024*5,  # 5MB
+            'backupCount': 5,
+            'formatter': 'verbose'
+        },
     },
     'loggers': {
         'django': {
@@ -377,5 +510,15 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'cheques.nplusone': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'cheques.slow_requests': {
+            'handlers': ['slow_requests'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     },
 }
\ No newline at end of file
@@ -6,13 +6,14 @@ from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 #media serving to urls.py: 
 from django.conf import settings
 from django.conf.urls.static import static
-from cheques.views import CustomTokenObtainPairView, user_detail
+from cheques.views import CustomTokenObtainPairView, metrics_view, user_detail
 from cheques.views import ParentCustomerDueReport
  #, CIvsChequeReportView
 # from cheques.views import frontend_config
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
      path('v1/chq/parent-customer-due-report/', ParentCustomerDueReport.as_view(), name='parent-customer-due-report'),
     # path('v1/chq/unallocated-payments/', unallocated_payments, name='unallocated-payments'),
     # path('v1/chq/reports/invoice-payments/', InvoicePaymentReportView.as_view(), name='invoice-payment-report'),